@@ -0,0 +1,298 @@
+"""上游准入控制：按服务商和上游端点限制同时进行的请求数，超出的请求在有界队列中等待。
+
+队列已满或排队超过最长等待时间时立即拒绝（Overloaded），调用方返回 503 和按近期上游耗时
+估算的 Retry-After。上游变慢时请求不会无限堆积占满服务线程，健康检查等其他接口照常响应。
+线程中的同步调用和 ASGI 事件循环中的异步调用共用同一组队列，按到达顺序获得名额。
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+
+REASONS = ("queue_full", "timeout")
+
+
+class Overloaded(Exception):
+    """上游已满载，请求被拒绝"""
+
+    def __init__(self, provider, endpoint, reason, retry_after):
+        super().__init__(f"Upstream '{provider}' is overloaded ({reason}), retry after {retry_after}s")
+        self.provider = provider
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """排队中的请求；名额释放时由释放者直接转交，不会被后来的请求插队"""
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        # 调用方已持有所在 Gate 的锁
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Gate:
+    """单个 (服务商, 端点) 的并发名额和等待队列"""
+
+    def __init__(self, controller, provider, endpoint):
+        self.controller = controller
+        self.provider = provider
+        self.endpoint = endpoint
+
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self._active = 0
+        self._service_time = None  # 名额占用时长的指数移动平均（秒）
+        self._stats = {"admitted": 0, "queued": 0, "peak_queue": 0, **{reason: 0 for reason in REASONS}}
+
+    # 上限随时从 controller 读取，启动后调整（如 asgi.py）对已创建的 Gate 同样生效
+    @property
+    def max_concurrency(self):
+        return self.controller.provider_limits.get(self.provider) or self.controller.max_concurrency
+
+    @property
+    def max_queue(self):
+        return self.controller.max_queue
+
+    @property
+    def max_wait(self):
+        return self.controller.max_wait
+
+    # --- 名额 ---
+    def _enter(self, loop=None):
+        """有空闲名额时直接占用并返回 None，否则排队并返回 _Waiter；队列已满时拒绝"""
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                self._stats["admitted"] += 1
+                self.controller._changed(self)
+                return None
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject("queue_full")
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            self._stats["queued"] += 1
+            self._stats["peak_queue"] = max(self._stats["peak_queue"], len(self._waiters))
+            self.controller._changed(self)
+            return waiter
+
+    def _leave_queue(self, waiter, reason):
+        """放弃排队；刚好已获得名额时返回 True（由调用方使用或归还）"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self.controller._changed(self)
+            if reason is None:
+                return False
+            raise self._reject(reason)
+
+    def _reject(self, reason):
+        # 调用方已持有锁
+        self._stats[reason] += 1
+        self.controller._rejected(self, reason)
+        return Overloaded(self.provider, self.endpoint, reason, self._retry_after())
+
+    def _retry_after(self):
+        """按排在前面的请求数和平均占用时长估算多久后可能有空闲名额（整秒）"""
+        service_time = self._service_time if self._service_time is not None else self.max_wait
+        rounds = math.ceil((len(self._waiters) + 1) / self.max_concurrency)
+        return int(min(max(math.ceil(service_time * rounds), 1), self.controller.max_retry_after))
+
+    def _release(self, started=None):
+        with self._lock:
+            if started is not None:
+                elapsed = time.monotonic() - started
+                if self._service_time is None:
+                    self._service_time = elapsed
+                else:
+                    self._service_time += 0.2 * (elapsed - self._service_time)
+            if self._waiters:
+                # 名额直接转交给排在最前的请求，占用数不变
+                self._waiters.popleft().grant()
+                self._stats["admitted"] += 1
+            else:
+                self._active -= 1
+            self.controller._changed(self)
+
+    def _releaser(self, waited):
+        self.controller._waited(self, waited)
+        started = time.monotonic()
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._release(started)
+
+        return release
+
+    def acquire(self):
+        """在当前线程中等待名额，返回归还名额的函数（可重复调用）"""
+        started = time.monotonic()
+        waiter = self._enter()
+        if waiter is not None and not waiter.event.wait(self.max_wait):
+            self._leave_queue(waiter, "timeout")
+        return self._releaser(time.monotonic() - started)
+
+    async def acquire_async(self):
+        """在事件循环中等待名额，不占用线程"""
+        started = time.monotonic()
+        waiter = self._enter(asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+            except asyncio.TimeoutError:
+                self._leave_queue(waiter, "timeout")
+            except asyncio.CancelledError:
+                # 客户端断开：退出队列，已转交过来的名额归还
+                if self._leave_queue(waiter, None):
+                    self._release()
+                raise
+        return self._releaser(time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active"] = self._active
+            stats["queue_depth"] = len(self._waiters)
+            stats["avg_service_seconds"] = round(self._service_time, 3) if self._service_time is not None else None
+        stats.update(
+            provider=self.provider, endpoint=self.endpoint,
+            max_concurrency=self.max_concurrency, max_queue=self.max_queue, max_wait=self.max_wait,
+        )
+        return stats
+
+
+class AdmissionController:
+    """各 (服务商, 端点) 的 Gate；端点只保留 scheme://host:port，官方 API 记为 default
+
+    provider_limits 可单独指定某个服务商每个端点的并发数，未指定时使用 max_concurrency。
+    """
+
+    def __init__(self, max_concurrency=16, max_queue=32, max_wait=10.0, max_retry_after=60,
+                 provider_limits=None, enabled=True, metrics_registry=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retry_after = max_retry_after
+        self.provider_limits = {provider: limit for provider, limit in (provider_limits or {}).items() if limit > 0}
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._gates = {}
+        self._pid = os.getpid()
+        self._metrics = None
+        if metrics_registry is not None:
+            labels = ("provider", "endpoint")
+            self._metrics = {
+                "active": metrics_registry.gauge(
+                    "tts_admission_active", "Upstream requests holding an admission slot", labels
+                ),
+                "queue": metrics_registry.gauge(
+                    "tts_admission_queue_depth", "Requests waiting for an upstream admission slot", labels
+                ),
+                "rejected": metrics_registry.counter(
+                    "tts_admission_rejections_total", "Requests rejected by admission control",
+                    labels + ("reason",)
+                ),
+                "wait": metrics_registry.histogram(
+                    "tts_admission_wait_seconds", "Time spent waiting for an upstream admission slot", labels,
+                    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+                ),
+            }
+
+    @staticmethod
+    def endpoint_label(endpoint):
+        if not endpoint:
+            return "default"
+        from urllib.parse import urlsplit
+        parts = urlsplit(endpoint)
+        return f"{parts.scheme}://{parts.netloc}" if parts.netloc else endpoint
+
+    def gate(self, provider, endpoint=None):
+        key = (provider, self.endpoint_label(endpoint))
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 出的子进程不继承父进程的名额占用
+                self._pid = os.getpid()
+                self._gates.clear()
+            gate = self._gates.get(key)
+            if gate is None:
+                gate = self._gates[key] = Gate(self, key[0], key[1])
+            return gate
+
+    def acquire(self, provider, endpoint=None):
+        """等待 provider/endpoint 的名额，返回归还名额的函数；满载时抛出 Overloaded"""
+        if not self.enabled:
+            return _noop
+        return self.gate(provider, endpoint).acquire()
+
+    async def acquire_async(self, provider, endpoint=None):
+        if not self.enabled:
+            return _noop
+        return await self.gate(provider, endpoint).acquire_async()
+
+    # --- 指标 ---
+    def _changed(self, gate):
+        if self._metrics is not None:
+            self._metrics["active"].set(gate._active, provider=gate.provider, endpoint=gate.endpoint)
+            self._metrics["queue"].set(len(gate._waiters), provider=gate.provider, endpoint=gate.endpoint)
+
+    def _rejected(self, gate, reason):
+        if self._metrics is not None:
+            self._metrics["rejected"].inc(provider=gate.provider, endpoint=gate.endpoint, reason=reason)
+
+    def _waited(self, gate, seconds):
+        if self._metrics is not None:
+            self._metrics["wait"].observe(seconds, provider=gate.provider, endpoint=gate.endpoint)
+
+    def stats(self):
+        with self._lock:
+            gates = list(self._gates.values())
+        return {
+            "enabled": self.enabled,
+            "max_concurrency": self.max_concurrency,
+            "provider_limits": self.provider_limits,
+            "max_queue": self.max_queue,
+            "max_wait": self.max_wait,
+            "gates": [gate.stats() for gate in gates],
+        }
+
+
+def _noop():
+    pass
+
+
+def create_admission_from_env(metrics_registry=None):
+    """根据环境变量创建准入控制"""
+    return AdmissionController(
+        max_concurrency=int(os.environ.get("TTS_ADMISSION_MAX_CONCURRENCY", 16)),
+        max_queue=int(os.environ.get("TTS_ADMISSION_MAX_QUEUE", 32)),
+        max_wait=float(os.environ.get("TTS_ADMISSION_MAX_WAIT", 10)),
+        max_retry_after=int(os.environ.get("TTS_ADMISSION_MAX_RETRY_AFTER", 60)),
+        provider_limits={
+            "openai": int(os.environ.get("TTS_ADMISSION_OPENAI_CONCURRENCY", 0)),
+            "gemini": int(os.environ.get("TTS_ADMISSION_GEMINI_CONCURRENCY", 0)),
+        },
+        enabled=os.environ.get("TTS_ADMISSION_ENABLED", "1").lower() not in ("0", "false", "no"),
+        metrics_registry=metrics_registry,
+    )
@@ -0,0 +1,230 @@
+"""API密钥认证缓存，以及 last_used_at 的合并批量写入。"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class ApiKeyCache:
+    """已验证API密钥记录的进程内 TTL 缓存
+
+    无效密钥也会短暂缓存（negative_ttl），防止无效密钥刷接口时反复查库。
+    失效时除清理本进程外，还会改写一个标记文件，
+    其他 worker 进程最多每 generation_interval 秒检查一次标记，发现变化即清空自己的缓存。
+
+    同时缓存每个密钥最近一次预占后的当日已用次数（quota_ttl 秒），
+    已知额度用尽的密钥在此期间直接拒绝，不必每次访问数据库。任何进程退还额度时更新
+    另一个标记文件（quota_generation_file），各进程在下一次检查标记时丢弃缓存的已用次数。
+    """
+
+    def __init__(self, ttl=30, negative_ttl=5, max_entries=10000, generation_file=None,
+                 generation_interval=1.0, quota_ttl=5, quota_generation_file=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.generation_file = generation_file
+        self.generation_interval = generation_interval
+        self.quota_ttl = quota_ttl
+        self.quota_generation_file = quota_generation_file
+
+        self._lock = threading.Lock()
+        self._entries = {}  # api_key -> (record 或 None, expires_at)
+        self._quota = {}  # key_id -> (day, used, expires_at)
+        self._generation = self._read_generation(generation_file)
+        self._quota_generation = self._read_generation(quota_generation_file)
+        self._next_check = time.monotonic() + generation_interval
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0, "quota_hits": 0}
+
+    @staticmethod
+    def _read_generation(path):
+        if not path:
+            return None
+        # 比较文件内容（写入时的纳秒时间戳），不受文件系统修改时间精度影响
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _bump(path):
+        """更新标记文件，返回新的标记（未配置或写入失败时返回 None）"""
+        if not path:
+            return None
+        generation = f"{time.time_ns()}-{os.getpid()}"
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(generation)
+        except OSError:
+            return None
+        return generation
+
+    def _bump_generation(self):
+        generation = self._bump(self.generation_file)
+        if generation is not None:
+            self._generation = generation
+
+    def _check_generation(self, now):
+        # 每 generation_interval 秒最多读一次标记文件
+        if now < self._next_check:
+            return
+        self._next_check = now + self.generation_interval
+        generation = self._read_generation(self.generation_file)
+        quota_generation = self._read_generation(self.quota_generation_file)
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._quota.clear()
+                self._generation = generation
+            if quota_generation != self._quota_generation:
+                self._quota.clear()
+                self._quota_generation = quota_generation
+
+    def get(self, api_key):
+        """查询缓存，返回 (是否命中, 密钥记录)；命中但密钥无效时记录为 None"""
+        now = time.monotonic()
+        self._check_generation(now)
+        with self._lock:
+            item = self._entries.get(api_key)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self._entries[api_key]
+                self._stats["misses"] += 1
+                return False, None
+            self._stats["hits"] += 1
+            return True, item[0]
+
+    def put(self, api_key, record):
+        """写入验证结果，record 为 None 表示密钥无效或已停用"""
+        ttl = self.ttl if record is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                for k in [k for k, v in self._entries.items() if v[1] < now]:
+                    del self._entries[k]
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[api_key] = (record, time.monotonic() + ttl)
+
+    def get_quota(self, key_id, day):
+        """返回缓存的当日已用次数；未缓存、已过期或日期不同时返回 None"""
+        self._check_generation(time.monotonic())
+        with self._lock:
+            item = self._quota.get(key_id)
+            if item is None or item[0] != day or item[2] < time.monotonic():
+                return None
+            self._stats["quota_hits"] += 1
+            return item[1]
+
+    def put_quota(self, key_id, day, used):
+        """记录预占后的当日已用次数"""
+        if self.quota_ttl <= 0:
+            return
+        with self._lock:
+            if len(self._quota) >= self.max_entries:
+                self._quota.clear()
+            self._quota[key_id] = (day, used, time.monotonic() + self.quota_ttl)
+
+    def forget_quota(self, key_id):
+        """退还额度后丢弃缓存的已用次数，下次预占重新查询；同时通知其他进程丢弃"""
+        with self._lock:
+            self._quota.pop(key_id, None)
+        self._bump(self.quota_generation_file)
+
+    def invalidate(self, key_id=None):
+        """使缓存失效：指定 key_id 时移除该密钥及所有无效密钥记录，否则全部清空"""
+        with self._lock:
+            if key_id is None:
+                self._entries.clear()
+                self._quota.clear()
+            else:
+                self._quota.pop(key_id, None)
+                # 重新启用的密钥可能正以“无效”状态缓存着，一并清掉
+                for k in [k for k, v in self._entries.items() if v[0] is None or v[0]["id"] == key_id]:
+                    del self._entries[k]
+            self._stats["invalidations"] += 1
+        self._bump_generation()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["ttl"] = self.ttl
+            stats["quota_entries"] = len(self._quota)
+        return stats
+
+
+class LastUsedTracker:
+    """合并 last_used_at 更新，由后台线程定期批量写入数据库"""
+
+    def __init__(self, connect, interval=10):
+        self.connect = connect
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pending = {}  # key_id -> 最后使用时间（UTC，与 CURRENT_TIMESTAMP 格式一致）
+        self._thread = None
+        self._pid = None
+        self._stats = {"touches": 0, "flushes": 0, "rows_written": 0, "errors": 0}
+        atexit.register(self.flush)
+
+    def _ensure_thread(self):
+        # 懒启动，并在 fork 出的 worker 中重新启动
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="last-used-flusher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def touch(self, key_id):
+        """记录一次密钥使用，仅更新内存"""
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._pending[key_id] = now
+            self._stats["touches"] += 1
+            if self.interval > 0:
+                self._ensure_thread()
+        if self.interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """将待写入的 last_used_at 在一个事务中批量更新"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+        try:
+            db = self.connect()
+            try:
+                db.executemany(
+                    "UPDATE api_keys SET last_used_at = ? WHERE id = ?",
+                    [(used_at, key_id) for key_id, used_at in pending.items()],
+                )
+                db.commit()
+            finally:
+                db.close()
+        except Exception:
+            # 写入失败时放回队列，下次再试（保留较新的时间）
+            with self._lock:
+                for key_id, used_at in pending.items():
+                    self._pending.setdefault(key_id, used_at)
+                self._stats["errors"] += 1
+            return 0
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += len(pending)
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        return stats
@@ -3,25 +3,57 @@ import sqlite3
 from functools import wraps
 
 from flask import (
-    Flask, Response, g, jsonify, request, send_from_directory, session
+    Flask, Response, g, has_request_context, jsonify, make_response, request, send_file, send_from_directory,
+    session
 )
 from flask_cors import CORS
 from werkzeug.security import check_password_hash, generate_password_hash
 import hashlib
+import hmac
 import secrets
 import base64
 import json
+import re
+import logging
+import time
 from datetime import datetime, timedelta
 
+import admission
+import audio
+import batch
+import database
+import hedge
+import long_text
+import metrics
+import migrations
+import proxy_dialects
+import quota
+import rate_limit
+import singleflight
+import structured_log
+import transcode
+from api_key_cache import ApiKeyCache, LastUsedTracker
+from gemini_stream import GeminiAudioStream, iter_proxy_audio, iter_sdk_audio
+from jobs import JobQueue
+from provider_clients import create_proxy_pool_from_env, create_registry_from_env
+from tts_cache import create_cache_from_env, make_cache_key
+from usage_writer import UsageWriter
+
 # --- App Configuration ---
 app = Flask(__name__, static_folder="static", static_url_path="")
 
+# 结构化日志（级别、请求 ID、字段截断、调试采样），经队列由后台线程写出
+structured_log.configure_from_env()
+logger = logging.getLogger(__name__)
+# 客户端传入的请求 ID 只接受这些字符，否则重新生成
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,64}")
+
 # 启用CORS支持，允许来自任何源的请求
 CORS(app, resources={
     r"/api/*": {
         "origins": "*",
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "X-Request-ID"]
     }
 })
 
@@ -40,131 +72,404 @@ app.config.update(
     SEND_FILE_MAX_AGE_DEFAULT=31536000,  # 1年的静态文件缓存
 )
 
+# 数据库连接管理：每个工作线程复用一个已调优（WAL 等）的长连接
+db_connections = database.ConnectionManager(DATABASE)
+
+# 合成结果缓存（内存LRU + 磁盘），默认放在数据库文件旁的 tts_cache 目录
+synthesis_cache = create_cache_from_env(
+    os.path.join(os.path.dirname(os.path.abspath(DATABASE)), "tts_cache")
+)
+# 已合成音频的稳定 ID：缓存键（SHA-256）加上绑定请求者的 HMAC，可通过 /api/audio/<id> 按字节范围读取
+AUDIO_ID_RE = re.compile(r"([0-9a-f]{64})\.([0-9a-f]{32})")
+AUDIO_ID_SECRET = hmac.new(app.secret_key.encode("utf-8"), b"tts-audio-id", hashlib.sha256).digest()
+
+# 服务商SDK客户端注册表，进程内复用 keep-alive 连接池
+provider_clients = create_registry_from_env()
+
+# 各代理端点/模型可用的请求格式，避免每次都从标准格式开始试
+proxy_payload_dialects = proxy_dialects.DialectMemory(
+    ttl=float(os.environ.get("GEMINI_PROXY_DIALECT_TTL", 3600))
+)
+
+# API密钥认证缓存；标记文件用于通知其他 worker 进程缓存已失效、额度已退还
+api_key_cache = ApiKeyCache(
+    ttl=float(os.environ.get("TTS_AUTH_CACHE_TTL", 30)),
+    negative_ttl=float(os.environ.get("TTS_AUTH_NEGATIVE_TTL", 5)),
+    generation_file=DATABASE + ".keys-gen",
+    quota_ttl=float(os.environ.get("TTS_AUTH_QUOTA_TTL", 5)),
+    quota_generation_file=DATABASE + ".quota-gen",
+)
+
+# last_used_at 合并后定期批量写入
+last_used_tracker = LastUsedTracker(
+    lambda: database.connect(DATABASE),
+    interval=float(os.environ.get("TTS_LAST_USED_FLUSH_INTERVAL", 10)),
+)
+
+# 每个API密钥的请求速率和并发上限（进程内检查），拒绝次数定期批量写入
+key_rate_limiter = rate_limit.KeyRateLimiter(
+    lambda: database.connect(DATABASE),
+    interval=float(os.environ.get("TTS_RATE_LIMIT_FLUSH_INTERVAL", 10)),
+)
+
+# 长文本合成：各服务商单次请求的字符上限、总长度上限，以及全局共享的分块并发数
+LONG_TEXT_CHUNK_CHARS = {
+    "openai": int(os.environ.get("TTS_OPENAI_CHUNK_CHARS", 4000)),
+    "gemini": int(os.environ.get("TTS_GEMINI_CHUNK_CHARS", 3000)),
+}
+LONG_TEXT_MAX_CHARS = int(os.environ.get("TTS_LONG_TEXT_MAX_CHARS", 200000))
+long_text_synthesizer = long_text.LongTextSynthesizer(
+    max_workers=int(os.environ.get("TTS_LONG_TEXT_WORKERS", 4))
+)
+
+# 批量合成：共享线程池 + 各服务商的并发上限
+BATCH_MAX_ITEMS = int(os.environ.get("TTS_BATCH_MAX_ITEMS", 100))
+batch_runner = batch.BatchRunner(
+    max_workers=int(os.environ.get("TTS_BATCH_WORKERS", 8)),
+    provider_limits={
+        "openai": int(os.environ.get("TTS_BATCH_OPENAI_CONCURRENCY", 4)),
+        "gemini": int(os.environ.get("TTS_BATCH_GEMINI_CONCURRENCY", 2)),
+    },
+)
+
+# 异步合成任务队列（持久化在 SQLite 中），结果文件默认放在数据库文件旁的 tts_jobs 目录
+job_queue = JobQueue(
+    lambda: database.connect(DATABASE),
+    os.environ.get(
+        "TTS_JOB_RESULT_DIR", os.path.join(os.path.dirname(os.path.abspath(DATABASE)), "tts_jobs")
+    ),
+    handler=lambda job: run_synthesis_job(job),
+    workers=int(os.environ.get("TTS_JOB_WORKERS", 2)),
+    poll_interval=float(os.environ.get("TTS_JOB_POLL_INTERVAL", 1.0)),
+    stale_after=float(os.environ.get("TTS_JOB_STALE_SECONDS", 300)),
+    retention=float(os.environ.get("TTS_JOB_RETENTION_DAYS", 7)) * 86400,
+)
+JOB_MAX_WAIT = float(os.environ.get("TTS_JOB_MAX_WAIT", 30))
+# 上游持续满载时，任务从创建起最多等待这么多秒后按失败处理
+JOB_OVERLOAD_TIMEOUT = float(os.environ.get("TTS_JOB_OVERLOAD_TIMEOUT", 600))
+
+# 其他入口（如 asgi.py）注册的运行统计，一并在 /api/system/stats 中返回
+extra_system_stats = {}
+
+# Prometheus 指标（/metrics）；多进程部署时各进程通过 TTS_METRICS_DIR 中的快照汇总
+metrics_registry = metrics.create_registry_from_env()
+METRICS_TOKEN = os.environ.get("TTS_METRICS_TOKEN", "")
+REQUEST_LABELS = ("route", "method", "status", "provider", "model")
+http_requests = metrics_registry.counter("tts_http_requests_total", "HTTP requests", REQUEST_LABELS)
+http_request_duration = metrics_registry.histogram(
+    "tts_http_request_duration_seconds", "HTTP request latency including streamed body", REQUEST_LABELS
+)
+http_response_bytes = metrics_registry.counter(
+    "tts_http_response_bytes_total", "Response body bytes sent", ("route", "status")
+)
+http_in_flight = metrics_registry.gauge("tts_http_requests_in_flight", "HTTP requests in progress", ("route",))
+upstream_ttfb = metrics_registry.histogram(
+    "tts_upstream_ttfb_seconds", "Time until the upstream TTS returned the first audio bytes", ("provider", "model")
+)
+upstream_duration = metrics_registry.histogram(
+    "tts_upstream_duration_seconds", "Total upstream TTS request time", ("provider", "model", "status")
+)
+upstream_in_flight = metrics_registry.gauge(
+    "tts_upstream_requests_in_flight", "Upstream TTS requests in progress", ("provider",)
+)
+db_time = metrics_registry.histogram(
+    "tts_db_time_seconds", "Database time per request", ("route",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+db_queries = metrics_registry.counter("tts_db_queries_total", "Database statements executed by requests", ("route",))
+auth_duration = metrics_registry.histogram(
+    "tts_auth_duration_seconds", "API key authentication time", ("result",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+queue_wait = metrics_registry.histogram(
+    "tts_queue_wait_seconds", "Time work waited in a thread pool or job queue before starting", ("queue",)
+)
+
+# API使用记录后台批量写入
+usage_writer = UsageWriter(
+    lambda: database.connect(DATABASE),
+    max_queue=int(os.environ.get("TTS_USAGE_QUEUE_SIZE", 10000)),
+    batch_size=int(os.environ.get("TTS_USAGE_BATCH_SIZE", 200)),
+    flush_interval=float(os.environ.get("TTS_USAGE_FLUSH_MS", 50)) / 1000,
+    overflow=os.environ.get("TTS_USAGE_OVERFLOW", "sync"),
+    enabled=os.environ.get("TTS_USAGE_ASYNC", "1").lower() not in ("0", "false", "no"),
+    metrics_registry=metrics_registry,
+)
+
+# Gemini 输出的 WAV 按请求的 format 在本地转码（ffmpeg 或进程内编码库）
+transcoder = transcode.create_transcoder_from_env()
+
+# 上游准入控制：每个服务商/端点的并发上限和有界等待队列，满载时返回 503 + Retry-After
+upstream_admission = admission.create_admission_from_env(metrics_registry)
+
+# 参数完全相同的并发合成只调用一次上游，其余请求共享同一份音频
+upstream_flights = singleflight.create_singleflight_from_env(metrics_registry)
+
+# Gemini 自定义端点（代理）的长连接会话池
+proxy_sessions = create_proxy_pool_from_env(metrics_registry)
+
+# 配置了 Gemini 自定义端点时，代理与官方 API 之间的对冲策略
+gemini_hedger = hedge.create_hedger_from_env(metrics_registry)
+GEMINI_HEDGE_PRIMARY = os.environ.get("GEMINI_HEDGE_PRIMARY", "proxy").lower()
+
 
 # --- Database Initialization ---
 def init_db():
-    """初始化数据库，如果不存在则创建默认管理员用户。"""
+    """初始化数据库：执行未应用的迁移，如果没有用户则创建默认管理员。
+
+    导入本模块时自动执行（各 WSGI/ASGI 入口都会导入），可重复调用；多个进程同时启动时
+    每个迁移在 BEGIN IMMEDIATE 写锁内确认版本后执行，只会执行一次。
+    """
     database_exists = os.path.exists(DATABASE)
     
     with app.app_context():
         db = get_db()
         
-        # 检查是否需要创建表结构
-        try:
-            # 尝试查询users表来检查表是否存在
-            db.execute("SELECT COUNT(*) FROM users").fetchone()
-            tables_exist = True
-        except sqlite3.OperationalError:
-            tables_exist = False
+        # 按版本顺序执行数据库迁移（幂等，已应用的会跳过）
+        applied = migrations.apply_migrations(db)
+        if applied:
+            print(f"已应用数据库迁移: {', '.join(str(v) for v in applied)}")
         
-        # 如果表不存在，创建表结构
-        if not tables_exist:
-            print("正在创建数据库表结构...")
-            # 动态创建 schema.sql 文件以供 init_db() 使用
-            with open("schema.sql", "w", encoding="utf-8") as f:
-                f.write("""-- TTS Gateway 数据库架构
-
--- 用户表
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
--- TTS历史记录表
-CREATE TABLE IF NOT EXISTS tts_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    text TEXT NOT NULL,
-    provider TEXT NOT NULL,
-    voice TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users (id)
-);
-
--- API配置表
-CREATE TABLE IF NOT EXISTS api_settings (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    service_name TEXT NOT NULL,
-    api_key TEXT,
-    api_endpoint TEXT,
-    model_name TEXT NOT NULL DEFAULT 'tts-1',
-    FOREIGN KEY (user_id) REFERENCES users (id),
-    UNIQUE (user_id, service_name)
-);
-
--- API密钥管理表
-CREATE TABLE IF NOT EXISTS api_keys (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    key_name TEXT NOT NULL,
-    api_key TEXT UNIQUE NOT NULL,
-    is_active BOOLEAN DEFAULT 1,
-    daily_limit INTEGER DEFAULT 1000,
-    provider_permissions TEXT DEFAULT '["openai","gemini"]',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    last_used_at TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users (id)
-);
-
--- API调用记录表
-CREATE TABLE IF NOT EXISTS api_usage (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    api_key_id INTEGER NOT NULL,
-    provider TEXT NOT NULL,
-    model TEXT NOT NULL,
-    voice TEXT,
-    text_length INTEGER,
-    audio_duration REAL,
-    success BOOLEAN DEFAULT 1,
-    error_message TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (api_key_id) REFERENCES api_keys (id)
-);""")
-            
-            # 执行SQL脚本
-            with open("schema.sql", "r", encoding="utf-8") as f:
-                db.cursor().executescript(f.read())
-            print("数据库表结构创建成功。")
-        
-        # 检查是否有用户，如果没有则创建默认管理员
-        cursor = db.cursor()
-        user_count = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        
-        if user_count == 0:
-            cursor.execute(
-                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                ("admin", generate_password_hash("admin")),
-            )
+        # 检查是否有用户，如果没有则创建默认管理员（在写锁内再确认一次，多个进程同时启动时只创建一次）
+        if db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+            password_hash = generate_password_hash("admin")
+            db.commit()
+            db.execute("BEGIN IMMEDIATE")
+            created = db.execute(
+                "INSERT INTO users (username, password_hash) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM users)",
+                ("admin", password_hash),
+            ).rowcount
             db.commit()
-            print("已创建默认用户 'admin'，密码 'admin'。")
+            if created:
+                print("已创建默认用户 'admin'，密码 'admin'。")
         
         if not database_exists:
             print(f"生产数据库 '{DATABASE}' 创建成功。")
         else:
-            print("生产数据库已存在，表结构检查完成。")
-        
-        # 清理临时的 schema 文件
-        if os.path.exists("schema.sql"):
-            os.remove("schema.sql")
+            print(f"生产数据库已存在，当前架构版本: {migrations.current_version(db)}。")
 
 
 def get_db():
-    """为当前应用上下文打开一个新的数据库连接。"""
+    """获取当前线程复用的数据库连接。"""
     if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
+        g.db = db_connections.get()
     return g.db
 
 
 @app.teardown_appcontext
 def close_db(error):
-    """在请求结束时关闭数据库连接。"""
+    """在请求结束时归还数据库连接（回滚未提交的事务，连接留给本线程复用）。"""
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        db_connections.release(db)
+
+
+# --- Request IDs ---
+@app.before_request
+def assign_request_id():
+    """沿用客户端的 X-Request-ID 或生成新的 ID，写入本请求的所有日志并在响应头中返回"""
+    incoming = request.headers.get("X-Request-ID", "")
+    g.request_id = incoming if REQUEST_ID_RE.fullmatch(incoming) else secrets.token_hex(8)
+    structured_log.request_id.set(g.request_id)
+
+
+@app.after_request
+def add_request_id_header(response):
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+# --- Metrics ---
+def metrics_route():
+    """请求指标的 route 标签：使用路由规则而不是实际路径，避免 ID 等变量导致标签数量失控"""
+    return request.url_rule.rule if request.url_rule else "<unmatched>"
+
+
+def set_metrics_labels(provider, model):
+    """合成类请求把服务商和模型记入请求指标的标签"""
+    g.metrics_labels = {"provider": provider, "model": model or ""}
+
+
+@app.before_request
+def start_request_metrics():
+    metrics_registry.start()
+    # 预加载后 fork 出的工作进程在第一个请求时启动各自的任务线程（已启动时直接返回）
+    job_queue.start()
+    g.metrics_started = time.perf_counter()
+    database.query_stats.reset_thread()
+    http_in_flight.inc(route=metrics_route())
+
+
+@app.after_request
+def record_request_metrics(response):
+    """记录数据库时间；请求总耗时、发送字节数在响应体输出完毕（流式响应结束）后记录"""
+    route = metrics_route()
+    statements, db_elapsed = database.query_stats.thread_totals()
+    db_time.observe(db_elapsed, route=route)
+    db_queries.inc(statements, route=route)
+
+    started = g.get("metrics_started", time.perf_counter())
+    labels = dict(
+        g.get("metrics_labels", {"provider": "", "model": ""}),
+        route=route, method=request.method, status=str(response.status_code),
+    )
+    sent = [response.content_length or 0]
+    if response.content_length is None and not response.direct_passthrough:
+        body = response.response
+
+        def counting():
+            for chunk in body:
+                sent[0] += len(chunk)
+                yield chunk
+
+        response.response = counting()
+        # 由响应的关闭回调关闭原响应体：计数生成器尚未开始就被关闭时不会执行其中的清理代码
+        if hasattr(body, "close"):
+            response.call_on_close(body.close)
+
+    def finish():
+        http_requests.inc(**labels)
+        http_request_duration.observe(time.perf_counter() - started, **labels)
+        http_response_bytes.inc(sent[0], route=route, status=labels["status"])
+        http_in_flight.dec(route=route)
+
+    response.call_on_close(finish)
+    return response
+
+
+class TrackedBody:
+    """响应体：输出完毕（ok）、出错（error）或提前被关闭（cancelled）时调用一次 done(status)
+
+    用迭代器对象而不是生成器：尚未开始迭代的生成器被关闭时不会执行 finally，准入名额会一直占用。
+    """
+
+    def __init__(self, body, done):
+        self.body = body
+        self.iterator = None
+        self.done = done
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            if self.iterator is None:
+                self.iterator = iter(self.body)
+            return next(self.iterator)
+        except StopIteration:
+            self._finish("ok")
+            raise
+        except Exception:
+            self._finish("error")
+            raise
+
+    def close(self):
+        self._finish("cancelled")
+
+    def _finish(self, status):
+        done, self.done = self.done, None
+        if done is not None:
+            if hasattr(self.body, "close"):
+                self.body.close()
+            done(status)
+
+
+def release_after(body, release):
+    """响应体读完、出错或关闭后调用一次 release()（如归还借出的 SDK 客户端）"""
+    return TrackedBody(body, lambda status: release())
+
+
+def settle_on_close(response, settle):
+    """响应体完整发送、出错或客户端提前断开时调用一次 settle(status)，status 同 TrackedBody"""
+    body = TrackedBody(response.response, settle)
+    response.response = body
+    # 外层包装（如指标计数）尚未开始就被关闭时不会关闭内层，因此同时注册关闭回调
+    response.call_on_close(body.close)
+    return response
+
+
+def timed_upstream(provider, model, call, endpoint=None, admit=True):
+    """调用上游合成并记录首字节耗时、总耗时（音频输出完毕为止）和并发数
+
+    调用前先取得该服务商/端点的准入名额（满载时抛出 admission.Overloaded），音频输出完毕后归还。
+    admit 为 False 时不在这里占用名额（对冲的各条路径各自取得，见 admitted）。
+    """
+    release = upstream_admission.acquire(provider, endpoint) if admit else (lambda: None)
+    started = time.perf_counter()
+    upstream_in_flight.inc(provider=provider)
+
+    def done(status):
+        release()
+        upstream_in_flight.dec(provider=provider)
+        upstream_duration.observe(time.perf_counter() - started, provider=provider, model=model, status=status)
+
+    try:
+        result = call()
+    except Exception:
+        done("error")
+        raise
+    response = result[0] if isinstance(result, tuple) else result
+    if not isinstance(response, Response) or response.status_code != 200:
+        done("error")
+        return result
+    upstream_ttfb.observe(time.perf_counter() - started, provider=provider, model=model)
+    response.response = TrackedBody(response.response, done)
+    return result
+
+
+def instrument_upstream(provider, hedged=False):
+    """上游调用函数的装饰器，参数形如 (settings, text, voice, model=None, ...)
+
+    同一上游账号、参数完全相同的并发调用合并为一次（合并进来的请求不占用准入名额）。
+    hedged 为 True 且配置了自定义端点时，由对冲的每条路径各自取得准入名额。
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(settings, text, voice, model=None, *args, **kwargs):
+            model_name = model or settings["model_name"] or ""
+            key = (
+                f.__name__, settings["api_key"], settings["api_endpoint"], model_name, text, voice,
+                args, tuple(sorted(kwargs.items())),
+            )
+            return upstream_flights.do(key, lambda: timed_upstream(
+                provider, model_name, lambda: f(settings, text, voice, model, *args, **kwargs), settings["api_endpoint"],
+                admit=not (hedged and settings["api_endpoint"]),
+            ), provider)
+        return wrapper
+    return decorator
+
+
+def queue_timed(queue, fn):
+    """包装提交到线程池的函数，记录从提交到开始执行的排队时间，并把请求 ID 带入工作线程的日志"""
+    submitted = time.perf_counter()
+    current_request_id = structured_log.request_id.get()
+
+    def run(*args):
+        queue_wait.observe(time.perf_counter() - submitted, queue=queue)
+        structured_log.request_id.set(current_request_id)
+        return fn(*args)
+
+    return run
+
+
+@app.errorhandler(admission.Overloaded)
+def overloaded_response(error):
+    """上游满载、请求被准入控制拒绝：返回 503，Retry-After 为预计可重试的秒数"""
+    logger.warning(
+        "Upstream overloaded, request rejected",
+        extra={"provider": error.provider, "endpoint": error.endpoint, "reason": error.reason,
+               "retry_after": error.retry_after},
+    )
+    response = jsonify({
+        "error": "Upstream overloaded",
+        "message": str(error),
+        "provider": error.provider,
+        "retry_after": error.retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 
 def generate_api_key():
@@ -172,14 +477,168 @@ def generate_api_key():
     return 'tts_' + secrets.token_urlsafe(32)
 
 
-def log_api_usage(api_key_id, provider, model, voice, text_length, audio_duration=None, success=True, error_message=None):
-    """记录API使用情况"""
-    db = get_db()
-    db.execute("""
-        INSERT INTO api_usage (api_key_id, provider, model, voice, text_length, audio_duration, success, error_message)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (api_key_id, provider, model, voice, text_length, audio_duration, success, error_message))
-    db.commit()
+def log_api_usage(api_key_id, provider, model, voice, text_length, audio_duration=None, success=True, error_message=None, cached=False):
+    """记录API使用情况（进入后台队列批量写入，不阻塞请求线程）"""
+    usage_writer.submit(
+        (api_key_id, provider, model, voice, text_length, audio_duration, success, error_message, cached)
+    )
+
+
+def build_audio_response(data):
+    """按文件头识别上游音频，原始 PCM 补上 WAV 头部；头部与原始缓冲区分块输出，不拼接复制"""
+    chunks, mimetype = audio.assemble(data)
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Length'] = str(audio.chunks_size(chunks))
+    return response
+
+
+def audio_owner():
+    """当前请求者：开放API为密钥所属用户，网页为登录用户"""
+    key_info = g.get("api_key_info")
+    return key_info["user_id"] if key_info is not None else session.get("user_id")
+
+
+def audio_tag(cache_key, owner):
+    return hmac.new(AUDIO_ID_SECRET, f"{cache_key}:{owner}".encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+
+def audio_id(cache_key):
+    """已合成音频对当前请求者的 ID；其他用户无法由缓存键推算出可用的 ID"""
+    return f"{cache_key}.{audio_tag(cache_key, audio_owner())}"
+
+
+def set_audio_id(response, cache_key):
+    """已保存或输出完毕后会保存的音频响应带上 X-TTS-Audio-Id（后台任务中合成时没有请求者，不设置）"""
+    if response.status_code != 200 or not has_request_context():
+        return response
+    if response.headers.get('X-TTS-Cache') != 'HIT' and not synthesis_cache.storable(response.content_length):
+        return response
+    response.headers['X-TTS-Audio-Id'] = audio_id(cache_key)
+    return response
+
+
+def cached_audio_response(entry):
+    """用缓存条目构造音频响应"""
+    response = Response(entry.chunks, mimetype=entry.mimetype)
+    response.headers['Content-Length'] = str(entry.size)
+    response.headers['X-TTS-Cache'] = 'HIT'
+    return set_audio_id(response, entry.key)
+
+
+def cache_audio_response(cache_key, response):
+    """包装上游音频响应：输出给客户端的同时写入缓存"""
+    if response.status_code == 200 and response.mimetype.startswith('audio/'):
+        response.response = synthesis_cache.tee(cache_key, response.response, response.mimetype)
+        response.headers['X-TTS-Cache'] = 'MISS'
+        # 输出完成后即可通过该 ID 按字节范围读取
+        set_audio_id(response, cache_key)
+    return response
+
+
+def stored_audio_response(audio_id):
+    """按稳定 ID 返回已保存的音频，支持 Range/If-Range/ETag 条件请求；只有合成该音频的用户可以读取"""
+    match = AUDIO_ID_RE.fullmatch(audio_id)
+    if not match:
+        return jsonify({"error": "Invalid audio id"}), 400
+    cache_key, tag = match.groups()
+    # 其他用户的 ID 与不存在的音频一样返回 404，不泄露音频是否存在
+    if not hmac.compare_digest(tag, audio_tag(cache_key, audio_owner())):
+        return jsonify({"error": "Audio not found or expired"}), 404
+    entry = synthesis_cache.get(cache_key)
+    if entry is None:
+        return jsonify({"error": "Audio not found or expired"}), 404
+    response = Response(entry.chunks, mimetype=entry.mimetype)
+    # 缓存键由合成参数决定，同一 ID 的内容不会变化
+    response.set_etag(audio_id)
+    response.headers['Cache-Control'] = f'private, max-age={synthesis_cache.max_age}'
+    response.headers['X-TTS-Audio-Id'] = audio_id
+    return response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+
+
+def iter_base64_json(chunks, result_fields):
+    """return_base64 响应体：先输出 JSON 开头，音频逐块 base64 编码输出，最后输出其余字段
+
+    result_fields() 在音频输出完后调用，返回 (data 中的其余字段, usage)。
+    """
+    yield '{"success": true, "data": {"audio_base64": "'
+    yield from audio.iter_base64(chunks)
+    fields, usage = result_fields()
+    yield '", ' + json.dumps(fields, ensure_ascii=False)[1:-1] + '}, "usage": ' + json.dumps(usage, ensure_ascii=False) + '}'
+
+
+def gemini_transcode_format(provider, format):
+    """Gemini 请求的 format 可在本地转码时返回该格式，否则返回 None（照旧输出 WAV）"""
+    if provider == "gemini" and format in transcode.MIMETYPES and transcoder.supports(format):
+        return format
+    return None
+
+
+def transcode_audio_response(cache_key, source, format):
+    """把 Gemini 的 WAV 响应转码为 format 流式输出，并以 cache_key 写入缓存（源 WAV 有自己的缓存项）"""
+    # 转码器读完、出错、被拒绝或被取消时关闭源响应（归还合并的上游调用等）；满载时抛出 admission.Overloaded
+    body = transcoder.transcode(source.response, format, source.close)
+    response = Response(body, mimetype=transcode.MIMETYPES[format])
+    if 'X-TTS-Chunks' in source.headers:
+        response.headers['X-TTS-Chunks'] = source.headers['X-TTS-Chunks']
+    response.headers['X-TTS-Source-Cache'] = source.headers.get('X-TTS-Cache', 'MISS')
+    return cache_audio_response(cache_key, response)
+
+
+def synthesize_long_text(provider, settings, text, voice, model=None, format="mp3", speed=1.0):
+    """长文本合成：在句子边界切分，并发合成各块后免重编码拼接为一个音频"""
+    pieces = long_text.split_text(text, LONG_TEXT_CHUNK_CHARS[provider])
+
+    def synthesize_piece(piece):
+        if provider == "openai":
+            response = call_openai_tts(settings, piece, voice, model, format, speed)
+        else:
+            response = call_gemini_tts(settings, piece, voice, model)
+        return response.mimetype, response.get_data()
+
+    results = long_text_synthesizer.synthesize(pieces, queue_timed("long_text", synthesize_piece))
+    body = long_text.join_audio(
+        [audio for _, audio in results], format if provider == "openai" else "wav"
+    )
+    response = Response(body, mimetype=results[0][0])
+    response.headers['Content-Length'] = str(sum(len(part) for part in body))
+    response.headers['X-TTS-Chunks'] = str(len(pieces))
+    return response
+
+
+@instrument_upstream("gemini")
+def stream_gemini_tts(settings, text, voice, model=None, container="wav", cache_key=None):
+    """Gemini 流式合成：收到一块 PCM 就转发一块；代理端点优先（SSE），失败时回退到官方 SDK"""
+    model_name = model or settings["model_name"] or "gemini-2.5-flash-preview-tts"
+    on_complete = None
+    if cache_key is not None:
+        on_complete = lambda chunks, mimetype: synthesis_cache.put(cache_key, chunks, mimetype)
+
+    stream = None
+    release = None
+    if settings["api_endpoint"]:
+        try:
+            stream = GeminiAudioStream(
+                iter_proxy_audio(
+                    proxy_sessions, proxy_payload_dialects, settings["api_endpoint"], settings["api_key"],
+                    model_name, text, voice
+                ),
+                container,
+                on_complete,
+            )
+        except Exception as e:
+            logger.warning("Gemini proxy streaming failed, falling back to direct API", extra={"error": str(e)})
+    if stream is None:
+        client, release = provider_clients.lease("gemini", settings["api_key"])
+        try:
+            stream = GeminiAudioStream(iter_sdk_audio(client, model_name, text, voice), container, on_complete)
+        except Exception:
+            release()
+            raise
+
+    body = iter(stream) if release is None else release_after(iter(stream), release)
+    response = Response(body, mimetype=stream.mimetype, headers=stream.headers())
+    response.headers['X-TTS-Cache'] = 'MISS'
+    return response
 
 
 # --- Auth Decorator ---
@@ -197,64 +656,184 @@ def api_key_required(f):
     """API密钥认证装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # 获取API密钥
-        auth_header = request.headers.get('Authorization')
-        api_key = None
-        
-        if auth_header:
-            if auth_header.startswith('Bearer '):
-                api_key = auth_header[7:]  # 移除 'Bearer ' 前缀
-            elif auth_header.startswith('ApiKey '):
-                api_key = auth_header[7:]  # 移除 'ApiKey ' 前缀
-        
-        # 也支持查询参数中的API密钥
-        if not api_key:
-            api_key = request.args.get('api_key')
-        
-        if not api_key:
-            return jsonify({
-                "error": "API key required",
-                "message": "Please provide API key in Authorization header (Bearer <key>) or as api_key parameter"
-            }), 401
-        
-        # 验证API密钥
-        db = get_db()
-        key_info = db.execute(
+        started = time.perf_counter()
+        error = authenticate_api_key()
+        auth_duration.observe(time.perf_counter() - started, result="denied" if error else "ok")
+        if error:
+            return error
+        ticket, error = acquire_key_slot()
+        if error:
+            return error
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            ticket.release()
+            raise
+        return with_key_ticket(response, ticket)
+    
+    return decorated_function
+
+
+def authenticate_api_key():
+    """校验请求中的API密钥，通过时把密钥信息放入 g.api_key_info 并返回 None，否则返回错误响应"""
+    # 获取API密钥
+    auth_header = request.headers.get('Authorization')
+    api_key = None
+
+    if auth_header:
+        if auth_header.startswith('Bearer '):
+            api_key = auth_header[7:]  # 移除 'Bearer ' 前缀
+        elif auth_header.startswith('ApiKey '):
+            api_key = auth_header[7:]  # 移除 'ApiKey ' 前缀
+
+    # 也支持查询参数中的API密钥
+    if not api_key:
+        api_key = request.args.get('api_key')
+
+    if not api_key:
+        return jsonify({
+            "error": "API key required",
+            "message": "Please provide API key in Authorization header (Bearer <key>) or as api_key parameter"
+        }), 401
+
+    # 验证API密钥（优先使用进程内缓存）
+    db = get_db()
+    cache_hit, key_info = api_key_cache.get(api_key)
+    if not cache_hit:
+        row = db.execute(
             "SELECT ak.*, u.username FROM api_keys ak JOIN users u ON ak.user_id = u.id WHERE ak.api_key = ? AND ak.is_active = 1",
             (api_key,)
         ).fetchone()
-        
-        if not key_info:
-            return jsonify({"error": "Invalid or inactive API key"}), 401
-        
-        # 检查日使用限制
-        today = datetime.now().strftime('%Y-%m-%d')
-        usage_count = db.execute(
-            "SELECT COUNT(*) as count FROM api_usage WHERE api_key_id = ? AND DATE(created_at) = ? AND success = 1",
-            (key_info['id'], today)
-        ).fetchone()
-        
-        if usage_count['count'] >= key_info['daily_limit']:
-            return jsonify({
-                "error": "Daily API limit exceeded",
-                "limit": key_info['daily_limit'],
-                "used": usage_count['count']
-            }), 429
-        
-        # 更新最后使用时间
-        db.execute(
-            "UPDATE api_keys SET last_used_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (key_info['id'],)
+        key_info = dict(row) if row else None
+        api_key_cache.put(api_key, key_info)
+
+    if not key_info:
+        return jsonify({"error": "Invalid or inactive API key"}), 401
+
+    # 每日额度由合成接口原子地预占（daily_quota_required），这里不再单独查询
+
+    # 更新最后使用时间（合并后批量写入）
+    last_used_tracker.touch(key_info['id'])
+
+    # 将API密钥信息添加到请求上下文
+    g.api_key_info = key_info
+    return None
+
+
+def acquire_key_slot():
+    """按 g.api_key_info 的速率和并发上限放行一次请求，返回 (Ticket, None)；超限时返回 (None, 429 响应)"""
+    key_info = g.api_key_info
+    try:
+        ticket = key_rate_limiter.acquire(
+            key_info['id'],
+            rps=key_info.get('rps_limit') or 0,
+            burst=key_info.get('burst_limit') or 0,
+            max_concurrency=key_info.get('concurrency_limit') or 0,
         )
-        db.commit()
+    except rate_limit.RateLimited as e:
+        response = jsonify({
+            "error": "Rate limit exceeded" if e.reason == "rate" else "Too many concurrent requests",
+            "reason": e.reason,
+            "retry_after": e.retry_after,
+        })
+        response.status_code = 429
+        response.headers.update(e.headers)
+        return None, response
+    return ticket, None
+
+
+def with_key_ticket(response, ticket):
+    """附加速率限制响应头，响应发送完毕（包括流式响应）后归还并发名额"""
+    response.headers.update(ticket.headers)
+    response.call_on_close(ticket.release)
+    return response
+
+
+def parse_key_limits(data, defaults=None):
+    """校验请求中的 rps_limit/burst_limit/concurrency_limit（0 表示不限制），返回 (限制, 错误响应)"""
+    defaults = defaults or {}
+    limits = {}
+    for field, cast in (("rps_limit", float), ("burst_limit", int), ("concurrency_limit", int)):
+        value = data.get(field, defaults.get(field, 0))
+        try:
+            value = cast(value or 0)
+        except (TypeError, ValueError):
+            return None, (jsonify({"error": f"{field} must be a number"}), 400)
+        if value < 0 or value > 1000:
+            return None, (jsonify({"error": f"{field} must be between 0 and 1000 (0 = unlimited)"}), 400)
+        limits[field] = value
+    return limits, None
+
+
+def daily_quota_required(f):
+    """每日用量预占装饰器：请求被接受时原子地占用一次额度，失败或响应未完整发送时退还
+
+    需放在 api_key_required 之后使用。
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        day, error = reserve_daily_quota()
+        if error:
+            return error
         
-        # 将API密钥信息添加到请求上下文
-        g.api_key_info = key_info
-        return f(*args, **kwargs)
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            refund_daily_quota(day)
+            raise
+        
+        if response.status_code >= 400:
+            refund_daily_quota(day)
+            return response
+        return refund_on_incomplete(response, day)
     
     return decorated_function
 
 
+def reserve_daily_quota():
+    """为 g.api_key_info 预占一次当日额度，返回 (日期, None)；额度用尽时返回 (None, 429 响应)"""
+    key_info = g.api_key_info
+    day = quota.today()
+    reserved, used_today = reserve_quota(get_db(), key_info, day)
+    if not reserved:
+        return None, (jsonify({
+            "error": "Daily API limit exceeded",
+            "limit": key_info['daily_limit'],
+            "used": used_today
+        }), 429)
+    return day, None
+
+
+def reserve_quota(db, key_info, day, amount=1):
+    """原子地预占 amount 次额度，返回 (是否成功, 当日已用次数)；本进程已知额度用尽时不再访问数据库"""
+    used_today = api_key_cache.get_quota(key_info['id'], day)
+    if used_today is not None and used_today + amount > key_info['daily_limit']:
+        return False, used_today
+    reserved, used_today = quota.reserve(db, key_info['id'], key_info['daily_limit'], amount=amount, day=day)
+    api_key_cache.put_quota(key_info['id'], day, used_today)
+    return reserved, used_today
+
+
+def refund_quota(db, api_key_id, day, amount=1):
+    quota.refund(db, api_key_id, amount=amount, day=day)
+    api_key_cache.forget_quota(api_key_id)
+
+
+def refund_daily_quota(day):
+    refund_quota(get_db(), g.api_key_info['id'], day)
+
+
+def refund_on_incomplete(response, day):
+    """额度在响应完整发送后才算用掉：流式输出出错或客户端提前断开时退还（在请求结束后的关闭回调中执行）"""
+    api_key_id = g.api_key_info['id']
+
+    def settle(status):
+        if status != "ok":
+            refund_quota(db_connections.get(), api_key_id, day)
+
+    return settle_on_close(response, settle)
+
+
 # --- API Endpoints ---
 @app.route("/")
 def serve_index():
@@ -338,6 +917,10 @@ def save_settings():
         return jsonify({"error": "Invalid service name"}), 400
 
     db = get_db()
+    old_settings = db.execute(
+        "SELECT api_key, api_endpoint FROM api_settings WHERE user_id = ? AND service_name = ?",
+        (user_id, service_name),
+    ).fetchone()
     db.execute(
         """
         INSERT INTO api_settings (user_id, service_name, api_key, api_endpoint, model_name)
@@ -357,6 +940,13 @@ def save_settings():
     )
     db.commit()
 
+    # 凭据或端点变更后丢弃旧客户端及其连接池
+    if old_settings and (
+        old_settings["api_key"] != data.get("api_key")
+        or old_settings["api_endpoint"] != data.get("api_endpoint")
+    ):
+        provider_clients.invalidate(service_name, old_settings["api_key"])
+
     return jsonify({"message": f"{service_name.capitalize()} settings saved successfully"}), 200
 
 
@@ -373,411 +963,113 @@ def text_to_speech():
     if not all([text, service, voice]):
         return jsonify({"error": "Missing 'text', 'service', or 'voice' in request"}), 400
 
-    # --- OpenAI TTS Logic ---
-    if service.lower() == "openai":
+    service = service.lower()
+    if service not in ("openai", "gemini"):
+        return jsonify({"error": "Unsupported service"}), 400
+
+    db = get_db()
+    settings = db.execute(
+        "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
+        (user_id, service),
+    ).fetchone()
+
+    if not settings or not settings["api_key"]:
+        service_label = "OpenAI" if service == "openai" else "Gemini"
+        return jsonify({"error": f"{service_label} API key not set in settings."}), 400
+    set_metrics_labels(service, settings["model_name"])
+
+    # 相同参数的合成结果直接从缓存返回
+    if service == "openai":
+        cache_key = make_cache_key(
+            service, settings["model_name"], voice, "mp3", 1.0, text, settings["api_endpoint"], settings["api_key"]
+        )
+    else:
+        cache_key = make_cache_key(
+            service, settings["model_name"] or "gemini-2.5-flash-preview-tts", voice, "wav", 1.0, text,
+            settings["api_endpoint"], settings["api_key"]
+        )
+    entry = synthesis_cache.get(cache_key)
+    if entry is not None:
+        return cached_audio_response(entry)
+
+    # 超过服务商单次上限的文本自动切分并发合成
+    if len(text) > LONG_TEXT_CHUNK_CHARS[service]:
+        if len(text) > LONG_TEXT_MAX_CHARS:
+            return jsonify({"error": f"Text length exceeds {LONG_TEXT_MAX_CHARS} characters"}), 400
         try:
-            from openai import OpenAI
+            response = synthesize_long_text(service, settings, text, voice)
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.error("Long text synthesis failed", extra={"provider": service, "error": str(e)})
+            return jsonify({"error": f"Long text synthesis failed: {e}"}), 500
+        return cache_audio_response(cache_key, response)
 
-            db = get_db()
-            settings = db.execute(
-                "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
-                (user_id, "openai"),
-            ).fetchone()
+    # Gemini 流式模式：边生成边播放
+    if service == "gemini" and data.get("stream"):
+        try:
+            return set_audio_id(stream_gemini_tts(settings, text, voice, cache_key=cache_key), cache_key)
+        except admission.Overloaded:
+            raise
+        except Exception as e:
+            logger.error("Gemini streaming failed", extra={"error": str(e)})
+            return jsonify({"error": f"Gemini streaming failed: {e}"}), 500
+
+    return cache_audio_response(
+        cache_key,
+        timed_upstream(
+            service, settings["model_name"] or "", lambda: synthesize_web_tts(settings, text, service, voice),
+            settings["api_endpoint"], admit=not (service == "gemini" and settings["api_endpoint"])
+        ),
+    )
 
-            if not settings or not settings["api_key"]:
-                return jsonify({"error": "OpenAI API key not set in settings."}), 400
 
-            client = OpenAI(
-                api_key=settings["api_key"],
-                base_url=settings["api_endpoint"] if settings["api_endpoint"] else None,
-            )
+def synthesize_web_tts(settings, text, service, voice):
+    """网页端合成：调用对应服务商并返回音频响应"""
+    # --- OpenAI TTS Logic ---
+    if service == "openai":
+        try:
+            client, release = provider_clients.lease("openai", settings["api_key"], settings["api_endpoint"])
 
-            print(f"--- Calling OpenAI TTS ---")
-            print(f"Model: {settings['model_name']}, Voice: {voice}")
+            logger.debug("Calling OpenAI TTS", extra={"model": settings["model_name"], "voice": voice})
 
-            response = client.audio.speech.create(
-                model=settings["model_name"],
-                voice=voice,
-                input=text,
-                response_format="mp3",
-            )
-            return Response(response.iter_bytes(), mimetype="audio/mpeg")
+            try:
+                response = client.audio.speech.create(
+                    model=settings["model_name"],
+                    voice=voice,
+                    input=text,
+                    response_format="mp3",
+                )
+            except Exception:
+                release()
+                raise
+            return Response(release_after(response.iter_bytes(), release), mimetype="audio/mpeg")
 
         except Exception as e:
-            print(f"An OpenAI error occurred: {e}")
+            logger.error("OpenAI TTS request failed", extra={"error": str(e)})
             error_message = str(e)
             if "Incorrect API key" in error_message:
                 return jsonify({"error": "Authentication error: Incorrect OpenAI API key."}), 401
             return jsonify({"error": f"An unexpected OpenAI error occurred: {error_message}"}), 500
 
     # --- Gemini TTS Logic ---
-    elif service.lower() == "gemini":
+    elif service == "gemini":
         try:
             # 使用新的 google.genai 库，如官方示例所示
-            from google import genai
             from google.genai import types
             
-            db = get_db()
-            settings = db.execute(
-                "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
-                (user_id, "gemini"),
-            ).fetchone()
-            
-            if not settings or not settings["api_key"]:
-                return jsonify({"error": "Gemini API key not set in settings."}), 400
-            
-            model_name = settings["model_name"]
-            if not model_name:
-                # 使用官方推荐的TTS模型
-                model_name = "gemini-2.5-flash-preview-tts"
-            
-            print(f"--- Calling Gemini TTS ---")
-            print(f"Model: {model_name}, Voice: {voice}")
-            print(f"API Endpoint: {settings['api_endpoint'] if settings['api_endpoint'] else 'Default Google API'}")
-            
-            # 检查是否使用自定义API端点
-            if settings["api_endpoint"]:
-                print(f"Using custom API endpoint: {settings['api_endpoint']}")
-                
-                # 使用requests直接调用代理API
-                try:
-                    import requests
-                    import base64
-                    
-                    # 构建请求URL
-                    proxy_url = settings["api_endpoint"].rstrip('/')
-                    api_url = f"{proxy_url}/v1beta/models/{model_name}:generateContent"
-                    
-                    headers = {
-                        'Content-Type': 'application/json',
-                        'x-goog-api-key': settings["api_key"]
-                    }
-                    
-                    # 对于自定义端点，尝试多种兼容格式
-                    # 首先尝试标准格式
-                    payload = {
-                        "contents": [{"parts": [{"text": text}]}],
-                        "generationConfig": {
-                            "response_modalities": ["AUDIO"],
-                            "speech_config": {
-                                "voice_config": {
-                                    "prebuilt_voice_config": {
-                                        "voice_name": voice
-                                    }
-                                }
-                            }
-                        }
-                    }
-                    
-                    print(f"Sending request to proxy: {api_url}")
-                    print(f"Request payload: {payload}")
-                    
-                    response = requests.post(api_url, headers=headers, json=payload, timeout=30)
-                    
-                    # 如果请求失败，尝试使用端点期望的格式
-                    if response.status_code in [400, 500]:
-                        print("First request failed, trying endpoint-specific format...")
-                        
-                        # 尝试使用该端点可能期望的格式
-                        alternative_payload = {
-                            "contents": [{"parts": [{"text": text}]}],
-                            "generationConfig": {
-                                "responseModalities": ["AUDIO"],  # 使用 responseModalities 而不是 response_modalities
-                                "candidateCount": 1,
-                                "topK": 40,
-                                "topP": 0.9,
-                                "temperature": 0.7
-                            }
-                        }
-                        
-                        print(f"Alternative payload: {alternative_payload}")
-                        response = requests.post(api_url, headers=headers, json=alternative_payload, timeout=30)
-                        
-                    # 如果还是失败，尝试最简化格式
-                    if response.status_code in [400, 500]:
-                        print("Second request failed, trying minimal format...")
-                        minimal_payload = {
-                            "contents": [{"parts": [{"text": text}]}],
-                            "generationConfig": {
-                                "responseModalities": ["AUDIO"]
-                            }
-                        }
-                        print(f"Minimal payload: {minimal_payload}")
-                        response = requests.post(api_url, headers=headers, json=minimal_payload, timeout=30)
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        print(f"Response received: {result}")
-                        
-                        # 提取音频数据
-                        candidate = result['candidates'][0]
-                        part = candidate['content']['parts'][0]
-                        
-                        # 检查是否有传统的inlineData格式
-                        if 'inlineData' in part:
-                            audio_data = part['inlineData']['data']
-                            decoded_audio = base64.b64decode(audio_data)
-                            
-                            print(f"Successfully received audio via proxy: {len(decoded_audio)} bytes")
-                            
-                            # 检测和处理音频格式
-                            if decoded_audio.startswith(b'RIFF'):
-                                mimetype = "audio/wav"
-                            elif decoded_audio.startswith(b'\xff\xfb') or decoded_audio.startswith(b'\xff\xfa'):
-                                mimetype = "audio/mpeg"
-                            elif decoded_audio.startswith(b'ID3'):
-                                mimetype = "audio/mpeg"
-                            elif decoded_audio.startswith(b'OggS'):
-                                mimetype = "audio/ogg"
-                            else:
-                                # 为原始PCM数据添加WAV头部
-                                def create_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-                                    import struct
-                                    chunk_size = 36 + len(pcm_data)
-                                    subchunk2_size = len(pcm_data)
-                                    byte_rate = sample_rate * channels * bits_per_sample // 8
-                                    block_align = channels * bits_per_sample // 8
-                                    
-                                    wav_header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                                        b'RIFF', chunk_size, b'WAVE', b'fmt ', 16, 1,
-                                        channels, sample_rate, byte_rate, block_align,
-                                        bits_per_sample, b'data', subchunk2_size
-                                    )
-                                    return wav_header
-                                
-                                wav_header = create_wav_header(decoded_audio)
-                                decoded_audio = wav_header + decoded_audio
-                                mimetype = "audio/wav"
-                            
-                            return Response(decoded_audio, mimetype=mimetype)
-                        
-                        # 检查是否有文本内容包含图片链接（特殊端点的格式）
-                        elif 'text' in part and '![image](' in part['text']:
-                            import re
-                            # 提取图片URL
-                            url_match = re.search(r'!\[image\]\((https?://[^\)]+)\)', part['text'])
-                            if url_match:
-                                audio_url = url_match.group(1)
-                                print(f"Found audio file URL: {audio_url}")
-                                
-                                # 下载音频文件
-                                audio_response = requests.get(audio_url, timeout=30)
-                                if audio_response.status_code == 200:
-                                    audio_data = audio_response.content
-                                    print(f"Successfully downloaded audio: {len(audio_data)} bytes")
-                                    
-                                    # 临时保存文件用于调试
-                                    import tempfile
-                                    import os
-                                    temp_file = os.path.join(tempfile.gettempdir(), f"debug_audio_{hash(audio_url) % 10000}.bin")
-                                    with open(temp_file, 'wb') as f:
-                                        f.write(audio_data)
-                                    print(f"Debug: Audio saved to {temp_file}")
-                                    
-                                    # 检查文件的实际格式（通过文件头）
-                                    if audio_data.startswith(b'RIFF') and b'WAVE' in audio_data[:12]:
-                                        mimetype = "audio/wav"
-                                        print("Detected WAV format")
-                                    elif audio_data.startswith(b'\xff\xfb') or audio_data.startswith(b'\xff\xfa') or audio_data.startswith(b'ID3'):
-                                        mimetype = "audio/mpeg"
-                                        print("Detected MP3 format")
-                                    elif audio_data.startswith(b'OggS'):
-                                        mimetype = "audio/ogg"
-                                        print("Detected OGG format")
-                                    elif audio_data.startswith(b'fLaC'):
-                                        mimetype = "audio/flac"
-                                        print("Detected FLAC format")
-                                    elif audio_data.startswith(b'\x00\x00\x00\x20ftypM4A') or audio_data.startswith(b'\x00\x00\x00\x18ftypM4A'):
-                                        mimetype = "audio/mp4"
-                                        print("Detected M4A format")
-                                    else:
-                                        # 打印文件头以便调试
-                                        file_header = audio_data[:16].hex() if len(audio_data) >= 16 else audio_data.hex()
-                                        print(f"Unknown audio format, file header: {file_header}")
-                                        
-                                        # 尝试检测是否为原始PCM数据
-                                        # PCM数据通常以小的数值开始，并且具有规律性
-                                        if len(audio_data) > 1000:  # 确保有足够的数据
-                                            # 检查是否看起来像16位PCM数据
-                                            samples = []
-                                            for i in range(0, min(20, len(audio_data)-1), 2):
-                                                sample = int.from_bytes(audio_data[i:i+2], 'little', signed=True)
-                                                samples.append(sample)
-                                            
-                                            # 检查样本值是否在合理的音频范围内（-32768到32767）
-                                            valid_samples = sum(1 for s in samples if -32768 <= s <= 32767)
-                                            if valid_samples >= 8:  # 大部分样本都在合理范围内
-                                                print("Detected raw PCM audio data, adding WAV header...")
-                                                
-                                                # 为原始PCM数据创建WAV文件头部
-                                                def create_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-                                                    import struct
-                                                    
-                                                    # WAV文件头部结构
-                                                    chunk_size = 36 + len(pcm_data)
-                                                    subchunk2_size = len(pcm_data)
-                                                    byte_rate = sample_rate * channels * bits_per_sample // 8
-                                                    block_align = channels * bits_per_sample // 8
-                                                    
-                                                    wav_header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                                                        b'RIFF',           # ChunkID
-                                                        chunk_size,        # ChunkSize
-                                                        b'WAVE',           # Format
-                                                        b'fmt ',           # Subchunk1ID
-                                                        16,                # Subchunk1Size (PCM)
-                                                        1,                 # AudioFormat (PCM)
-                                                        channels,          # NumChannels
-                                                        sample_rate,       # SampleRate
-                                                        byte_rate,         # ByteRate
-                                                        block_align,       # BlockAlign
-                                                        bits_per_sample,   # BitsPerSample
-                                                        b'data',           # Subchunk2ID
-                                                        subchunk2_size     # Subchunk2Size
-                                                    )
-                                                    
-                                                    return wav_header + pcm_data
-                                                
-                                                # 创建完整的WAV文件
-                                                audio_data = create_wav_header(audio_data)
-                                                mimetype = "audio/wav"
-                                                print(f"Created WAV file with header, total size: {len(audio_data)} bytes")
-                                            else:
-                                                print("Data doesn't appear to be PCM audio")
-                                                mimetype = "audio/wav"  # 默认尝试
-                                        else:
-                                            # 文件太小，默认尝试WAV
-                                            mimetype = "audio/wav"
-                                        
-                                        print(f"Using final mimetype: {mimetype}")
-                                    
-                                    return Response(audio_data, mimetype=mimetype)
-                                else:
-                                    raise Exception(f"Failed to download audio from {audio_url}")
-                            else:
-                                raise Exception("No audio URL found in response text")
-                        else:
-                            raise Exception("No audio data found in proxy response")
-                    else:
-                        print(f"Proxy request failed: {response.status_code} - {response.text}")
-                        try:
-                            error_detail = response.json()
-                            print(f"Error details: {error_detail}")
-                        except:
-                            print("Could not parse error response as JSON")
-                        raise Exception(f"Proxy request failed with status {response.status_code}: {response.text[:500]}")
-                        
-                except Exception as proxy_error:
-                    print(f"Proxy request failed: {proxy_error}")
-                    print("Falling back to direct API call...")
-            
-            # 使用默认的Google API端点（回退选项）
-            print("Using direct Google API")
-            client = genai.Client(api_key=settings["api_key"])
-            
-            # 根据官方示例配置TTS参数
-            response = client.models.generate_content(
-                model=model_name,
-                contents=text,
-                config=types.GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=types.SpeechConfig(
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name=voice,
-                            )
-                        )
-                    ),
-                )
-            )
+            model_name = gemini_model_name(settings)
             
-            # 提取音频数据
-            candidate = response.candidates[0]
-            part = candidate.content.parts[0]
-            
-            # 检查是否有inline_data
-            if hasattr(part, 'inline_data'):
-                inline_data = part.inline_data
-                
-                if hasattr(inline_data, 'data'):
-                    audio_data = inline_data.data
-                    
-                    if audio_data:
-                        # 检查是否已经是字节数据
-                        if isinstance(audio_data, bytes):
-                            decoded_audio = audio_data
-                        else:
-                            # 尝试base64解码
-                            import base64
-                            try:
-                                decoded_audio = base64.b64decode(audio_data)
-                            except Exception:
-                                # 如果解码失败，尝试直接使用数据
-                                decoded_audio = audio_data.encode() if isinstance(audio_data, str) else audio_data
-                    else:
-                        raise Exception("No audio data found in inline_data.data")
-                else:
-                    raise Exception("No 'data' attribute found in inline_data")
-            else:
-                raise Exception("No 'inline_data' found in response part")
+            # 配置了自定义端点时按对冲策略在代理和官方 API 之间取先成功的结果
+            decoded_audio = gemini_tts_audio(settings, text, voice, model_name)
             
             if not decoded_audio or len(decoded_audio) < 100:  # 音频文件至少应该有100字节
                 raise Exception(f"Audio data too small or empty: {len(decoded_audio) if decoded_audio else 0} bytes")
             
-            # 根据数据头部判断格式
-            if decoded_audio.startswith(b'RIFF'):
-                mimetype = "audio/wav"
-            elif decoded_audio.startswith(b'\xff\xfb') or decoded_audio.startswith(b'\xff\xfa'):
-                mimetype = "audio/mpeg"
-            elif decoded_audio.startswith(b'ID3'):
-                mimetype = "audio/mpeg"
-            elif decoded_audio.startswith(b'OggS'):
-                mimetype = "audio/ogg"
-            else:
-                # Gemini可能返回原始PCM数据，添加WAV头部
-                mimetype = "audio/wav"
-                
-                # 为原始PCM数据创建WAV文件头部
-                def create_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-                    """为原始PCM数据创建WAV文件头部"""
-                    import struct
-                    
-                    # WAV文件头部结构
-                    chunk_size = 36 + len(pcm_data)
-                    subchunk2_size = len(pcm_data)
-                    byte_rate = sample_rate * channels * bits_per_sample // 8
-                    block_align = channels * bits_per_sample // 8
-                    
-                    wav_header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                        b'RIFF',           # ChunkID
-                        chunk_size,        # ChunkSize
-                        b'WAVE',           # Format
-                        b'fmt ',           # Subchunk1ID
-                        16,                # Subchunk1Size (PCM)
-                        1,                 # AudioFormat (PCM)
-                        channels,          # NumChannels
-                        sample_rate,       # SampleRate
-                        byte_rate,         # ByteRate
-                        block_align,       # BlockAlign
-                        bits_per_sample,   # BitsPerSample
-                        b'data',           # Subchunk2ID
-                        subchunk2_size     # Subchunk2Size
-                    )
-                    
-                    return wav_header + pcm_data
-                
-                # 尝试创建完整的WAV文件
-                try:
-                    decoded_audio = create_wav_header(decoded_audio)
-                except Exception:
-                    # 如果失败，继续使用原始数据
-                    pass
-            
             # 创建响应并添加适当的头部
-            response_obj = Response(decoded_audio, mimetype=mimetype)
+            response_obj = build_audio_response(decoded_audio)
             response_obj.headers['Content-Disposition'] = 'inline; filename="tts_audio.wav"'
             response_obj.headers['Cache-Control'] = 'no-cache'
-            response_obj.headers['Accept-Ranges'] = 'bytes'
-            response_obj.headers['Content-Length'] = str(len(decoded_audio))
             
             return response_obj
             
@@ -790,7 +1082,7 @@ def text_to_speech():
             
         except AttributeError as e:
             error_str = str(e)
-            print(f"A critical attribute error occurred: {error_str}")
+            logger.error("google-genai attribute error", extra={"error": error_str})
             error_msg = (
                 "The 'google-genai' library appears to be outdated or incompatible. "
                 "Please update to the latest version: 'pip install google-genai'"
@@ -798,7 +1090,7 @@ def text_to_speech():
             return jsonify({"error": error_msg}), 500
             
         except Exception as e:
-            print(f"A Gemini error occurred: {e}")
+            logger.error("Gemini TTS request failed", extra={"error": str(e)})
             error_message = str(e)
             
             if "API key not valid" in error_message or "401" in error_message:
@@ -812,6 +1104,13 @@ def text_to_speech():
     else:
         return jsonify({"error": "Unsupported service"}), 400
 
+@app.route("/api/audio/<audio_id>", methods=["GET"])
+@login_required
+def get_stored_audio(audio_id):
+    """网页播放器通过稳定 URL 播放已合成的音频，拖动进度和断点续传只读取已保存的字节"""
+    return stored_audio_response(audio_id)
+
+
 # --- Account Management ---
 @app.route("/api/account", methods=["GET"])
 @login_required
@@ -892,9 +1191,10 @@ def update_account():
 def get_api_keys():
     """获取用户的API密钥列表"""
     user_id = session["user_id"]
+    last_used_tracker.flush()
     db = get_db()
     keys = db.execute(
-        "SELECT id, key_name, api_key, is_active, daily_limit, provider_permissions, created_at, last_used_at FROM api_keys WHERE user_id = ? ORDER BY created_at DESC",
+        "SELECT id, key_name, api_key, is_active, daily_limit, rps_limit, burst_limit, concurrency_limit, provider_permissions, created_at, last_used_at FROM api_keys WHERE user_id = ? ORDER BY created_at DESC",
         (user_id,)
     ).fetchall()
     
@@ -908,6 +1208,9 @@ def get_api_keys():
             'api_key_masked': masked_key,
             'is_active': bool(key['is_active']),
             'daily_limit': key['daily_limit'],
+            'rps_limit': key['rps_limit'],
+            'burst_limit': key['burst_limit'],
+            'concurrency_limit': key['concurrency_limit'],
             'provider_permissions': json.loads(key['provider_permissions']),
             'created_at': key['created_at'],
             'last_used_at': key['last_used_at']
@@ -937,16 +1240,23 @@ def create_api_key():
         if provider not in valid_providers:
             return jsonify({"error": f"Invalid provider: {provider}"}), 400
     
+    limits, error = parse_key_limits(data)
+    if error:
+        return error
+    
     user_id = session["user_id"]
     new_api_key = generate_api_key()
     
     db = get_db()
     try:
         db.execute("""
-            INSERT INTO api_keys (user_id, key_name, api_key, daily_limit, provider_permissions)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, key_name, new_api_key, daily_limit, json.dumps(provider_permissions)))
+            INSERT INTO api_keys (user_id, key_name, api_key, daily_limit, provider_permissions,
+                                  rps_limit, burst_limit, concurrency_limit)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, key_name, new_api_key, daily_limit, json.dumps(provider_permissions),
+              limits["rps_limit"], limits["burst_limit"], limits["concurrency_limit"]))
         db.commit()
+        api_key_cache.invalidate()
         
         return jsonify({
             "message": "API key created successfully",
@@ -975,6 +1285,7 @@ def delete_api_key(key_id):
     
     db.execute("DELETE FROM api_keys WHERE id = ?", (key_id,))
     db.commit()
+    api_key_cache.invalidate(key_id)
     
     return jsonify({"message": "API key deleted successfully"})
 
@@ -998,6 +1309,7 @@ def toggle_api_key(key_id):
     new_status = not bool(key_info['is_active'])
     db.execute("UPDATE api_keys SET is_active = ? WHERE id = ?", (new_status, key_id))
     db.commit()
+    api_key_cache.invalidate(key_id)
     
     return jsonify({
         "message": f"API key {'enabled' if new_status else 'disabled'} successfully",
@@ -1005,452 +1317,837 @@ def toggle_api_key(key_id):
     })
 
 
+@app.route("/api/keys/<int:key_id>/limits", methods=["PUT"])
+@login_required
+def update_api_key_limits(key_id):
+    """修改API密钥的速率和并发上限，未提供的字段保持不变"""
+    user_id = session["user_id"]
+    db = get_db()
+    
+    key_info = db.execute(
+        "SELECT id, rps_limit, burst_limit, concurrency_limit FROM api_keys WHERE id = ? AND user_id = ?",
+        (key_id, user_id)
+    ).fetchone()
+    
+    if not key_info:
+        return jsonify({"error": "API key not found"}), 404
+    
+    limits, error = parse_key_limits(request.get_json(silent=True) or {}, dict(key_info))
+    if error:
+        return error
+    
+    db.execute(
+        "UPDATE api_keys SET rps_limit = ?, burst_limit = ?, concurrency_limit = ? WHERE id = ?",
+        (limits["rps_limit"], limits["burst_limit"], limits["concurrency_limit"], key_id)
+    )
+    db.commit()
+    api_key_cache.invalidate(key_id)
+    
+    return jsonify({"message": "API key limits updated successfully", **limits})
+
+
 # --- Open API Endpoints ---
 @app.route("/api/v1/tts/synthesize", methods=["POST"])
 @api_key_required
+@daily_quota_required
 def api_text_to_speech():
     """开放的TTS API端点"""
+    data = request.get_json(silent=True)
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "JSON body required"}), 400
-        
-        text = data.get("text", "").strip()
-        provider = data.get("provider", "openai").lower()
-        voice = data.get("voice", "alloy")
-        model = data.get("model")
-        format = data.get("format", "mp3").lower()
-        speed = data.get("speed", 1.0)
-        
-        # 参数验证
-        if not text:
-            return jsonify({"error": "Text is required"}), 400
-        
-        if len(text) > 4000:
-            return jsonify({"error": "Text length exceeds 4000 characters"}), 400
-        
-        # 检查服务商权限
-        api_key_info = g.api_key_info
-        provider_permissions = json.loads(api_key_info['provider_permissions'])
-        if provider not in provider_permissions:
-            return jsonify({
-                "error": f"Provider '{provider}' not allowed for this API key",
-                "allowed_providers": provider_permissions
-            }), 403
-        
-        # 获取用户配置
-        db = get_db()
-        settings = db.execute(
-            "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
-            (api_key_info['user_id'], provider)
-        ).fetchone()
-        
-        if not settings or not settings["api_key"]:
-            return jsonify({
-                "error": f"{provider.upper()} API configuration not found",
-                "message": f"Please configure {provider.upper()} settings in the web interface first"
-            }), 400
-        
+        plan, error = plan_api_synthesis(data, g.api_key_info)
+        if error:
+            return error
+        return finish_api_synthesis(plan, run_api_synthesis(plan))
+    except Exception as e:
+        return api_synthesis_error(data, g.api_key_info, e)
+
+
+def plan_api_synthesis(data, api_key_info):
+    """开放API合成的准备阶段：校验参数和权限、读取服务商配置、查合成缓存
+
+    返回 (plan, None) 或 (None, 错误响应)；plan 为 dict，供调用上游和收尾阶段使用。
+    """
+    if not data:
+        return None, (jsonify({"error": "JSON body required"}), 400)
+    
+    text = data.get("text", "").strip()
+    provider = data.get("provider", "openai").lower()
+    voice = data.get("voice", "alloy")
+    model = data.get("model")
+    format = data.get("format", "mp3").lower()
+    speed = data.get("speed", 1.0)
+    long_text_mode = bool(data.get("long_text", False))
+    stream = bool(data.get("stream", False))
+    return_base64 = bool(data.get("return_base64", False))
+    
+    # 参数验证
+    if not text:
+        return None, (jsonify({"error": "Text is required"}), 400)
+    
+    if long_text_mode:
+        if len(text) > LONG_TEXT_MAX_CHARS:
+            return None, (jsonify({"error": f"Text length exceeds {LONG_TEXT_MAX_CHARS} characters"}), 400)
+    elif len(text) > 4000:
+        return None, (jsonify({
+            "error": "Text length exceeds 4000 characters",
+            "message": "Set long_text=true to synthesize longer text in chunks"
+        }), 400)
+    
+    # 检查服务商权限
+    provider_permissions = json.loads(api_key_info['provider_permissions'])
+    if provider not in provider_permissions:
+        return None, (jsonify({
+            "error": f"Provider '{provider}' not allowed for this API key",
+            "allowed_providers": provider_permissions
+        }), 403)
+    
+    # 获取用户配置
+    db = get_db()
+    settings = db.execute(
+        "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
+        (api_key_info['user_id'], provider)
+    ).fetchone()
+    
+    if not settings or not settings["api_key"]:
+        return None, (jsonify({
+            "error": f"{provider.upper()} API configuration not found",
+            "message": f"Please configure {provider.upper()} settings in the web interface first"
+        }), 400)
+    
+    if provider not in ("openai", "gemini"):
+        return None, (jsonify({"error": f"Unsupported provider: {provider}"}), 400)
+    set_metrics_labels(provider, model or settings["model_name"])
+    
+    # 长文本模式下超过单次上限才需要切分；切分后的音频需能免重编码拼接
+    chunked = long_text_mode and len(text) > LONG_TEXT_CHUNK_CHARS[provider]
+    if chunked and provider == "openai" and format not in long_text.JOINABLE_FORMATS:
+        return None, (jsonify({
+            "error": f"Format '{format}' is not supported in long text mode",
+            "supported_formats": list(long_text.JOINABLE_FORMATS)
+        }), 400)
+    
+    # Gemini 流式模式（长文本切分和 base64 返回需要完整音频，不走流式）
+    streaming = provider == "gemini" and stream and not chunked and not return_base64
+    stream_container = "pcm" if streaming and format == "pcm" else "wav"
+    # Gemini 请求 mp3/opus/aac/flac 时先得到 WAV（源），再在本地转码
+    transcode_format = gemini_transcode_format(provider, format)
+    
+    # 先查合成缓存（转码结果和源 WAV 分别缓存）
+    cache_key = api_cache_key(
+        provider, settings, text, voice, model, format, speed, transcode_format or stream_container
+    )
+    entry = synthesis_cache.get(cache_key)
+    source_key = cache_key
+    source_entry = None
+    if entry is None and transcode_format:
+        source_key = api_cache_key(provider, settings, text, voice, model, format, speed, stream_container)
+        source_entry = synthesis_cache.get(source_key)
+    
+    return {
+        "provider": provider,
+        "settings": dict(settings),
+        "api_key_id": api_key_info['id'],
+        "text": text,
+        "voice": voice,
+        "model": model,
+        "format": format,
+        "speed": speed,
+        "return_base64": return_base64,
+        "chunked": chunked,
+        "streaming": streaming,
+        "stream_container": stream_container,
+        "transcode_format": transcode_format,
+        "cache_key": cache_key,
+        "source_key": source_key,
+        "entry": entry,
+        "source_entry": source_entry,
         # 记录开始时间用于计算音频时长
-        start_time = datetime.now()
-        
-        # 调用相应的TTS服务
-        if provider == "openai":
-            audio_response = call_openai_tts(settings, text, voice, model, format, speed)
-        elif provider == "gemini":
-            audio_response = call_gemini_tts(settings, text, voice, model)
-        else:
-            return jsonify({"error": f"Unsupported provider: {provider}"}), 400
-        
-        # 计算处理时间（近似音频时长）
-        processing_time = (datetime.now() - start_time).total_seconds()
-        
-        # 记录API使用情况
+        "start_time": datetime.now(),
+    }, None
+
+
+def needs_upstream_call(plan):
+    """是否需要普通的（非流式、非长文本切分）上游请求；ASGI 模式下这类请求以异步方式调用上游"""
+    return plan["entry"] is None and plan["source_entry"] is None and not plan["streaming"] and not plan["chunked"]
+
+
+def run_api_synthesis(plan):
+    """调用相应的TTS服务（缓存命中时直接返回缓存），返回源音频响应"""
+    provider, settings = plan["provider"], plan["settings"]
+    text, voice, model, format, speed = plan["text"], plan["voice"], plan["model"], plan["format"], plan["speed"]
+    if plan["entry"] is not None:
+        return cached_audio_response(plan["entry"])
+    if plan["source_entry"] is not None:
+        return cached_audio_response(plan["source_entry"])
+    if plan["streaming"]:
+        return set_audio_id(
+            stream_gemini_tts(settings, text, voice, model, plan["stream_container"], plan["source_key"]),
+            plan["source_key"]
+        )
+    if plan["chunked"]:
+        return cache_audio_response(
+            plan["source_key"], synthesize_long_text(provider, settings, text, voice, model, format, speed)
+        )
+    if provider == "openai":
+        return cache_audio_response(plan["source_key"], call_openai_tts(settings, text, voice, model, format, speed))
+    return cache_audio_response(plan["source_key"], call_gemini_tts(settings, text, voice, model))
+
+
+# 音频未完整发送时记录在用量中的错误信息
+STREAM_FAILURES = {
+    "error": "Audio stream failed before completion",
+    "cancelled": "Client disconnected before audio was fully sent",
+}
+
+
+def finish_api_synthesis(plan, audio_response):
+    """收尾阶段：按需转码、记录用量，按请求返回音频流或流式 base64 JSON"""
+    provider, settings, entry = plan["provider"], plan["settings"], plan["entry"]
+    if entry is None and plan["transcode_format"]:
+        audio_response = transcode_audio_response(plan["cache_key"], audio_response, plan["transcode_format"])
+    
+    # 计算处理时间（近似音频时长）
+    processing_time = (datetime.now() - plan["start_time"]).total_seconds()
+    
+    def settle(status):
+        # 音频完整发送后才记为成功（缓存命中同样计入用量）；出错或客户端提前断开时记为失败
         log_api_usage(
-            api_key_info['id'], 
-            provider, 
-            model or settings["model_name"],
-            voice, 
-            len(text),
+            plan["api_key_id"],
+            provider,
+            plan["model"] or settings["model_name"],
+            plan["voice"],
+            len(plan["text"]),
             processing_time,
-            True
+            status == "ok",
+            None if status == "ok" else STREAM_FAILURES[status],
+            cached=entry is not None
         )
-        
-        # 如果需要返回base64编码
-        if data.get("return_base64", False):
-            if hasattr(audio_response, 'data'):
-                audio_data = audio_response.data
+    
+    if not plan["return_base64"]:
+        # 返回音频流
+        return settle_on_close(audio_response, settle)
+    
+    # 需要返回base64编码：音频边到达边编码输出，不在内存中保留完整音频
+    def result_fields():
+        return {
+            "format": plan["format"],
+            "provider": provider,
+            "model": plan["model"] or settings["model_name"],
+            "voice": plan["voice"],
+            "text_length": len(plan["text"]),
+            "processing_time": (datetime.now() - plan["start_time"]).total_seconds(),
+            "cached": entry is not None
+        }, {
+            "characters": len(plan["text"]),
+            "provider": provider
+        }
+
+    response = Response(iter_base64_json(audio_response.response, result_fields), mimetype="application/json")
+    response.call_on_close(audio_response.close)
+    return settle_on_close(response, settle)
+
+
+def api_synthesis_error(data, api_key_info, error):
+    """记录失败的用量并返回 500；上游满载被拒绝时返回 503（不计入用量）"""
+    if isinstance(error, admission.Overloaded):
+        return overloaded_response(error)
+    data = data or {}
+    log_api_usage(
+        api_key_info['id'],
+        data.get('provider', 'unknown'),
+        data.get('model', 'unknown'),
+        data.get('voice', 'unknown'),
+        len(data.get('text', '')),
+        None,
+        False,
+        str(error)
+    )
+    return jsonify({
+        "error": "Internal server error",
+        "message": str(error)
+    }), 500
+
+
+def api_cache_key(provider, settings, text, voice, model=None, format="mp3", speed=1.0, gemini_format="wav"):
+    """开放API的缓存键；Gemini 统一输出 WAV（流式裸 PCM 除外），因此缓存键中的格式固定"""
+    if provider == "openai":
+        return make_cache_key(
+            provider, model or settings["model_name"], voice, format, speed, text,
+            settings["api_endpoint"], settings["api_key"]
+        )
+    return make_cache_key(
+        provider, model or settings["model_name"] or "gemini-2.5-flash-preview-tts", voice,
+        gemini_format, 1.0, text, settings["api_endpoint"], settings["api_key"]
+    )
+
+
+@app.route("/api/v1/tts/batch", methods=["POST"])
+@api_key_required
+def api_batch_synthesize():
+    """批量合成：一次认证和额度预占，条目并发合成，按完成顺序流式返回结果"""
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get("items"), list) or not data["items"]:
+        return jsonify({"error": "'items' must be a non-empty list"}), 400
+    items = data["items"]
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items, maximum is {BATCH_MAX_ITEMS}"}), 400
+    output = data.get("output", "json").lower()
+    if output not in batch.OUTPUT_FORMATS:
+        return jsonify({
+            "error": f"Unsupported output '{output}'",
+            "supported_outputs": list(batch.OUTPUT_FORMATS)
+        }), 400
+
+    api_key_info = g.api_key_info
+    provider_permissions = json.loads(api_key_info['provider_permissions'])
+    db = get_db()
+
+    # 逐条校验，无效条目直接记为失败，不占用额度
+    settings_by_provider = {}
+    jobs = []
+    invalid = []
+    for index, raw in enumerate(items):
+        if not isinstance(raw, dict):
+            invalid.append({"index": index, "id": None, "success": False, "error": "Item must be an object"})
+            continue
+        item = {
+            "index": index,
+            "id": raw.get("id"),
+            "text": (raw.get("text") or "").strip(),
+            "provider": (raw.get("provider") or data.get("provider") or "openai").lower(),
+            "voice": raw.get("voice") or data.get("voice") or "alloy",
+            "model": raw.get("model") or data.get("model"),
+            "format": (raw.get("format") or data.get("format") or "mp3").lower(),
+            "speed": raw.get("speed") or data.get("speed") or 1.0,
+        }
+        error = None
+        if not item["text"]:
+            error = "Text is required"
+        elif len(item["text"]) > 4000:
+            error = "Text length exceeds 4000 characters"
+        elif item["provider"] not in ("openai", "gemini"):
+            error = f"Unsupported provider: {item['provider']}"
+        elif item["provider"] not in provider_permissions:
+            error = f"Provider '{item['provider']}' not allowed for this API key"
+        else:
+            if item["provider"] not in settings_by_provider:
+                settings_by_provider[item["provider"]] = db.execute(
+                    "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
+                    (api_key_info['user_id'], item["provider"])
+                ).fetchone()
+            settings = settings_by_provider[item["provider"]]
+            if not settings or not settings["api_key"]:
+                error = f"{item['provider'].upper()} API configuration not found"
             else:
-                audio_data = audio_response.get_data()
-            
-            encoded_audio = base64.b64encode(audio_data).decode('utf-8')
-            
-            return jsonify({
-                "success": True,
-                "data": {
-                    "audio_base64": encoded_audio,
-                    "format": format,
-                    "provider": provider,
-                    "model": model or settings["model_name"],
-                    "voice": voice,
-                    "text_length": len(text),
-                    "processing_time": processing_time
-                },
-                "usage": {
-                    "characters": len(text),
-                    "provider": provider
-                }
-            })
+                item["settings"] = settings
+        if error:
+            invalid.append({"index": index, "id": item["id"], "success": False, "error": error})
         else:
-            # 返回音频流
-            return audio_response
-            
+            jobs.append((index, item["provider"], item))
+
+    # 一次性原子预占所有有效条目的额度
+    day = quota.today()
+    if jobs:
+        reserved, used_today = reserve_quota(db, api_key_info, day, amount=len(jobs))
+        if not reserved:
+            return jsonify({
+                "error": "Daily API limit exceeded",
+                "limit": api_key_info['daily_limit'],
+                "used": used_today,
+                "requested": len(jobs)
+            }), 429
+
+    summary = {"total": len(items), "succeeded": 0, "failed": 0, "cached": 0}
+    items_by_index = {index: item for index, _, item in jobs}
+
+    def iter_results():
+        started = datetime.now()
+        try:
+            for result in invalid:
+                summary["failed"] += 1
+                yield result
+            for index, outcome, error in batch_runner.run(jobs, queue_timed("batch", synthesize_item)):
+                item = items_by_index[index]
+                settings = item["settings"]
+                model_name = item["model"] or settings["model_name"]
+                result = {"index": index, "id": item["id"], "provider": item["provider"], "voice": item["voice"]}
+                if error is not None:
+                    summary["failed"] += 1
+                    log_api_usage(
+                        api_key_info['id'], item["provider"], model_name, item["voice"],
+                        len(item["text"]), None, False, str(error)
+                    )
+                    result.update(success=False, error=str(error))
+                else:
+                    mimetype, audio, cached, elapsed = outcome
+                    summary["succeeded"] += 1
+                    summary["cached"] += int(cached)
+                    log_api_usage(
+                        api_key_info['id'], item["provider"], model_name, item["voice"],
+                        len(item["text"]), elapsed, True, cached=cached
+                    )
+                    result.update(
+                        success=True, mimetype=mimetype, cached=cached,
+                        text_length=len(item["text"]), audio=audio
+                    )
+                yield result
+        finally:
+            # 失败或因客户端断开未完成的条目退还额度
+            unused = len(jobs) - summary["succeeded"]
+            if unused > 0:
+                refund_quota(db_connections.get(), api_key_info['id'], day, amount=unused)
+            summary["elapsed"] = round((datetime.now() - started).total_seconds(), 3)
+
+    headers = {"X-Batch-Items": str(len(items))}
+    if output == "zip":
+        return Response(
+            batch.iter_zip(iter_results(), summary), mimetype="application/zip",
+            headers=dict(headers, **{"Content-Disposition": 'attachment; filename="tts-batch.zip"'})
+        )
+    if output == "multipart":
+        boundary = batch.multipart_boundary()
+        return Response(
+            batch.iter_multipart(iter_results(), summary, boundary),
+            mimetype=f"multipart/mixed; boundary={boundary}", headers=headers
+        )
+    return Response(batch.iter_json(iter_results(), summary), mimetype="application/json", headers=headers)
+
+
+def synthesize_item(item):
+    """合成单个条目（批量合成、异步任务）：先查缓存，未命中时调用上游并写入缓存
+
+    返回 (mimetype, 音频字节, 是否命中缓存, 耗时秒数)。
+    """
+    settings = item["settings"]
+    transcode_format = gemini_transcode_format(item["provider"], item["format"])
+    cache_key = api_cache_key(
+        item["provider"], settings, item["text"], item["voice"], item["model"], item["format"], item["speed"],
+        transcode_format or "wav"
+    )
+    entry = synthesis_cache.get(cache_key)
+    if entry is not None:
+        return entry.mimetype, b"".join(entry.chunks), True, 0.0
+    started = datetime.now()
+    source_key = cache_key
+    source_entry = None
+    if transcode_format:
+        source_key = api_cache_key(
+            item["provider"], settings, item["text"], item["voice"], item["model"], item["format"], item["speed"]
+        )
+        source_entry = synthesis_cache.get(source_key)
+    if source_entry is not None:
+        response = cached_audio_response(source_entry)
+    elif item.get("long_text") and len(item["text"]) > LONG_TEXT_CHUNK_CHARS[item["provider"]]:
+        response = synthesize_long_text(
+            item["provider"], settings, item["text"], item["voice"], item["model"], item["format"], item["speed"]
+        )
+    elif item["provider"] == "openai":
+        response = call_openai_tts(
+            settings, item["text"], item["voice"], item["model"], item["format"], item["speed"]
+        )
+    else:
+        response = call_gemini_tts(settings, item["text"], item["voice"], item["model"])
+    if source_entry is None:
+        response = cache_audio_response(source_key, response)
+    if transcode_format:
+        response = transcode_audio_response(cache_key, response, transcode_format)
+    audio = response.get_data()
+    return response.mimetype, audio, False, (datetime.now() - started).total_seconds()
+
+
+@app.route("/api/v1/audio/<audio_id>", methods=["GET"])
+@api_key_required
+def api_get_stored_audio(audio_id):
+    """按合成响应中的 X-TTS-Audio-Id 读取已保存的音频（支持 Range 请求，不重新合成、不计额度）"""
+    return stored_audio_response(audio_id)
+
+
+@app.route("/api/v1/tts/jobs", methods=["POST"])
+@api_key_required
+@daily_quota_required
+def api_create_job():
+    """提交异步合成任务：立即返回任务ID，由后台工作线程执行"""
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "JSON body required"}), 400
+    
+    text = (data.get("text") or "").strip()
+    provider = (data.get("provider") or "openai").lower()
+    long_text_mode = bool(data.get("long_text", False))
+    job_request = {
+        "user_id": g.api_key_info['user_id'],
+        "text": text,
+        "provider": provider,
+        "voice": data.get("voice") or "alloy",
+        "model": data.get("model"),
+        "format": (data.get("format") or "mp3").lower(),
+        "speed": data.get("speed") or 1.0,
+        "long_text": long_text_mode,
+    }
+    
+    if not text:
+        return jsonify({"error": "Text is required"}), 400
+    max_chars = LONG_TEXT_MAX_CHARS if long_text_mode else 4000
+    if len(text) > max_chars:
+        return jsonify({"error": f"Text length exceeds {max_chars} characters"}), 400
+    if provider not in ("openai", "gemini"):
+        return jsonify({"error": f"Unsupported provider: {provider}"}), 400
+    provider_permissions = json.loads(g.api_key_info['provider_permissions'])
+    if provider not in provider_permissions:
+        return jsonify({
+            "error": f"Provider '{provider}' not allowed for this API key",
+            "allowed_providers": provider_permissions
+        }), 403
+    if (long_text_mode and provider == "openai" and len(text) > LONG_TEXT_CHUNK_CHARS[provider]
+            and job_request["format"] not in long_text.JOINABLE_FORMATS):
+        return jsonify({
+            "error": f"Format '{job_request['format']}' is not supported in long text mode",
+            "supported_formats": list(long_text.JOINABLE_FORMATS)
+        }), 400
+    
+    db = get_db()
+    settings = db.execute(
+        "SELECT api_key FROM api_settings WHERE user_id = ? AND service_name = ?",
+        (g.api_key_info['user_id'], provider)
+    ).fetchone()
+    if not settings or not settings["api_key"]:
+        return jsonify({
+            "error": f"{provider.upper()} API configuration not found",
+            "message": f"Please configure {provider.upper()} settings in the web interface first"
+        }), 400
+    
+    job_id = job_queue.submit(db, g.api_key_info['id'], job_request, quota_day=quota.today())
+    return jsonify({
+        "success": True,
+        "data": job_to_dict(job_queue.get(db, job_id, g.api_key_info['id']))
+    }), 202
+
+
+@app.route("/api/v1/tts/jobs", methods=["GET"])
+@api_key_required
+def api_list_jobs():
+    """列出当前密钥最近的任务"""
+    db = get_db()
+    limit = min(request.args.get("limit", 20, type=int), 100)
+    rows = db.execute(
+        "SELECT id FROM tts_jobs WHERE api_key_id = ? ORDER BY created_at DESC, rowid DESC LIMIT ?",
+        (g.api_key_info['id'], limit)
+    ).fetchall()
+    return jsonify({
+        "success": True,
+        "data": [job_to_dict(job_queue.get(db, row["id"], g.api_key_info['id'])) for row in rows]
+    })
+
+
+@app.route("/api/v1/tts/jobs/<job_id>", methods=["GET"])
+@api_key_required
+def api_get_job(job_id):
+    """查询任务状态；?wait=秒数 时长轮询，直到任务结束或超时"""
+    db = get_db()
+    wait = min(request.args.get("wait", 0, type=float), JOB_MAX_WAIT)
+    if wait > 0:
+        job = job_queue.wait(db, job_id, g.api_key_info['id'], wait)
+    else:
+        job = job_queue.get(db, job_id, g.api_key_info['id'])
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"success": True, "data": job_to_dict(job)})
+
+
+@app.route("/api/v1/tts/jobs/<job_id>/audio", methods=["GET"])
+@api_key_required
+def api_get_job_audio(job_id):
+    """下载已完成任务的音频"""
+    job = job_queue.get(get_db(), job_id, g.api_key_info['id'])
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] != "succeeded":
+        return jsonify({"error": f"Job is {job['status']}", "status": job["status"]}), 409
+    path = job_queue.result_path(job_id)
+    if not os.path.exists(path):
+        return jsonify({"error": "Job result has expired"}), 410
+    return send_file(
+        path,
+        mimetype=job["mimetype"],
+        as_attachment=request.args.get("download", type=int) == 1,
+        download_name=f"{job_id}.{batch.file_extension(job['mimetype'])}",
+        conditional=True,
+    )
+
+
+@app.route("/api/v1/tts/jobs/<job_id>", methods=["DELETE"])
+@api_key_required
+def api_cancel_job(job_id):
+    """取消任务；尚未开始执行的任务退还额度"""
+    db = get_db()
+    previous = job_queue.cancel(db, job_id, g.api_key_info['id'])
+    if previous is None:
+        return jsonify({"error": "Job not found"}), 404
+    job = job_queue.get(db, job_id, g.api_key_info['id'])
+    if previous == "queued":
+        refund_quota(db, g.api_key_info['id'], job["quota_day"])
+    return jsonify({"success": True, "data": job_to_dict(job)})
+
+
+def job_to_dict(job):
+    """任务记录转换为API响应"""
+    job_request = job["request"]
+    result = {
+        "id": job["id"],
+        "status": job["status"],
+        "provider": job_request["provider"],
+        "voice": job_request["voice"],
+        "model": job_request["model"],
+        "format": job_request["format"],
+        "text_length": len(job_request["text"]),
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "status_url": f"/api/v1/tts/jobs/{job['id']}",
+    }
+    if job["status"] == "failed":
+        result["error"] = job["error_message"]
+    if job["status"] == "succeeded":
+        result["audio_url"] = f"/api/v1/tts/jobs/{job['id']}/audio"
+        result["mimetype"] = job["mimetype"]
+        result["size"] = job["result_size"]
+        result["cached"] = bool(job["cached"])
+    return result
+
+
+def run_synthesis_job(job):
+    """任务队列工作线程执行的合成任务：完成时记录用量，失败时记录错误并退还额度"""
+    structured_log.request_id.set(f"job-{job['id']}")
+    job_request = job["request"]
+    created_at = job["created_at"]
+    if isinstance(created_at, str):
+        created_at = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
+    age = max((datetime.utcnow() - created_at).total_seconds(), 0.0)
+    queue_wait.observe(age, queue="jobs")
+    db = db_connections.get()
+    settings = db.execute(
+        "SELECT * FROM api_settings WHERE user_id = ? AND service_name = ?",
+        (job_request["user_id"], job_request["provider"])
+    ).fetchone()
+    db.commit()
+    model_name = job_request["model"] or (settings["model_name"] if settings else None)
+    try:
+        if not settings or not settings["api_key"]:
+            raise Exception(f"{job_request['provider'].upper()} API configuration not found")
+        mimetype, audio, cached, elapsed = synthesize_job_item(
+            dict(job_request, settings=settings), job["id"], time.monotonic() + JOB_OVERLOAD_TIMEOUT - age
+        )
     except Exception as e:
-        # 记录错误
-        if 'api_key_info' in g:
-            log_api_usage(
-                g.api_key_info['id'], 
-                data.get('provider', 'unknown'),
-                data.get('model', 'unknown'),
-                data.get('voice', 'unknown'),
-                len(data.get('text', '')),
-                None,
-                False,
-                str(e)
+        log_api_usage(
+            job["api_key_id"], job_request["provider"], model_name or "unknown", job_request["voice"],
+            len(job_request["text"]), None, False, str(e)
+        )
+        refund_quota(db, job["api_key_id"], job["quota_day"])
+        raise
+    log_api_usage(
+        job["api_key_id"], job_request["provider"], model_name, job_request["voice"],
+        len(job_request["text"]), elapsed, True, cached=cached
+    )
+    return mimetype, audio, cached
+
+
+def synthesize_job_item(item, job_id, deadline):
+    """后台任务不因上游暂时满载而立即失败：被准入控制拒绝时按 Retry-After 等待后重试
+
+    等待期间任务被取消，或到 deadline（time.monotonic() 时间）仍无法执行时放弃并抛出异常，
+    由调用方记为失败并退还额度。
+    """
+    db = db_connections.get()
+    while True:
+        try:
+            return synthesize_item(item)
+        except admission.Overloaded as e:
+            retry_at = time.monotonic() + e.retry_after
+            if retry_at > deadline:
+                raise Exception(
+                    f"Upstream '{e.provider}' still overloaded after waiting {JOB_OVERLOAD_TIMEOUT:g}s"
+                ) from e
+            logger.info(
+                "Upstream overloaded, job waiting",
+                extra={"provider": e.provider, "endpoint": e.endpoint, "retry_after": e.retry_after},
             )
-        
-        return jsonify({
-            "error": "Internal server error",
-            "message": str(e)
-        }), 500
+            # 分段等待，期间检查任务是否已被取消
+            while True:
+                if job_queue.is_cancelled(db, job_id):
+                    raise Exception("Job cancelled while waiting for upstream capacity")
+                remaining = retry_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(remaining, job_queue.poll_interval))
 
 
+@instrument_upstream("openai")
 def call_openai_tts(settings, text, voice, model=None, format="mp3", speed=1.0):
     """调用OpenAI TTS服务"""
-    from openai import OpenAI
-    
-    client = OpenAI(
-        api_key=settings["api_key"],
-        base_url=settings["api_endpoint"] if settings["api_endpoint"] else None,
-    )
+    client, release = provider_clients.lease("openai", settings["api_key"], settings["api_endpoint"])
     
-    response = client.audio.speech.create(
-        model=model or settings["model_name"],
-        voice=voice,
-        input=text,
-        response_format=format,
-        speed=speed
-    )
+    try:
+        response = client.audio.speech.create(
+            model=model or settings["model_name"],
+            voice=voice,
+            input=text,
+            response_format=format,
+            speed=speed
+        )
+    except Exception:
+        release()
+        raise
     
-    return Response(response.iter_bytes(), mimetype=f"audio/{format}")
+    # 客户端在音频输出完毕（或客户端断开）后才归还
+    return Response(release_after(response.iter_bytes(), release), mimetype=f"audio/{format}")
 
 
-def call_gemini_tts(settings, text, voice, model=None):
-    """调用Gemini TTS服务 - 使用与网页端相同的逻辑"""
-    from google import genai
-    from google.genai import types
-    import base64
-    import requests
-    import re
-    
-    model_name = model or settings["model_name"] or "gemini-2.5-flash-preview-tts"
+def gemini_model_name(settings, model=None):
+    return model or settings["model_name"] or "gemini-2.5-flash-preview-tts"
+
+
+def gemini_proxy_request(settings, model_name):
+    """Gemini 自定义端点（代理）的请求地址和请求头，返回 (api_url, proxy_url, headers)"""
+    proxy_url = settings["api_endpoint"].rstrip('/')
+    api_url = f"{proxy_url}/v1beta/models/{model_name}:generateContent"
+    headers = {
+        'Content-Type': 'application/json',
+        'x-goog-api-key': settings["api_key"]
+    }
+    return api_url, proxy_url, headers
+
+
+def gemini_proxy_audio(result):
+    """解析代理返回的 JSON：返回 (音频字节, None)，或特殊端点给出音频文件链接时返回 (None, 链接)"""
+    if not result.get('candidates'):
+        raise Exception("No candidates in response")
+    candidate = result['candidates'][0]
+    if 'content' not in candidate or 'parts' not in candidate['content']:
+        raise Exception("Invalid response structure")
+    part = candidate['content']['parts'][0]
     
-    print(f"--- Calling Gemini TTS (API) ---")
-    print(f"Model: {model_name}, Voice: {voice}")
-    print(f"API Endpoint: {settings['api_endpoint'] if settings['api_endpoint'] else 'Default Google API'}")
+    # 检查是否有传统的inlineData格式
+    if 'inlineData' in part:
+        decoded_audio = base64.b64decode(part['inlineData']['data'])
+        logger.debug("Gemini proxy audio received", extra={"bytes": len(decoded_audio)})
+        return decoded_audio, None
     
-    # 检查是否使用自定义API端点
-    if settings["api_endpoint"]:
-        print(f"Using custom API endpoint: {settings['api_endpoint']}")
-        
-        # 构建请求URL
-        proxy_url = settings["api_endpoint"].rstrip('/')
-        api_url = f"{proxy_url}/v1beta/models/{model_name}:generateContent"
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'x-goog-api-key': settings["api_key"]
-        }
-        
-        # 对于自定义端点，尝试多种兼容格式
-        # 首先尝试标准格式
-        payload = {
-            "contents": [{"parts": [{"text": text}]}],
-            "generationConfig": {
-                "response_modalities": ["AUDIO"],
-                "speech_config": {
-                    "voice_config": {
-                        "prebuilt_voice_config": {
-                            "voice_name": voice
-                        }
-                    }
-                }
-            }
-        }
-        
-        print(f"Sending request to proxy: {api_url}")
-        print(f"Request payload: {payload}")
-        
-        response = requests.post(api_url, headers=headers, json=payload, timeout=30)
-        
-        # 如果请求失败，尝试使用端点期望的格式
-        if response.status_code in [400, 500]:
-            print("First request failed, trying endpoint-specific format...")
-            
-            # 尝试使用该端点可能期望的格式
-            alternative_payload = {
-                "contents": [{"parts": [{"text": text}]}],
-                "generationConfig": {
-                    "responseModalities": ["AUDIO"],  # 使用 responseModalities 而不是 response_modalities
-                    "candidateCount": 1,
-                    "topK": 40,
-                    "topP": 0.9,
-                    "temperature": 0.7
-                }
-            }
-            
-            print(f"Alternative payload: {alternative_payload}")
-            response = requests.post(api_url, headers=headers, json=alternative_payload, timeout=30)
-            
-        # 如果还是失败，尝试最简化格式
-        if response.status_code in [400, 500]:
-            print("Second request failed, trying minimal format...")
-            minimal_payload = {
-                "contents": [{"parts": [{"text": text}]}],
-                "generationConfig": {
-                    "responseModalities": ["AUDIO"]
-                }
-            }
-            print(f"Minimal payload: {minimal_payload}")
-            response = requests.post(api_url, headers=headers, json=minimal_payload, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            print(f"Response received: {result}")
-            
-            # 提取音频数据
-            if 'candidates' in result and result['candidates']:
-                candidate = result['candidates'][0]
-                if 'content' in candidate and 'parts' in candidate['content']:
-                    part = candidate['content']['parts'][0]
-                    print(f"Part keys: {list(part.keys())}")
-                    
-                    # 检查是否有传统的inlineData格式
-                    if 'inlineData' in part:
-                        print("Found inlineData format")
-                        audio_data = part['inlineData']['data']
-                        decoded_audio = base64.b64decode(audio_data)
-                        
-                        print(f"Successfully received audio via proxy: {len(decoded_audio)} bytes")
-                        print(f"Audio data first 16 bytes: {decoded_audio[:16].hex()}")
-                        
-                        # 检测和处理音频格式
-                        if decoded_audio.startswith(b'RIFF'):
-                            print("Detected RIFF/WAV format")
-                            mimetype = "audio/wav"
-                        elif decoded_audio.startswith(b'\xff\xfb') or decoded_audio.startswith(b'\xff\xfa'):
-                            print("Detected MP3 format")
-                            mimetype = "audio/mpeg"
-                        elif decoded_audio.startswith(b'ID3'):
-                            print("Detected MP3 with ID3")
-                            mimetype = "audio/mpeg"
-                        elif decoded_audio.startswith(b'OggS'):
-                            print("Detected OGG format")
-                            mimetype = "audio/ogg"
-                        else:
-                            print("Detected raw PCM, adding WAV header")
-                            # 为原始PCM数据添加WAV头部
-                            def create_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-                                import struct
-                                
-                                # 计算各种参数
-                                byte_rate = sample_rate * channels * bits_per_sample // 8
-                                block_align = channels * bits_per_sample // 8
-                                chunk_size = 36 + len(pcm_data)
-                                subchunk2_size = len(pcm_data)
-                                
-                                # 创建WAV头部
-                                wav_header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                                    b'RIFF',           # Chunk ID
-                                    chunk_size,        # Chunk Size (文件大小 - 8)
-                                    b'WAVE',           # Format
-                                    b'fmt ',           # Subchunk1 ID
-                                    16,                # Subchunk1 Size (PCM格式固定为16)
-                                    1,                 # Audio Format (1 = PCM)
-                                    channels,          # Num Channels
-                                    sample_rate,       # Sample Rate
-                                    byte_rate,         # Byte Rate
-                                    block_align,       # Block Align
-                                    bits_per_sample,   # Bits Per Sample
-                                    b'data',           # Subchunk2 ID
-                                    subchunk2_size     # Subchunk2 Size (PCM数据大小)
-                                )
-                                
-                                return wav_header
-                            
-                            wav_header = create_wav_header(decoded_audio)
-                            decoded_audio = wav_header + decoded_audio
-                            mimetype = "audio/wav"
-                            print(f"Added WAV header, total size: {len(decoded_audio)} bytes")
-                            print(f"WAV header (first 16 bytes): {decoded_audio[:16].hex()}")
-                        
-                        return Response(decoded_audio, mimetype=mimetype)
-                    
-                    # 检查是否有文本内容包含图片链接（特殊端点的格式）
-                    elif 'text' in part and '![image](' in part['text']:
-                        print("Found text with image URL format")
-                        # 提取图片URL
-                        url_match = re.search(r'!\[image\]\((https?://[^\)]+)\)', part['text'])
-                        if url_match:
-                            audio_url = url_match.group(1)
-                            print(f"Found audio file URL: {audio_url}")
-                            
-                            # 下载音频文件
-                            audio_response = requests.get(audio_url, timeout=30)
-                            if audio_response.status_code == 200:
-                                audio_data = audio_response.content
-                                print(f"Successfully downloaded audio: {len(audio_data)} bytes")
-                                
-                                # 检查文件的实际格式（通过文件头）
-                                if audio_data.startswith(b'RIFF') and b'WAVE' in audio_data[:12]:
-                                    mimetype = "audio/wav"
-                                elif audio_data.startswith(b'\xff\xfb') or audio_data.startswith(b'\xff\xfa') or audio_data.startswith(b'ID3'):
-                                    mimetype = "audio/mpeg"
-                                elif audio_data.startswith(b'OggS'):
-                                    mimetype = "audio/ogg"
-                                elif audio_data.startswith(b'fLaC'):
-                                    mimetype = "audio/flac"
-                                elif audio_data.startswith(b'\x00\x00\x00\x20ftypM4A') or audio_data.startswith(b'\x00\x00\x00\x18ftypM4A'):
-                                    mimetype = "audio/mp4"
-                                else:
-                                    # 检查是否为原始PCM数据
-                                    print(f"Unknown audio format, file header: {audio_data[:16].hex()}")
-                                    
-                                    # 尝试检测是否为原始PCM数据
-                                    if len(audio_data) > 1000:  # 确保有足够的数据
-                                        # 检查是否看起来像16位PCM数据
-                                        samples = []
-                                        for i in range(0, min(20, len(audio_data)-1), 2):
-                                            sample = int.from_bytes(audio_data[i:i+2], 'little', signed=True)
-                                            samples.append(sample)
-                                        
-                                        # 检查样本值是否在合理的音频范围内（-32768到32767）
-                                        valid_samples = sum(1 for s in samples if -32768 <= s <= 32767)
-                                        if valid_samples >= 8:  # 大部分样本都在合理范围内
-                                            print("Detected raw PCM audio data, adding WAV header...")
-                                            
-                                            # 为原始PCM数据创建WAV文件头部
-                                            def create_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-                                                import struct
-                                                
-                                                # 计算各种参数
-                                                byte_rate = sample_rate * channels * bits_per_sample // 8
-                                                block_align = channels * bits_per_sample // 8
-                                                chunk_size = 36 + len(pcm_data)
-                                                subchunk2_size = len(pcm_data)
-                                                
-                                                # 创建WAV头部
-                                                wav_header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                                                    b'RIFF',           # ChunkID
-                                                    chunk_size,        # ChunkSize
-                                                    b'WAVE',           # Format
-                                                    b'fmt ',           # Subchunk1ID
-                                                    16,                # Subchunk1Size (PCM)
-                                                    1,                 # AudioFormat (PCM)
-                                                    channels,          # NumChannels
-                                                    sample_rate,       # SampleRate
-                                                    byte_rate,         # ByteRate
-                                                    block_align,       # BlockAlign
-                                                    bits_per_sample,   # BitsPerSample
-                                                    b'data',           # Subchunk2ID
-                                                    subchunk2_size     # Subchunk2Size
-                                                )
-                                                
-                                                return wav_header + pcm_data
-                                            
-                                            # 创建完整的WAV文件
-                                            audio_data = create_wav_header(audio_data)
-                                            mimetype = "audio/wav"
-                                            print(f"Created WAV file with header, total size: {len(audio_data)} bytes")
-                                        else:
-                                            print("Data doesn't appear to be PCM audio")
-                                            mimetype = "audio/wav"  # 默认尝试
-                                    else:
-                                        # 文件太小，默认尝试WAV
-                                        mimetype = "audio/wav"
-                                
-                                return Response(audio_data, mimetype=mimetype)
-                            else:
-                                raise Exception(f"Failed to download audio from URL: {audio_url}")
-                        else:
-                            raise Exception("No audio URL found in response text")
-                    else:
-                        raise Exception("No audio data found in response")
-                else:
-                    raise Exception("Invalid response structure")
-            else:
-                raise Exception("No candidates in response")
-        else:
-            error_msg = f"API request failed with status {response.status_code}: {response.text}"
-            print(f"Gemini代理端点错误: {error_msg}")
-            raise Exception(error_msg)
-    else:
-        # 使用官方API
-        client = genai.Client(api_key=settings["api_key"])
-        response = client.models.generate_content(
-            model=model_name,
-            contents=text,
-            config=types.GenerateContentConfig(
-                response_modalities=["AUDIO"],
-                speech_config=types.SpeechConfig(
-                    voice_config=types.VoiceConfig(
-                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                            voice_name=voice
-                        )
-                    )
+    # 检查是否有文本内容包含图片链接（特殊端点的格式）
+    if 'text' in part and '![image](' in part['text']:
+        url_match = re.search(r'!\[image\]\((https?://[^\)]+)\)', part['text'])
+        if not url_match:
+            raise Exception("No audio URL found in response text")
+        return None, url_match.group(1)
+    raise Exception("No audio data found in response")
+
+
+def gemini_sdk_config(voice):
+    """官方 SDK 的 TTS 请求参数"""
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        response_modalities=["AUDIO"],
+        speech_config=types.SpeechConfig(
+            voice_config=types.VoiceConfig(
+                prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                    voice_name=voice
                 )
             )
         )
-        
-        if response.candidates and response.candidates[0].content.parts:
-            audio_data = response.candidates[0].content.parts[0].inline_data.data
-            pcm_data = base64.b64decode(audio_data)
-            # 为PCM数据添加WAV文件头
-            def create_wav_header(pcm_data, sample_rate=24000, channels=1, bits_per_sample=16):
-                import struct
-                
-                # 计算各种参数
-                byte_rate = sample_rate * channels * bits_per_sample // 8
-                block_align = channels * bits_per_sample // 8
-                chunk_size = 36 + len(pcm_data)
-                subchunk2_size = len(pcm_data)
-                
-                # 创建WAV头部
-                wav_header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                    b'RIFF',           # Chunk ID
-                    chunk_size,        # Chunk Size (文件大小 - 8)
-                    b'WAVE',           # Format
-                    b'fmt ',           # Subchunk1 ID
-                    16,                # Subchunk1 Size (PCM格式固定为16)
-                    1,                 # Audio Format (1 = PCM)
-                    channels,          # Num Channels
-                    sample_rate,       # Sample Rate
-                    byte_rate,         # Byte Rate
-                    block_align,       # Block Align
-                    bits_per_sample,   # Bits Per Sample
-                    b'data',           # Subchunk2 ID
-                    subchunk2_size     # Subchunk2 Size (PCM数据大小)
-                )
-                
-                return wav_header
-            
-            wav_header = create_wav_header(pcm_data)
-            wav_data = wav_header + pcm_data
-            return Response(wav_data, mimetype="audio/wav")
-    
+    )
+
+
+def gemini_sdk_audio(response):
+    """从官方 SDK 的响应中取出音频字节"""
+    if response.candidates and response.candidates[0].content.parts:
+        audio_data = response.candidates[0].content.parts[0].inline_data.data
+        # SDK 返回的已是解码后的字节
+        if not isinstance(audio_data, bytes):
+            audio_data = base64.b64decode(audio_data)
+        return audio_data
     raise Exception("Failed to generate audio from Gemini")
 
 
+def gemini_proxy_tts(settings, text, voice, model_name):
+    """通过自定义端点（代理）合成，返回音频字节"""
+    # 按该端点/模型上次成功的请求格式优先发送，被拒绝时再依次尝试其他格式
+    api_url, proxy_url, headers = gemini_proxy_request(settings, model_name)
+    response = proxy_dialects.post(
+        proxy_sessions, proxy_payload_dialects, api_url, proxy_url, model_name,
+        headers, text, voice
+    )
+    if response.status_code != 200:
+        raise Exception(f"API request failed with status {response.status_code}: {response.text}")
+    
+    audio_data, audio_url = gemini_proxy_audio(response.json())
+    if audio_url:
+        # 下载音频文件
+        audio_response = proxy_sessions.get(audio_url)
+        if audio_response.status_code != 200:
+            raise Exception(f"Failed to download audio from URL: {audio_url}")
+        audio_data = audio_response.content
+        logger.debug(
+            "Gemini proxy audio downloaded",
+            extra={"url": audio_url, "bytes": len(audio_data), "format": audio.sniff_format(audio_data) or "pcm"},
+        )
+    return audio_data
+
+
+def gemini_direct_tts(settings, text, voice, model_name):
+    """通过官方 SDK 合成，返回音频字节"""
+    client, release = provider_clients.lease("gemini", settings["api_key"])
+    try:
+        response = client.models.generate_content(
+            model=model_name, contents=text, config=gemini_sdk_config(voice)
+        )
+    finally:
+        release()
+    return gemini_sdk_audio(response)
+
+
+def admitted(provider, endpoint, fn):
+    """对冲的单条路径：调用前取得该路径所在端点的准入名额，返回音频后归还"""
+    def call():
+        release = upstream_admission.acquire(provider, endpoint)
+        try:
+            return fn()
+        finally:
+            release()
+    return call
+
+
+def gemini_paths(settings, text, voice, model_name, proxy, direct, admit):
+    """按 GEMINI_HEDGE_PRIMARY 排列的 (主路径, 备用路径)，每项为 (名称, 函数)
+
+    两条路径分别经 admit(服务商, 端点, 函数) 取得代理端点和官方 API 的准入名额。
+    """
+    paths = [
+        ("proxy", admit("gemini", settings["api_endpoint"], lambda: proxy(settings, text, voice, model_name))),
+        ("direct", admit("gemini", None, lambda: direct(settings, text, voice, model_name))),
+    ]
+    return paths if GEMINI_HEDGE_PRIMARY != "direct" else paths[::-1]
+
+
+def gemini_tts_audio(settings, text, voice, model_name):
+    """Gemini 合成并返回音频字节：配置了自定义端点时按对冲策略在代理和官方 API 之间取先成功的结果"""
+    logger.debug(
+        "Calling Gemini TTS",
+        extra={"model": model_name, "voice": voice, "endpoint": settings["api_endpoint"] or "google"},
+    )
+    if not settings["api_endpoint"]:
+        return gemini_direct_tts(settings, text, voice, model_name)
+    return gemini_hedger.run(
+        settings["api_endpoint"], *gemini_paths(settings, text, voice, model_name, gemini_proxy_tts, gemini_direct_tts, admitted)
+    )
+
+
+@instrument_upstream("gemini", hedged=True)
+def call_gemini_tts(settings, text, voice, model=None):
+    """调用Gemini TTS服务 - 使用与网页端相同的逻辑"""
+    return build_audio_response(gemini_tts_audio(settings, text, voice, gemini_model_name(settings, model)))
+
+
 @app.route("/api/v1/providers", methods=["GET"])
 @api_key_required
 def get_providers():
@@ -1475,7 +2172,8 @@ def get_providers():
                 "Alnilam", "Schedar", "Gacrux", "Pulcherrima", "Achird", "Zubenelgenubi",
                 "Vindemiatrix", "Sadachbia", "Sadaltager", "Sulafat"
             ],
-            "formats": ["wav"]
+            # 除 WAV 外，其余格式由本地编码器转码
+            "formats": ["wav"] + transcoder.formats()
         }
     }
     
@@ -1526,23 +2224,62 @@ def health_check():
     })
 
 
+@app.route("/api/system/stats", methods=["GET"])
+@login_required
+def get_system_stats():
+    """获取网关内部运行统计（缓存命中率等），用于容量调优"""
+    return jsonify({
+        "cache": synthesis_cache.stats(),
+        "clients": provider_clients.stats(),
+        "proxy_sessions": proxy_sessions.stats(),
+        "proxy_dialects": proxy_payload_dialects.stats(),
+        "auth_cache": api_key_cache.stats(),
+        "last_used": last_used_tracker.stats(),
+        "rate_limit": key_rate_limiter.stats(),
+        "usage_writer": usage_writer.stats(),
+        "long_text": long_text_synthesizer.stats(),
+        "batch": batch_runner.stats(),
+        "transcode": transcoder.stats(),
+        "jobs": job_queue.stats(get_db()),
+        "database": db_connections.stats(),
+        "logging": structured_log.stats(),
+        "admission": upstream_admission.stats(),
+        "coalescing": upstream_flights.stats(),
+        "gemini_hedge": gemini_hedger.stats(),
+        **{name: get_stats() for name, get_stats in extra_system_stats.items()}
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus 抓取端点；设置了 TTS_METRICS_TOKEN 时需要 Authorization: Bearer <token>"""
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return jsonify({"error": "Authentication required"}), 401
+    return Response(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.route("/api/v1/usage", methods=["GET"])
 @api_key_required
 def get_usage_stats():
     """获取API使用统计"""
     api_key_info = g.api_key_info
     
-    # 获取今日使用统计
-    today = datetime.now().strftime('%Y-%m-%d')
+    # 获取今日使用统计（先等待队列中的使用记录写入）
+    usage_writer.flush(timeout=1.0)
+    today = quota.today()
     db = get_db()
     
+    day_start, day_end = quota.day_range(today)
     today_usage = db.execute("""
         SELECT COUNT(*) as calls, SUM(text_length) as characters, provider,
-               SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful_calls
+               SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful_calls,
+               SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached_calls
         FROM api_usage 
-        WHERE api_key_id = ? AND DATE(created_at) = ?
+        WHERE api_key_id = ? AND created_at >= ? AND created_at < ?
         GROUP BY provider
-    """, (api_key_info['id'], today)).fetchall()
+    """, (api_key_info['id'], day_start, day_end)).fetchall()
     
     # 获取总体统计
     total_usage = db.execute("""
@@ -1552,10 +2289,22 @@ def get_usage_stats():
         WHERE api_key_id = ?
     """, (api_key_info['id'],)).fetchone()
     
+    used_today = quota.used(db, api_key_info['id'], today)
+    rejected_today, rejected_total = key_rate_limiter.rejections(db, api_key_info['id'], today)
+    
     return jsonify({
         "daily_limit": api_key_info['daily_limit'],
+        "used_today": used_today,
+        "remaining_today": max(api_key_info['daily_limit'] - used_today, 0),
         "today_usage": [dict(row) for row in today_usage],
         "total_usage": dict(total_usage),
+        "rate_limit": {
+            "rps_limit": api_key_info.get('rps_limit') or 0,
+            "burst_limit": api_key_info.get('burst_limit') or 0,
+            "concurrency_limit": api_key_info.get('concurrency_limit') or 0,
+            "rejected_today": rejected_today,
+            "rejected_total": rejected_total,
+        },
         "key_name": api_key_info['key_name'],
         "created_at": api_key_info['created_at']
     })
@@ -1565,10 +2314,13 @@ def get_usage_stats():
 application = app
 
 # --- Main Execution ---
+# 导入即初始化数据库并启动异步任务工作线程（WSGI/ASGI 服务器导入本模块时同样执行），
+# 继续执行重启前未完成的任务
+init_db()
+job_queue.start()
+
+
 if __name__ == "__main__":
-    # 初始化数据库
-    init_db()
-    
     # 从环境变量获取端口，默认7280
     port = int(os.environ.get('PORT', 7280))
     host = os.environ.get('HOST', '0.0.0.0')
@@ -0,0 +1,415 @@
+"""ASGI 入口：等待上游的合成请求不占用线程。
+
+    pip install uvicorn
+    uvicorn asgi:application --host 0.0.0.0 --port 7280
+
+开放API的普通合成请求（POST /api/v1/tts/synthesize，非流式、非长文本切分、未命中缓存）
+在这里分三段处理：认证、额度、参数校验和查缓存在线程池中执行；上游调用（OpenAI、Gemini
+官方 API 和代理）使用异步客户端在事件循环中等待；收尾（写缓存、转码、记录用量）再回到线程池。
+同时等待的上游请求数只受 TTS_ASGI_MAX_UPSTREAM 限制，与线程数无关。
+
+其他请求（网页端、登录会话、管理接口、流式和长文本合成等）照常交给 Flask 应用，在线程池中执行。
+"""
+import asyncio
+import contextvars
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app_production as gateway
+import proxy_dialects
+from provider_clients import create_async_registry_from_env
+
+# 执行 Flask 请求、数据库操作和响应体输出的线程数
+THREADS = int(os.environ.get("TTS_ASGI_THREADS", 32))
+# 同时等待的上游请求数上限
+MAX_UPSTREAM = int(os.environ.get("TTS_ASGI_MAX_UPSTREAM", 1000))
+
+SYNTHESIZE_PATH = "/api/v1/tts/synthesize"
+
+executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="tts-asgi")
+async_clients = create_async_registry_from_env()
+
+_upstream_slots = {}  # 事件循环 -> 信号量
+_stats = {"async_syntheses": 0, "wsgi_requests": 0, "upstream_in_flight": 0, "peak_upstream_in_flight": 0}
+
+
+def stats():
+    result = dict(_stats)
+    result["threads"] = THREADS
+    result["max_upstream"] = MAX_UPSTREAM
+    result["clients"] = async_clients.stats()
+    return result
+
+
+async def run_sync(fn, *args):
+    """在线程池中执行同步函数，带上当前的上下文（Flask 请求上下文、请求 ID）"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, fn, *args)
+
+
+async def run_sync_to_end(fn, *args):
+    """同 run_sync；被取消时先等线程中的函数执行完再抛出（请求上下文须在其结束后才能弹出）"""
+    future = asyncio.ensure_future(run_sync(fn, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+def upstream_slots():
+    loop = asyncio.get_running_loop()
+    slots = _upstream_slots.get(loop)
+    if slots is None:
+        _upstream_slots.clear()
+        slots = _upstream_slots[loop] = asyncio.Semaphore(MAX_UPSTREAM)
+    return slots
+
+
+gateway.extra_system_stats["asgi"] = stats
+
+# 排队等待名额时不占用线程：未单独配置时，准入控制的并发上限与 TTS_ASGI_MAX_UPSTREAM 一致
+if "TTS_ADMISSION_MAX_CONCURRENCY" not in os.environ:
+    gateway.upstream_admission.max_concurrency = MAX_UPSTREAM
+
+
+# --- ASGI <-> WSGI ---
+async def read_body(receive):
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body.write(message.get("body", b""))
+        if not message.get("more_body"):
+            return body.getvalue()
+
+
+def build_environ(scope, body):
+    """由 ASGI scope 构造 WSGI environ"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def send_response(send, status, headers, body):
+    """发送响应；body 为同步可迭代对象，每块在线程池中取出（可能涉及缓存写入、转码等阻塞操作）"""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    iterator = iter(body)
+    done = object()
+    try:
+        while True:
+            chunk = await run_sync(next, iterator, done)
+            if chunk is done:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": bytes(chunk), "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        # 客户端断开时同样关闭响应体（结束上游读取、触发 call_on_close 回调）
+        close = getattr(body, "close", None)
+        if close is not None:
+            await run_sync(close)
+
+
+async def send_wsgi_response(send, environ, wsgi_app):
+    """调用 WSGI 应用（Flask 应用或 Flask 响应对象）并发送其响应"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+        return lambda data: None
+
+    body = await run_sync(wsgi_app, environ, start_response)
+    await send_response(send, started["status"], started["headers"], body)
+
+
+async def handle_wsgi(environ, send):
+    """交给 Flask 应用处理"""
+    _stats["wsgi_requests"] += 1
+    await send_wsgi_response(send, environ, gateway.application)
+
+
+# --- 异步合成 ---
+def release_db():
+    # 线程池中的每一段各自取用本线程的数据库连接，结束时归还
+    gateway.close_db(None)
+
+
+def finalize(rv, day=None):
+    """生成最终响应并执行 after_request 钩子；失败或未完整发送的响应退还预占的额度，发送完毕后归还密钥并发名额"""
+    response = gateway.app.make_response(rv)
+    if day is not None:
+        if response.status_code >= 400:
+            gateway.refund_daily_quota(day)
+        else:
+            gateway.refund_on_incomplete(response, day)
+    ticket = gateway.g.pop("key_ticket", None)
+    if ticket is not None:
+        gateway.with_key_ticket(response, ticket)
+    return gateway.app.process_response(response)
+
+
+def prepare_synthesis():
+    """第一段：before_request 钩子、认证、预占额度、参数校验和查缓存
+
+    返回 (最终响应, None, None)，或需要异步调用上游时返回 (None, plan, 额度日期)。
+    """
+    day = None
+    try:
+        rv = gateway.app.preprocess_request()
+        if rv is not None:
+            return finalize(rv), None, None
+        started = time.perf_counter()
+        error = gateway.authenticate_api_key()
+        gateway.auth_duration.observe(time.perf_counter() - started, result="denied" if error else "ok")
+        if error:
+            return finalize(error), None, None
+        ticket, error = gateway.acquire_key_slot()
+        if error:
+            return finalize(error), None, None
+        gateway.g.key_ticket = ticket
+        day, error = gateway.reserve_daily_quota()
+        if error:
+            return finalize(error), None, None
+        data = gateway.request.get_json(silent=True)
+        try:
+            plan, error = gateway.plan_api_synthesis(data, gateway.g.api_key_info)
+            if error:
+                return finalize(error, day), None, None
+            if gateway.needs_upstream_call(plan):
+                plan["data"] = data
+                return None, plan, day
+            rv = gateway.finish_api_synthesis(plan, gateway.run_api_synthesis(plan))
+        except Exception as e:
+            rv = gateway.api_synthesis_error(data, gateway.g.api_key_info, e)
+        return finalize(rv, day), None, None
+    except Exception as e:
+        return finalize(gateway.app.handle_exception(e), day), None, None
+    finally:
+        release_db()
+
+
+def complete_synthesis(plan, day, audio_data, error):
+    """第三段：用上游返回的音频构造响应，写缓存、转码、记录用量"""
+    try:
+        if error is not None:
+            rv = gateway.api_synthesis_error(plan["data"], gateway.g.api_key_info, error)
+        else:
+            try:
+                if plan["provider"] == "openai":
+                    audio_response = gateway.Response([audio_data], mimetype=f"audio/{plan['format']}")
+                else:
+                    audio_response = gateway.build_audio_response(audio_data)
+                audio_response = gateway.cache_audio_response(plan["source_key"], audio_response)
+                rv = gateway.finish_api_synthesis(plan, audio_response)
+            except Exception as e:
+                rv = gateway.api_synthesis_error(plan["data"], gateway.g.api_key_info, e)
+        return finalize(rv, day)
+    except Exception as e:
+        return finalize(gateway.app.handle_exception(e), day)
+    finally:
+        release_db()
+
+
+async def call_openai_async(plan):
+    settings = plan["settings"]
+    client = async_clients.openai(settings["api_key"], settings["api_endpoint"])
+    response = await client.audio.speech.create(
+        model=plan["model"] or settings["model_name"],
+        voice=plan["voice"],
+        input=plan["text"],
+        response_format=plan["format"],
+        speed=plan["speed"],
+    )
+    return response.content
+
+
+async def gemini_direct_async(settings, text, voice, model_name):
+    client, release = gateway.provider_clients.lease("gemini", settings["api_key"])
+    try:
+        response = await client.aio.models.generate_content(
+            model=model_name, contents=text, config=gateway.gemini_sdk_config(voice)
+        )
+    finally:
+        release()
+    return gateway.gemini_sdk_audio(response)
+
+
+async def gemini_proxy_async(settings, text, voice, model_name):
+    http = async_clients.http()
+    api_url, proxy_url, headers = gateway.gemini_proxy_request(settings, model_name)
+    response = await proxy_dialects.post_async(
+        http, gateway.proxy_payload_dialects, api_url, proxy_url, model_name, headers, text, voice
+    )
+    if response.status_code != 200:
+        raise Exception(f"API request failed with status {response.status_code}: {response.text}")
+    audio_data, audio_url = gateway.gemini_proxy_audio(response.json())
+    if audio_url:
+        download = await http.get(audio_url)
+        if download.status_code != 200:
+            raise Exception(f"Failed to download audio from URL: {audio_url}")
+        audio_data = download.content
+    return audio_data
+
+
+async def call_gemini_async(plan):
+    """与同步模式相同：配置了自定义端点时按对冲策略在代理和官方 API 之间取先成功的结果"""
+    settings = plan["settings"]
+    model_name = gateway.gemini_model_name(settings, plan["model"])
+    if not settings["api_endpoint"]:
+        return await gemini_direct_async(settings, plan["text"], plan["voice"], model_name)
+    return await gateway.gemini_hedger.run_async(
+        settings["api_endpoint"],
+        *gateway.gemini_paths(
+            settings, plan["text"], plan["voice"], model_name, gemini_proxy_async, gemini_direct_async, admitted_async
+        )
+    )
+
+
+def admitted_async(provider, endpoint, fn):
+    """同 app.admitted：对冲的单条路径在事件循环中取得该路径所在端点的准入名额"""
+    async def call():
+        release = await gateway.upstream_admission.acquire_async(provider, endpoint)
+        try:
+            return await fn()
+        finally:
+            release()
+    return call
+
+
+def flight_key(plan):
+    """合并相同上游调用的键：同一上游账号、参数完全相同的非流式合成"""
+    settings = plan["settings"]
+    return (
+        plan["provider"], settings["api_key"], settings["api_endpoint"], plan["model"] or settings["model_name"],
+        plan["text"], plan["voice"], plan["format"], plan["speed"],
+    )
+
+
+async def call_upstream(plan):
+    """第二段：在事件循环中等待上游，记录与同步模式相同的上游指标
+
+    与同步模式共用准入控制：满载时抛出 admission.Overloaded，收尾阶段返回 503。
+    配置了自定义端点的 Gemini 由对冲的每条路径各自取得名额（admitted_async）。
+    """
+    provider = plan["provider"]
+    model = plan["model"] or plan["settings"]["model_name"] or ""
+    endpoint = plan["settings"]["api_endpoint"]
+    hedged = provider == "gemini" and endpoint
+    release = (lambda: None) if hedged else await gateway.upstream_admission.acquire_async(provider, endpoint)
+    try:
+        async with upstream_slots():
+            _stats["upstream_in_flight"] += 1
+            _stats["peak_upstream_in_flight"] = max(_stats["peak_upstream_in_flight"], _stats["upstream_in_flight"])
+            gateway.upstream_in_flight.inc(provider=provider)
+            started = time.perf_counter()
+            status = "error"
+            try:
+                if provider == "openai":
+                    audio_data = await call_openai_async(plan)
+                else:
+                    audio_data = await call_gemini_async(plan)
+                status = "ok"
+                gateway.upstream_ttfb.observe(time.perf_counter() - started, provider=provider, model=model)
+                return audio_data
+            except asyncio.CancelledError:
+                status = "cancelled"
+                raise
+            finally:
+                _stats["upstream_in_flight"] -= 1
+                gateway.upstream_in_flight.dec(provider=provider)
+                gateway.upstream_duration.observe(
+                    time.perf_counter() - started, provider=provider, model=model, status=status
+                )
+    finally:
+        release()
+
+
+async def handle_synthesize(environ, send):
+    ctx = gateway.app.request_context(environ)
+    ctx.push()
+    try:
+        response, plan, day = await run_sync_to_end(prepare_synthesis)
+        if plan is not None:
+            _stats["async_syntheses"] += 1
+            audio_data, error = None, None
+            try:
+                audio_data = await gateway.upstream_flights.do_async(
+                    flight_key(plan), lambda: call_upstream(plan), plan["provider"]
+                )
+            except Exception as e:
+                error = e
+            response = await run_sync_to_end(complete_synthesis, plan, day, audio_data, error)
+    finally:
+        # 未生成响应（如客户端断开被取消）时在这里归还密钥并发名额
+        ticket = gateway.g.pop("key_ticket", None)
+        if ticket is not None:
+            ticket.release()
+        # 与 Flask 相同：请求上下文在输出响应体之前结束（须在推入它的同一上下文中弹出）
+        ctx.pop()
+    await send_wsgi_response(send, environ, response)
+
+
+# --- 入口 ---
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_clients.aclose()
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    environ = build_environ(scope, body)
+    if scope["method"] == "POST" and scope["path"] == SYNTHESIZE_PATH:
+        await handle_synthesize(environ, send)
+    else:
+        await handle_wsgi(environ, send)
@@ -0,0 +1,120 @@
+"""音频格式识别、零拷贝组装与流式 base64 编码。
+
+响应体以分块列表的形式返回：头部单独一块，后面直接跟原始音频缓冲区，
+不做 header + data 拼接，避免复制数 MB 的音频数据。
+"""
+import base64
+import struct
+from functools import lru_cache
+
+# Gemini TTS 输出的原始 PCM 参数
+DEFAULT_SAMPLE_RATE = 24000
+DEFAULT_CHANNELS = 1
+DEFAULT_BITS_PER_SAMPLE = 16
+
+# 流式 base64 编码每次处理的最大字节数（3 的倍数，编码结果不含填充）
+BASE64_BLOCK_SIZE = 3 * 16384
+
+# 流式输出时总长度未知，RIFF/data 长度写为最大值，播放器读到流结束为止
+STREAMING_SIZE = 0xFFFFFFFF
+
+MIMETYPES = {
+    "wav": "audio/wav",
+    "mp3": "audio/mpeg",
+    "ogg": "audio/ogg",
+    "flac": "audio/flac",
+    "m4a": "audio/mp4",
+    "aac": "audio/aac",
+}
+
+
+def sniff_format(data):
+    """根据文件头识别音频格式，返回 wav/mp3/ogg/flac/m4a/aac，无法识别（如原始 PCM）时返回 None"""
+    head = bytes(data[:12])
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:3] == b"ID3":
+        return "mp3"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[4:8] == b"ftyp":
+        return "m4a"
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+        # 帧同步字：layer 位为 00 的是 ADTS（AAC），其余为 MPEG 音频
+        return "aac" if (head[1] & 0x06) == 0 else "mp3"
+    return None
+
+
+def sniff_mimetype(data):
+    """识别音频的 MIME 类型，无法识别时返回 None"""
+    return MIMETYPES.get(sniff_format(data))
+
+
+@lru_cache(maxsize=16)
+def _wav_header_template(sample_rate, channels, bits_per_sample):
+    """预先计算与长度无关的 WAV 头部字段，只留两个长度字段在使用时填入"""
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    return bytes(struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 0, b'WAVE', b'fmt ', 16, 1,
+        channels, sample_rate, byte_rate, block_align,
+        bits_per_sample, b'data', 0,
+    ))
+
+
+def wav_header(data_size, sample_rate=DEFAULT_SAMPLE_RATE, channels=DEFAULT_CHANNELS,
+               bits_per_sample=DEFAULT_BITS_PER_SAMPLE):
+    """PCM WAV 头部（44 字节）；data_size 为 STREAMING_SIZE 时生成开放长度的流式头部"""
+    header = bytearray(_wav_header_template(sample_rate, channels, bits_per_sample))
+    riff_size = STREAMING_SIZE if data_size == STREAMING_SIZE else 36 + data_size
+    struct.pack_into('<I', header, 4, riff_size)
+    struct.pack_into('<I', header, 40, data_size)
+    return bytes(header)
+
+
+def wav_chunks(pcm_data, sample_rate=DEFAULT_SAMPLE_RATE, channels=DEFAULT_CHANNELS,
+               bits_per_sample=DEFAULT_BITS_PER_SAMPLE):
+    """为原始 PCM 加上 WAV 头部：返回 [头部, 原始缓冲区]，不复制 PCM 数据"""
+    return [wav_header(len(pcm_data), sample_rate, channels, bits_per_sample), pcm_data]
+
+
+def assemble(data):
+    """识别上游返回的音频；已有容器格式的原样返回，原始 PCM 补上 WAV 头部
+
+    返回 (分块列表, mimetype)。
+    """
+    mimetype = sniff_mimetype(data)
+    if mimetype is not None:
+        return [data], mimetype
+    return wav_chunks(data), MIMETYPES["wav"]
+
+
+def chunks_size(chunks):
+    return sum(len(chunk) for chunk in chunks)
+
+
+def iter_base64(chunks, block_size=BASE64_BLOCK_SIZE):
+    """逐块 base64 编码音频，输出依次拼接后与整体编码结果相同
+
+    只编码 3 字节对齐的部分，余下的 0~2 字节并入下一块；单块过大时再按 block_size 切开，
+    内存占用与音频总长度无关。
+    """
+    carry = b""
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if carry:
+            need = 3 - len(carry)
+            if len(view) < need:
+                carry += bytes(view)
+                continue
+            yield base64.b64encode(carry + bytes(view[:need]))
+            view = view[need:]
+        aligned = len(view) - len(view) % 3
+        for start in range(0, aligned, block_size):
+            yield base64.b64encode(view[start:min(start + block_size, aligned)])
+        carry = bytes(view[aligned:])
+    if carry:
+        yield base64.b64encode(carry)
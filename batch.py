@@ -0,0 +1,173 @@
+"""批量合成：有界线程池并发执行，按服务商限制并发数，结果完成一个输出一个。"""
+import json
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import audio
+
+OUTPUT_FORMATS = ("json", "multipart", "zip")
+
+_EXTENSIONS = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/wav": "wav",
+    "audio/opus": "opus",
+    "audio/ogg": "ogg",
+    "audio/aac": "aac",
+    "audio/flac": "flac",
+    "audio/pcm": "pcm",
+}
+
+
+def file_extension(mimetype):
+    return _EXTENSIONS.get((mimetype or "").split(";")[0].strip().lower(), "bin")
+
+
+class BatchRunner:
+    """所有批量请求共享的线程池；每个服务商另有信号量限制同时进行的上游请求数"""
+
+    def __init__(self, max_workers=8, provider_limits=None):
+        self.max_workers = max_workers
+        self.provider_limits = dict(provider_limits or {})
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-batch")
+        self._semaphores = {
+            provider: threading.BoundedSemaphore(limit)
+            for provider, limit in self.provider_limits.items() if limit > 0
+        }
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "items": 0, "failures": 0}
+
+    def _run_item(self, provider, synthesize_item, item):
+        semaphore = self._semaphores.get(provider)
+        if semaphore is None:
+            return synthesize_item(item)
+        with semaphore:
+            return synthesize_item(item)
+
+    def run(self, jobs, synthesize_item):
+        """jobs 为 (序号, 服务商, 条目) 列表；按完成顺序产出 (序号, 结果, 异常)"""
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["items"] += len(jobs)
+        futures = {
+            self._executor.submit(self._run_item, provider, synthesize_item, item): index
+            for index, provider, item in jobs
+        }
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    with self._lock:
+                        self._stats["failures"] += 1
+                    yield futures[future], None, e
+        finally:
+            # 客户端提前断开时取消尚未开始的条目
+            for future in futures:
+                future.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_workers"] = self.max_workers
+        stats["provider_limits"] = self.provider_limits
+        stats["queued"] = self._executor._work_queue.qsize()
+        return stats
+
+
+# --- 输出编码 ---
+# results 产出的每个结果为 dict，成功的条目带 "audio"（字节）和 "mimetype"；
+# summary 为 dict，在 results 迭代结束后才填好，所以只在最后输出。
+def _manifest_entry(result, **extra):
+    entry = {k: v for k, v in result.items() if k != "audio"}
+    entry.update(extra)
+    return entry
+
+
+def iter_json(results, summary):
+    """JSON 清单：{"results": [...], "summary": {...}}，每完成一条就输出一条"""
+    yield '{"results": ['
+    first = True
+    for result in results:
+        separator = "" if first else ", "
+        first = False
+        entry = json.dumps(_manifest_entry(result), ensure_ascii=False)
+        if result.get("audio") is None:
+            yield separator + entry
+            continue
+        # audio_base64 放在最前，边编码边输出，不生成整段 base64 字符串
+        yield separator + '{"audio_base64": "'
+        yield from audio.iter_base64([result["audio"]])
+        yield '", ' + entry[1:]
+    yield '], "summary": ' + json.dumps(summary, ensure_ascii=False) + '}'
+
+
+def multipart_boundary():
+    return "tts-batch-" + uuid.uuid4().hex
+
+
+def iter_multipart(results, summary, boundary):
+    """multipart/mixed 流：每个条目一个部分（失败的条目为 JSON），最后一部分为汇总"""
+    def part(headers, body):
+        head = "".join(f"{name}: {value}\r\n" for name, value in headers)
+        return f"--{boundary}\r\n{head}\r\n".encode("utf-8") + body + b"\r\n"
+
+    for result in results:
+        headers = [("X-Item-Index", result["index"])]
+        if result.get("id") is not None:
+            headers.append(("X-Item-Id", result["id"]))
+        if result.get("audio") is not None:
+            filename = f"{result['index']:03d}.{file_extension(result['mimetype'])}"
+            headers = [
+                ("Content-Type", result["mimetype"]),
+                ("Content-Disposition", f'attachment; filename="{filename}"'),
+            ] + headers
+            yield part(headers, result["audio"])
+        else:
+            body = json.dumps(_manifest_entry(result), ensure_ascii=False).encode("utf-8")
+            yield part([("Content-Type", "application/json")] + headers, body)
+    body = json.dumps(summary, ensure_ascii=False).encode("utf-8")
+    yield part([("Content-Type", "application/json"), ("X-Batch-Summary", "1")], body)
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+
+class _StreamBuffer:
+    """只写、不可 seek 的缓冲区，zipfile 写入后由生成器取走已写出的字节"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def iter_zip(results, summary):
+    """流式 ZIP：音频按完成顺序写入（不压缩），最后写入 manifest.json"""
+    buffer = _StreamBuffer()
+    manifest = []
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for result in results:
+            extra = {}
+            if result.get("audio") is not None:
+                extra["filename"] = f"{result['index']:03d}.{file_extension(result['mimetype'])}"
+                archive.writestr(extra["filename"], result["audio"])
+            manifest.append(_manifest_entry(result, **extra))
+            data = buffer.take()
+            if data:
+                yield data
+        archive.writestr(
+            "manifest.json",
+            json.dumps({"results": manifest, "summary": summary}, ensure_ascii=False, indent=2),
+        )
+    yield buffer.take()
@@ -0,0 +1,580 @@
+"""网关自身开销的基准测试。
+
+在进程内启动模拟的 OpenAI / Gemini（代理端点）服务，延迟为 0 或固定值，用 Flask 测试客户端
+调用 app_production，测量网关在上游之外增加的耗时：API密钥认证、用量记录、WAV 组装、
+base64 编码、代理请求格式回退，以及完整的合成请求。与 api_usage 表大小相关的项目按
+--rows 指定的每个行数分别测量。结果以 JSON 输出，可用 --compare 与之前版本的结果对比。
+
+    python benchmark.py --rows 10000,100000,1000000 --output bench.json
+    python benchmark.py --compare bench.json
+    python benchmark.py --rows 10000 --concurrency 1000   # ASGI 模式与线程池模式的高并发对比
+
+数据库、缓存等都在临时目录中创建，不影响现有数据。
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# 1 秒 24kHz 16-bit 单声道 PCM，与 Gemini TTS 的输出参数相同
+PCM_SECOND = b"\x01\x00" * 24000
+# 模拟的 MP3 响应（只需文件头可被识别）
+FAKE_MP3 = b"ID3" + b"\x00" * 16 * 1024
+
+DEFAULT_ROWS = "10000,100000,1000000"
+SEED_BATCH_ROWS = 1000000
+
+
+# --- 模拟上游 ---
+class FakeUpstream:
+    """模拟 OpenAI /v1/audio/speech 和 Gemini 代理的 generateContent（asyncio 实现，可同时挂起上千个请求）
+
+    latency 为每个请求的固定延迟（秒）；reject_dialects 为代理拒绝的请求格式数，
+    依次拒绝 standard、alternative，用于测量请求格式回退的开销。
+    """
+
+    latency = 0.0
+    reject_dialects = 0
+    in_flight = 0
+    peak_in_flight = 0
+    gemini_body = json.dumps({
+        "candidates": [{"content": {"parts": [{"inlineData": {
+            "mimeType": "audio/L16;codec=pcm;rate=24000",
+            "data": base64.b64encode(PCM_SECOND * 2).decode(),
+        }}]}}]
+    }).encode()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+        self.stopped = threading.Event()
+        ready = threading.Event()
+        threading.Thread(target=self._serve, args=(ready,), name="bench-upstream", daemon=True).start()
+        ready.wait()
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def _serve(self, ready):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=4096)
+        )
+        self.port = server.sockets[0].getsockname()[1]
+        ready.set()
+        self.loop.run_forever()
+        # 关闭监听、取消仍在等待的连接，再关闭事件循环
+        server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        self.stopped.set()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.wait(5)
+
+    @staticmethod
+    def _dialect_index(payload):
+        config = payload.get("generationConfig", {})
+        if "speech_config" in config:
+            return 0
+        if "candidateCount" in config:
+            return 1
+        return 2
+
+    def _route(self, path, payload):
+        if path.endswith("/audio/speech"):
+            return 200, "audio/mpeg", FAKE_MP3
+        if ":generateContent" in path:
+            if self._dialect_index(payload) < FakeUpstream.reject_dialects:
+                return 400, "application/json", b'{"error": {"message": "Unsupported payload"}}'
+            return 200, "application/json", self.gemini_body
+        return 404, "application/json", b"{}"
+
+    async def _handle(self, reader, writer):
+        # 只实现带 Content-Length 的 HTTP/1.1 keep-alive 请求
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {k.strip().lower(): v.strip() for k, v in (l.split(":", 1) for l in lines[1:] if l)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                FakeUpstream.in_flight += 1
+                FakeUpstream.peak_in_flight = max(FakeUpstream.peak_in_flight, FakeUpstream.in_flight)
+                try:
+                    if FakeUpstream.latency:
+                        await asyncio.sleep(FakeUpstream.latency)
+                    status, content_type, out = self._route(path, json.loads(body or b"{}"))
+                finally:
+                    FakeUpstream.in_flight -= 1
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\nContent-Length: {len(out)}\r\n\r\n".encode()
+                    + out
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def start_fake_upstream(latency):
+    FakeUpstream.latency = latency
+    server = FakeUpstream()
+    return server, server.url
+
+
+# --- 测量 ---
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def summarize(name, rows, samples, **extra):
+    ms = sorted(s * 1000 for s in samples)
+    quantiles = statistics.quantiles(ms, n=100, method="inclusive") if len(ms) > 1 else ms * 99
+    result = {
+        "name": name,
+        "rows": rows,
+        "iterations": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 4),
+        "p50_ms": round(quantiles[49], 4),
+        "p95_ms": round(quantiles[94], 4),
+        "p99_ms": round(quantiles[98], 4),
+        "min_ms": round(ms[0], 4),
+        "max_ms": round(ms[-1], 4),
+        "ops_per_sec": round(len(ms) / (sum(ms) / 1000), 1) if sum(ms) else None,
+    }
+    result.update(extra)
+    return result
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class Bench:
+    def __init__(self, app_module, upstream_url, iterations, warmup):
+        self.m = app_module
+        self.upstream_url = upstream_url
+        self.iterations = iterations
+        self.warmup = warmup
+        self.results = []
+        self.client = app_module.app.test_client()
+
+    def run(self, name, fn, rows=None, iterations=None, **extra):
+        samples = measure(fn, iterations or self.iterations, self.warmup)
+        result = summarize(name, rows, samples, **extra)
+        self.results.append(result)
+        log(f"  {name:<32} rows={rows!s:<9} p50={result['p50_ms']:.3f}ms p95={result['p95_ms']:.3f}ms")
+        return result
+
+    # --- 准备数据 ---
+    def setup(self):
+        m = self.m
+        with contextlib.redirect_stdout(sys.stderr):
+            m.init_db()
+        self.client.post("/api/login", json={"username": "admin", "password": "admin"})
+        self.client.post("/api/settings", json={
+            "service_name": "openai", "api_key": "bench", "api_endpoint": f"{self.upstream_url}/v1",
+            "model_name": "tts-1",
+        })
+        self.client.post("/api/settings", json={
+            "service_name": "gemini", "api_key": "bench", "api_endpoint": self.upstream_url,
+            "model_name": "gemini-2.5-flash-preview-tts",
+        })
+        self.api_key = self.client.post("/api/keys", json={"key_name": "bench"}).get_json()["api_key"]
+        other_key = self.client.post("/api/keys", json={"key_name": "bench-background"}).get_json()["api_key"]
+        db = m.database.connect(m.DATABASE)
+        # 基准测试的请求数远超默认的每日限额
+        db.execute("UPDATE api_keys SET daily_limit = 1000000000")
+        db.commit()
+        self.key_id = db.execute("SELECT id FROM api_keys WHERE api_key = ?", (self.api_key,)).fetchone()[0]
+        self.other_key_id = db.execute("SELECT id FROM api_keys WHERE api_key = ?", (other_key,)).fetchone()[0]
+        db.close()
+        m.api_key_cache.invalidate()
+        self.headers = {"Authorization": f"Bearer {self.api_key}"}
+
+    def seed_usage(self, target_rows):
+        """把 api_usage 补足到 target_rows 行：十分之一属于被测密钥，时间分布在最近 90 天"""
+        db = self.m.database.connect(self.m.DATABASE)
+        current = db.execute("SELECT COUNT(*) FROM api_usage").fetchone()[0]
+        started = time.perf_counter()
+        while current < target_rows:
+            count = min(target_rows - current, SEED_BATCH_ROWS)
+            db.execute(
+                """
+                WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < ?)
+                INSERT INTO api_usage (api_key_id, provider, model, voice, text_length, audio_duration,
+                                       success, error_message, cached, created_at)
+                SELECT CASE WHEN n % 10 = 0 THEN ? ELSE ? END,
+                       CASE WHEN n % 3 = 0 THEN 'gemini' ELSE 'openai' END,
+                       CASE WHEN n % 3 = 0 THEN 'gemini-2.5-flash-preview-tts' ELSE 'tts-1' END,
+                       'alloy', 20 + n % 200, 0.5, n % 50 != 0, NULL, n % 4 = 0,
+                       datetime('now', '-' || (n % 129600) || ' minutes')
+                FROM seq
+                """,
+                (count, self.key_id, self.other_key_id),
+            )
+            db.commit()
+            current += count
+        db.close()
+        log(f"api_usage rows: {current} (seeded in {time.perf_counter() - started:.1f}s)")
+        return current
+
+    # --- 与表大小无关的项目 ---
+    def bench_audio(self):
+        m = self.m
+        for seconds in (1, 10, 60):
+            pcm = PCM_SECOND * seconds
+
+            def assemble():
+                response = m.build_audio_response(pcm)
+                for _ in response.response:
+                    pass
+
+            self.run(f"wav_assembly.{seconds}s", assemble, bytes=len(pcm))
+
+            def stream_base64():
+                for _ in m.audio.iter_base64(m.audio.wav_chunks(pcm)):
+                    pass
+
+            def oneshot_base64():
+                base64.b64encode(b"".join(m.audio.wav_chunks(pcm)))
+
+            self.run(f"base64.stream.{seconds}s", stream_base64, bytes=len(pcm))
+            self.run(f"base64.oneshot.{seconds}s", oneshot_base64, bytes=len(pcm))
+
+    def bench_baseline(self):
+        """不经过网关直接请求模拟上游，作为计算网关开销的基准"""
+        import requests
+
+        session = requests.Session()
+        payload = self.m.proxy_dialects.build_payload("standard", "benchmark text", "Kore")
+        gemini_url = f"{self.upstream_url}/v1beta/models/gemini-2.5-flash-preview-tts:generateContent"
+        self.baseline = {
+            "gemini": self.run(
+                "baseline.gemini_proxy", lambda: session.post(gemini_url, json=payload).content
+            )["p50_ms"],
+            "openai": self.run(
+                "baseline.openai",
+                lambda: session.post(f"{self.upstream_url}/v1/audio/speech", json={"input": "benchmark text"}).content,
+            )["p50_ms"],
+        }
+
+    # --- 与表大小相关的项目 ---
+    def bench_auth(self, rows):
+        m = self.m
+
+        def authenticate():
+            with m.app.test_request_context("/api/v1/health", headers=self.headers):
+                assert m.authenticate_api_key() is None
+
+        self.run("api_key_required.cached", authenticate, rows)
+        cache = m.api_key_cache
+        m.api_key_cache = m.ApiKeyCache(ttl=0, negative_ttl=0)
+        try:
+            self.run("api_key_required.uncached", authenticate, rows)
+        finally:
+            m.api_key_cache = cache
+        self.run(
+            "request.health",
+            lambda: self.client.get("/api/v1/health", headers=self.headers).close(),
+            rows,
+        )
+
+    def bench_usage(self, rows):
+        m = self.m
+
+        def log_usage():
+            m.log_api_usage(self.key_id, "openai", "tts-1", "alloy", 42, 0.1)
+
+        self.run("log_api_usage.submit", log_usage, rows)
+
+        def log_and_flush():
+            for _ in range(100):
+                log_usage()
+            m.usage_writer.flush(timeout=30)
+
+        result = self.run("log_api_usage.persist_x100", log_and_flush, rows, iterations=max(self.iterations // 10, 5))
+        result["per_row_ms"] = round(result["p50_ms"] / 100, 4)
+        self.run(
+            "request.usage",
+            lambda: self.client.get("/api/v1/usage", headers=self.headers).close(),
+            rows,
+            iterations=max(self.iterations // 10, 5),
+        )
+
+    def synthesize(self, provider, **extra):
+        body = dict({"text": "benchmark text", "provider": provider, "voice": "Kore" if provider == "gemini" else "alloy"}, **extra)
+
+        def call():
+            response = self.client.post("/api/v1/tts/synthesize", json=body, headers=self.headers)
+            assert response.status_code == 200, response.get_data(as_text=True)[:200]
+            response.get_data()
+            response.close()
+
+        return call
+
+    def bench_synthesize(self, rows):
+        m = self.m
+        for provider in ("openai", "gemini"):
+            result = self.run(f"synthesize.{provider}", self.synthesize(provider), rows)
+            result["overhead_ms"] = round(result["p50_ms"] - self.baseline[provider], 4)
+        result = self.run("synthesize.gemini.base64", self.synthesize("gemini", return_base64=True), rows)
+        result["overhead_ms"] = round(result["p50_ms"] - self.baseline["gemini"], 4)
+
+        # 代理拒绝前 N 种请求格式；每次换新的格式记忆，测量完整的回退过程
+        memory = m.proxy_payload_dialects
+        try:
+            for rejected in (1, 2):
+                FakeUpstream.reject_dialects = rejected
+
+                def fallback():
+                    m.proxy_payload_dialects = m.proxy_dialects.DialectMemory()
+                    self.synthesize("gemini")()
+
+                result = self.run(f"proxy_fallback.reject{rejected}", fallback, rows)
+                result["overhead_ms"] = round(result["p50_ms"] - self.baseline["gemini"], 4)
+            # 记住可用格式之后的稳定状态
+            m.proxy_payload_dialects = m.proxy_dialects.DialectMemory()
+            result = self.run("proxy_fallback.remembered", self.synthesize("gemini"), rows)
+            result["overhead_ms"] = round(result["p50_ms"] - self.baseline["gemini"], 4)
+        finally:
+            FakeUpstream.reject_dialects = 0
+            m.proxy_payload_dialects = memory
+
+    def check_offline(self):
+        """所有 Gemini 请求都应由模拟代理处理，没有发往官方 API 的请求"""
+        for scope in self.m.gemini_hedger.stats()["endpoints"]:
+            direct = scope["paths"].get("direct", {}).get("calls", 0)
+            assert direct == 0, f"{direct} Gemini calls went to the real API instead of the fake upstream"
+
+    # --- 高并发：ASGI 模式与线程池模式对比 ---
+    def bench_concurrency(self, concurrency, latency):
+        """concurrency 个合成请求同时到达、上游延迟为 latency 秒时的总耗时和吞吐
+
+        ASGI 模式等待上游时不占用线程，同时等待的请求数只受 TTS_ASGI_MAX_UPSTREAM 限制；
+        线程池模式（同样的线程数）同时处理的请求数受线程数和同步客户端连接池（TTS_CLIENT_POOL_SIZE）限制。
+        每个请求的文本各不相同，不会被合并；coalesced 为线程池模式下所有请求文本相同、合并为一次上游调用。
+        """
+        import itertools
+        from concurrent.futures import ThreadPoolExecutor
+
+        import asgi
+
+        sequence = itertools.count()
+
+        def request_body():
+            text = "benchmark text" if same_text else f"benchmark text {next(sequence)}"
+            return json.dumps({"text": text, "provider": "openai", "voice": "alloy"}).encode()
+
+        headers = [(b"authorization", self.headers["Authorization"].encode()), (b"content-type", b"application/json")]
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+            "path": "/api/v1/tts/synthesize", "query_string": b"", "root_path": "", "headers": headers,
+            "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80),
+        }
+
+        async def asgi_call():
+            started = time.perf_counter()
+            body = request_body()
+            received = []
+            status = {}
+
+            async def receive():
+                if not received:
+                    received.append(True)
+                    return {"type": "http.request", "body": body, "more_body": False}
+                await asyncio.Event().wait()
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    status["code"] = message["status"]
+
+            await asgi.application(scope, receive, send)
+            statuses.append(status.get("code"))
+            assert status.get("code") in (200, 503), status
+            return time.perf_counter() - started
+
+        async def asgi_burst():
+            return await asyncio.gather(*(asgi_call() for _ in range(concurrency)))
+
+        def wsgi_call():
+            started = time.perf_counter()
+            response = self.client.post("/api/v1/tts/synthesize", data=request_body(), headers=dict(
+                self.headers, **{"Content-Type": "application/json"}
+            ))
+            statuses.append(response.status_code)
+            assert response.status_code in (200, 503), response.get_data(as_text=True)[:200]
+            response.get_data()
+            response.close()
+            return time.perf_counter() - started
+
+        def wsgi_burst():
+            with ThreadPoolExecutor(max_workers=asgi.THREADS) as pool:
+                return list(pool.map(lambda _: wsgi_call(), range(concurrency)))
+
+        modes = (
+            ("asgi", False, lambda: asyncio.run(asgi_burst())),
+            ("threads", False, wsgi_burst),
+            ("coalesced", True, wsgi_burst),
+        )
+        previous = FakeUpstream.latency
+        FakeUpstream.latency = latency
+        try:
+            for mode, same_text, burst in modes:
+                statuses = []
+                FakeUpstream.peak_in_flight = 0
+                started = time.perf_counter()
+                samples = burst()
+                wall = time.perf_counter() - started
+                result = summarize(
+                    f"concurrency.{mode}", None, samples,
+                    concurrency=concurrency,
+                    upstream_latency_ms=latency * 1000,
+                    threads=asgi.THREADS,
+                    max_upstream=asgi.MAX_UPSTREAM,
+                    wall_s=round(wall, 3),
+                    throughput_rps=round(concurrency / wall, 1),
+                    peak_upstream_in_flight=FakeUpstream.peak_in_flight,
+                    # 被准入控制拒绝（503）的请求数
+                    rejected=statuses.count(503),
+                )
+                self.results.append(result)
+                log(f"  {result['name']:<32} n={concurrency:<6} wall={wall:.2f}s "
+                    f"rps={result['throughput_rps']:<8} p95={result['p95_ms']:.0f}ms "
+                    f"peak_upstream={FakeUpstream.peak_in_flight} rejected={result['rejected']}")
+        finally:
+            FakeUpstream.latency = previous
+
+
+def git_revision(path):
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=path, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline_path, tolerance):
+    """与之前的结果对比 p50，返回变慢超过 tolerance 的项目"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["name"], r["rows"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        old = baseline.get((result["name"], result["rows"]))
+        if not old or not old["p50_ms"]:
+            continue
+        change = result["p50_ms"] / old["p50_ms"] - 1
+        result["baseline_p50_ms"] = old["p50_ms"]
+        result["change"] = round(change, 4)
+        if change > tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the gateway's own per-request overhead")
+    parser.add_argument("--rows", default=DEFAULT_ROWS,
+                        help=f"comma-separated api_usage table sizes (default {DEFAULT_ROWS}, up to 10000000)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fixed latency of the fake upstreams")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="also fire this many simultaneous synthesize requests through asgi.py and "
+                             "through a thread pool of the same size (default 0 = skip)")
+    parser.add_argument("--concurrency-latency-ms", type=float, default=500.0,
+                        help="fake upstream latency for the --concurrency test (default 500)")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50 slowdown versus --compare before failing (default 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    row_counts = sorted(int(r) for r in args.rows.split(",") if r.strip())
+
+    workdir = tempfile.mkdtemp(prefix="tts-bench-")
+    # 导入应用前设置环境：临时数据库、关闭合成缓存（否则测量的是缓存命中）、Gemini 不转码、
+    # Gemini 只走模拟代理（对冲模式会向真实的官方 API 发出请求）
+    os.environ.update({
+        "DATABASE_PATH": os.path.join(workdir, "bench.db"),
+        "TTS_CACHE_ENABLED": "0",
+        "TTS_TRANSCODER": "none",
+        "GEMINI_HEDGE_MODE": "fallback",
+        "TTS_JOB_RESULT_DIR": os.path.join(workdir, "jobs"),
+    })
+    os.environ.setdefault("TTS_LOG_LEVEL", "WARNING")
+    os.environ.pop("TTS_METRICS_DIR", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app_production
+
+    server, upstream_url = start_fake_upstream(args.latency_ms / 1000)
+    bench = Bench(app_production, upstream_url, args.iterations, args.warmup)
+    try:
+        bench.setup()
+        log("audio:")
+        bench.bench_audio()
+        log("baseline:")
+        bench.bench_baseline()
+        for rows in row_counts:
+            bench.seed_usage(rows)
+            bench.bench_auth(rows)
+            bench.bench_usage(rows)
+            bench.bench_synthesize(rows)
+        if args.concurrency:
+            log("concurrency:")
+            bench.bench_concurrency(args.concurrency, args.concurrency_latency_ms / 1000)
+        bench.check_offline()
+    finally:
+        server.shutdown()
+        app_production.usage_writer.close(timeout=5)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(os.path.dirname(os.path.abspath(__file__))),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "rows": row_counts,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "upstream_latency_ms": args.latency_ms,
+            "concurrency": args.concurrency,
+        },
+        "results": bench.results,
+    }
+    regressions = compare(bench.results, args.compare, args.tolerance) if args.compare else []
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for result in regressions:
+        log(f"REGRESSION {result['name']} rows={result['rows']}: "
+            f"p50 {result['baseline_p50_ms']}ms -> {result['p50_ms']}ms ({result['change']:+.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
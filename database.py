@@ -0,0 +1,166 @@
+"""SQLite 连接管理：每个工作线程复用长连接，统一设置 PRAGMA 并统计语句耗时。"""
+import os
+import sqlite3
+import threading
+import time
+
+
+class QueryStats:
+    """按 SQL 语句汇总执行次数和耗时，同时累计每个线程的数据库时间"""
+
+    def __init__(self, max_statements=200):
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._statements = {}  # sql -> [count, total_ms, max_ms]
+        self._local = threading.local()
+        self.total_count = 0
+        self.total_ms = 0.0
+
+    def record(self, sql, elapsed):
+        elapsed_ms = elapsed * 1000
+        key = " ".join(sql.split())[:200]
+        with self._lock:
+            self.total_count += 1
+            self.total_ms += elapsed_ms
+            item = self._statements.get(key)
+            if item is None:
+                if len(self._statements) >= self.max_statements:
+                    key = "<other>"
+                    item = self._statements.get(key)
+                if item is None:
+                    item = self._statements[key] = [0, 0.0, 0.0]
+            item[0] += 1
+            item[1] += elapsed_ms
+            item[2] = max(item[2], elapsed_ms)
+        self._local.elapsed = getattr(self._local, "elapsed", 0.0) + elapsed
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def reset_thread(self):
+        """请求开始时清零当前线程的累计值"""
+        self._local.elapsed = 0.0
+        self._local.count = 0
+
+    def thread_totals(self):
+        """返回当前线程自上次清零以来的 (语句数, 耗时秒数)"""
+        return getattr(self._local, "count", 0), getattr(self._local, "elapsed", 0.0)
+
+    def snapshot(self, top=20):
+        """返回总计以及按总耗时排序的前 top 条语句"""
+        with self._lock:
+            items = sorted(self._statements.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+            return {
+                "statements": self.total_count,
+                "total_ms": round(self.total_ms, 3),
+                "queries": [
+                    {
+                        "sql": sql,
+                        "count": count,
+                        "total_ms": round(total_ms, 3),
+                        "avg_ms": round(total_ms / count, 4) if count else 0.0,
+                        "max_ms": round(max_ms, 3),
+                    }
+                    for sql, (count, total_ms, max_ms) in items
+                ],
+            }
+
+
+query_stats = QueryStats()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_stats.record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_stats.record(sql, time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """记录每条语句耗时的连接（Connection.execute 不经过 cursor()，需单独覆盖）"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            query_stats.record("COMMIT", time.perf_counter() - started)
+
+
+def pragma_settings():
+    """从环境变量读取 PRAGMA 配置"""
+    return {
+        "journal_mode": os.environ.get("TTS_SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("TTS_SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": int(os.environ.get("TTS_SQLITE_BUSY_TIMEOUT_MS", 5000)),
+        "mmap_size": int(os.environ.get("TTS_SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+        "cache_size": int(os.environ.get("TTS_SQLITE_CACHE_SIZE", -64000)),  # 负数单位为 KiB
+        "temp_store": os.environ.get("TTS_SQLITE_TEMP_STORE", "MEMORY"),
+    }
+
+
+def connect(path, detect_types=0, pragmas=None):
+    """打开一个应用了调优 PRAGMA 的连接"""
+    pragmas = pragmas or pragma_settings()
+    db = sqlite3.connect(
+        path,
+        timeout=pragmas["busy_timeout"] / 1000,
+        detect_types=detect_types,
+        factory=InstrumentedConnection,
+    )
+    db.row_factory = sqlite3.Row
+    for name in ("journal_mode", "synchronous", "busy_timeout", "mmap_size", "cache_size", "temp_store"):
+        db.execute(f"PRAGMA {name} = {pragmas[name]}")
+    return db
+
+
+class ConnectionManager:
+    """为每个线程保留一个长连接；fork 后的子进程会重新建立连接"""
+
+    def __init__(self, path, detect_types=0):
+        self.path = path
+        self.detect_types = detect_types
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def get(self):
+        """返回当前线程的连接，不存在（或已在其他进程中创建）时新建"""
+        db = getattr(self._local, "db", None)
+        if db is not None and self._local.pid == os.getpid():
+            return db
+        db = connect(self.path, detect_types=self.detect_types)
+        self._local.db = db
+        self._local.pid = os.getpid()
+        with self._lock:
+            self._opened += 1
+        return db
+
+    def release(self, db):
+        """请求结束时调用：回滚未提交的事务，连接保留给本线程后续复用"""
+        if db.in_transaction:
+            db.rollback()
+
+    def stats(self):
+        with self._lock:
+            opened = self._opened
+        stats = query_stats.snapshot()
+        stats["connections_opened"] = opened
+        stats["pragmas"] = pragma_settings()
+        return stats
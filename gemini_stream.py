@@ -0,0 +1,147 @@
+"""Gemini 流式合成：边生成边转发 PCM 音频，首包延迟与文本长度无关。"""
+import base64
+import json
+import re
+
+import audio
+import proxy_dialects
+
+
+def parse_audio_mime(mime_type):
+    """解析 "audio/L16;codec=pcm;rate=24000" 形式的 MIME，返回 (采样率, 声道数, 位深)"""
+    sample_rate, channels, bits_per_sample = audio.DEFAULT_SAMPLE_RATE, 1, 16
+    if mime_type:
+        match = re.search(r"rate=(\d+)", mime_type)
+        if match:
+            sample_rate = int(match.group(1))
+        match = re.search(r"channels=(\d+)", mime_type)
+        if match:
+            channels = int(match.group(1))
+        match = re.search(r"audio/L(\d+)", mime_type, re.IGNORECASE)
+        if match:
+            bits_per_sample = int(match.group(1))
+    return sample_rate, channels, bits_per_sample
+
+
+def is_pcm_mime(mime_type):
+    """Gemini 返回的原始 PCM 没有容器头，MIME 为 audio/L16 或 audio/pcm"""
+    if not mime_type:
+        return True
+    mime_type = mime_type.lower()
+    return mime_type.startswith("audio/l16") or "pcm" in mime_type
+
+
+def iter_sdk_audio(client, model, text, voice):
+    """通过官方 SDK 的流式接口生成音频，逐块产出 (mime_type, 音频字节)"""
+    from google.genai import types
+
+    stream = client.models.generate_content_stream(
+        model=model,
+        contents=text,
+        config=types.GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=types.SpeechConfig(
+                voice_config=types.VoiceConfig(
+                    prebuilt_voice_config=types.PrebuiltVoiceConfig(voice_name=voice)
+                )
+            ),
+        ),
+    )
+    for chunk in stream:
+        for candidate in chunk.candidates or []:
+            if not candidate.content or not candidate.content.parts:
+                continue
+            for part in candidate.content.parts:
+                inline_data = getattr(part, "inline_data", None)
+                if inline_data is None or not inline_data.data:
+                    continue
+                data = inline_data.data
+                if isinstance(data, str):
+                    data = base64.b64decode(data)
+                yield inline_data.mime_type, data
+
+
+def iter_proxy_audio(proxy_sessions, dialects, endpoint, api_key, model, text, voice):
+    """通过代理的 streamGenerateContent（SSE）接口生成音频，逐块产出 (mime_type, 音频字节)
+
+    请求格式与非流式请求共用 dialects 中记住的代理方言。
+    """
+    url = f"{endpoint.rstrip('/')}/v1beta/models/{model}:streamGenerateContent?alt=sse"
+    headers = {
+        'Content-Type': 'application/json',
+        'x-goog-api-key': api_key,
+    }
+    response = proxy_dialects.post(
+        proxy_sessions, dialects, url, endpoint, model, headers, text, voice, stream=True
+    )
+    try:
+        if response.status_code != 200:
+            raise Exception(
+                f"Proxy stream request failed with status {response.status_code}: {response.text[:500]}"
+            )
+        for line in response.iter_lines(chunk_size=8192):
+            if not line.startswith(b"data:"):
+                continue
+            event = json.loads(line[5:])
+            for candidate in event.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    inline_data = part.get("inlineData") or part.get("inline_data")
+                    if inline_data and inline_data.get("data"):
+                        mime_type = inline_data.get("mimeType") or inline_data.get("mime_type")
+                        yield mime_type, base64.b64decode(inline_data["data"])
+    finally:
+        response.close()
+
+
+class GeminiAudioStream:
+    """把上游音频块整理为可直接作为响应体的流
+
+    构造时先取到第一块：既能确定采样率，也让鉴权失败等早期错误在响应开始前抛出。
+    container 为 "wav" 时先输出开放长度的 WAV 头部，为 "pcm" 时输出裸 PCM
+    （采样参数放在响应头中）。上游返回的不是 PCM 时按原格式转发。
+    on_complete(chunks, mimetype) 在流正常结束后以完整音频（带准确长度的头部）回调，用于写入缓存。
+    """
+
+    def __init__(self, chunks, container="wav", on_complete=None):
+        self._chunks = iter(chunks)
+        self.container = container
+        self.on_complete = on_complete
+        first = next(self._chunks, None)
+        if first is None:
+            raise Exception("No audio data in Gemini stream")
+        self._first_mime, self._first = first
+        self.raw = not is_pcm_mime(self._first_mime)
+        self.sample_rate, self.channels, self.bits_per_sample = parse_audio_mime(self._first_mime)
+
+    @property
+    def mimetype(self):
+        if self.raw:
+            return self._first_mime
+        if self.container == "pcm":
+            return f"audio/L{self.bits_per_sample};rate={self.sample_rate};channels={self.channels}"
+        return "audio/wav"
+
+    def headers(self):
+        if self.raw:
+            return {}
+        return {
+            "X-Audio-Sample-Rate": str(self.sample_rate),
+            "X-Audio-Channels": str(self.channels),
+            "X-Audio-Bits-Per-Sample": str(self.bits_per_sample),
+        }
+
+    def __iter__(self):
+        parts = [self._first]
+        if not self.raw and self.container == "wav":
+            yield audio.wav_header(audio.STREAMING_SIZE, self.sample_rate, self.channels, self.bits_per_sample)
+        yield self._first
+        for _, data in self._chunks:
+            parts.append(data)
+            yield data
+        if self.on_complete is not None:
+            if not self.raw and self.container == "wav":
+                header = audio.wav_header(
+                    audio.chunks_size(parts), self.sample_rate, self.channels, self.bits_per_sample
+                )
+                parts.insert(0, header)
+            self.on_complete(parts, self.mimetype)
@@ -0,0 +1,326 @@
+"""Gemini 自定义端点（代理）与官方 API 之间的对冲请求。
+
+主路径（默认为代理）超过其近期耗时的某个百分位（如 p95）仍未返回时，同时向另一路径发出相同的
+请求，采用先成功返回的结果；主路径出错时立即改用另一路径，不必等完代理的多次重试。
+因慢而发出的重复请求受两个上限约束：同时进行的对冲请求数，以及对冲请求占全部请求的比例（预算）。
+同步调用中没被采用的一方在后台执行完后丢弃结果，异步调用中直接取消。
+
+模式：hedge（按百分位延迟对冲）、parallel（两条路径同时发出，不消耗预算，只受同时进行的
+对冲请求数上限约束，超出上限的请求只走主路径）、fallback（原来的顺序回退：主路径失败后才调用另一路径）。
+"""
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+MODES = ("hedge", "parallel", "fallback")
+
+
+class _Scope:
+    """单个端点的各路径近期耗时和计数"""
+
+    def __init__(self, endpoint, window):
+        self.endpoint = endpoint
+        self.window = window
+        self.latencies = {}  # 路径 -> 近期成功调用的耗时（秒）
+        self.paths = {}  # 路径 -> 计数
+        self.stats = {"requests": 0, "hedged": 0, "fallbacks": 0, "denied": 0}
+
+    def path(self, name):
+        counts = self.paths.get(name)
+        if counts is None:
+            counts = self.paths[name] = {"calls": 0, "errors": 0, "wins": 0, "hedge_wins": 0}
+            self.latencies[name] = deque(maxlen=self.window)
+        return counts
+
+
+def _percentile(samples, percentile):
+    ordered = sorted(samples)
+    return ordered[min(max(math.ceil(percentile / 100 * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+class Hedger:
+    """按端点记录各路径耗时并决定何时发出对冲请求；路径以 (名称, 函数) 传入"""
+
+    def __init__(self, mode="hedge", percentile=95, delay=8.0, min_samples=20, window=200,
+                 max_inflight=8, budget=0.1, threads=64, metrics_registry=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown hedge mode: {mode}")
+        self.mode = mode
+        self.percentile = percentile
+        self.delay = delay
+        self.min_samples = min_samples
+        self.window = window
+        self.max_inflight = max_inflight
+        self.budget = budget
+        self.threads = threads
+
+        self._lock = threading.Lock()
+        self._scopes = {}
+        self._tokens = 1.0  # 预算：每个请求积累 budget，发出一次对冲消耗 1
+        self._inflight = 0
+        self._executor = None
+        self._pid = os.getpid()
+        self._metrics = None
+        if metrics_registry is not None:
+            self._metrics = {
+                "requests": metrics_registry.counter(
+                    "tts_hedge_requests_total", "Gemini requests eligible for proxy/direct hedging", ("endpoint",)
+                ),
+                "alternate": metrics_registry.counter(
+                    "tts_hedge_alternate_total",
+                    "Calls sent to the alternate Gemini path, by trigger (slow primary or primary error)",
+                    ("endpoint", "trigger"),
+                ),
+                "wins": metrics_registry.counter(
+                    "tts_hedge_wins_total", "Gemini requests answered by each path", ("endpoint", "path")
+                ),
+                "errors": metrics_registry.counter(
+                    "tts_hedge_errors_total", "Failed Gemini calls by path", ("endpoint", "path")
+                ),
+            }
+
+    # --- 决策 ---
+    def _begin(self, endpoint):
+        """登记一次请求，返回该端点的 _Scope"""
+        from admission import AdmissionController
+
+        label = AdmissionController.endpoint_label(endpoint)
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 出的子进程不继承父进程的线程池和进行中的对冲请求
+                self._pid = os.getpid()
+                self._executor = None
+                self._inflight = 0
+            scope = self._scopes.get(label)
+            if scope is None:
+                scope = self._scopes[label] = _Scope(label, self.window)
+            scope.stats["requests"] += 1
+            self._tokens = min(self._tokens + self.budget, max(self.budget * 100, 1.0))
+        self._count("requests", endpoint=label)
+        return scope
+
+    def threshold(self, scope, path):
+        """主路径的对冲等待时间：近期样本足够时取其百分位，否则取默认延迟"""
+        if self.mode == "parallel":
+            return 0.0
+        with self._lock:
+            samples = list(scope.latencies.get(path, ()))
+        if len(samples) < self.min_samples:
+            return self.delay
+        return _percentile(samples, self.percentile)
+
+    def _admit_hedge(self, scope):
+        # parallel 模式每个请求都同时发出两条路径，按比例的预算不适用
+        budgeted = self.mode != "parallel"
+        with self._lock:
+            if self._inflight >= self.max_inflight or (budgeted and self._tokens < 1):
+                scope.stats["denied"] += 1
+                return False
+            if budgeted:
+                self._tokens -= 1
+            self._inflight += 1
+            scope.stats["hedged"] += 1
+        self._count("alternate", endpoint=scope.endpoint, trigger="slow")
+        return True
+
+    def _hedge_done(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def _fallback(self, scope):
+        with self._lock:
+            scope.stats["fallbacks"] += 1
+        self._count("alternate", endpoint=scope.endpoint, trigger="error")
+
+    # --- 记录 ---
+    def _finished(self, scope, path, elapsed, error):
+        with self._lock:
+            counts = scope.path(path)
+            counts["calls"] += 1
+            if error is None:
+                scope.latencies[path].append(elapsed)
+            else:
+                counts["errors"] += 1
+        if error is not None:
+            self._count("errors", endpoint=scope.endpoint, path=path)
+
+    def _won(self, scope, path, hedged):
+        with self._lock:
+            counts = scope.path(path)
+            counts["wins"] += 1
+            if hedged:
+                counts["hedge_wins"] += 1
+        self._count("wins", endpoint=scope.endpoint, path=path)
+
+    def _count(self, name, **labels):
+        if self._metrics is not None:
+            self._metrics[name].inc(**labels)
+
+    def _timed(self, scope, path, fn):
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            self._finished(scope, path, time.monotonic() - started, e)
+            raise
+        self._finished(scope, path, time.monotonic() - started, None)
+        return result
+
+    # --- 同步 ---
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="gemini-hedge")
+            return self._executor
+
+    def _submit(self, scope, path, fn):
+        context = contextvars.copy_context()
+        return self._pool().submit(context.run, self._timed, scope, path, fn)
+
+    def run(self, endpoint, primary, alternate):
+        """执行 primary=(名称, 函数)，按策略加发 alternate，返回先成功的结果；都失败时抛出最后一个异常"""
+        scope = self._begin(endpoint)
+        (primary_name, primary_fn), (alternate_name, alternate_fn) = primary, alternate
+        if self.mode == "fallback":
+            try:
+                result = self._timed(scope, primary_name, primary_fn)
+            except Exception:
+                self._fallback(scope)
+                result = self._timed(scope, alternate_name, alternate_fn)
+                self._won(scope, alternate_name, False)
+                return result
+            self._won(scope, primary_name, False)
+            return result
+
+        pending = {self._submit(scope, primary_name, primary_fn): primary_name}
+        done, _ = wait(pending, timeout=self.threshold(scope, primary_name))
+        hedged = False
+        if not done and self._admit_hedge(scope):
+            hedged = True
+            future = self._submit(scope, alternate_name, alternate_fn)
+            future.add_done_callback(lambda _: self._hedge_done())
+            pending[future] = alternate_name
+        error = None
+        started_alternate = hedged
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                if future.exception() is None:
+                    self._won(scope, path, hedged)
+                    return future.result()
+                error = future.exception()
+            if not pending and not started_alternate:
+                # 主路径出错：立即改用另一路径
+                started_alternate = True
+                self._fallback(scope)
+                pending[self._submit(scope, alternate_name, alternate_fn)] = alternate_name
+        raise error
+
+    # --- 异步 ---
+    async def run_async(self, endpoint, primary, alternate):
+        """同 run，路径函数返回协程；未被采用的一方被取消"""
+        scope = self._begin(endpoint)
+        (primary_name, primary_fn), (alternate_name, alternate_fn) = primary, alternate
+
+        async def timed(path, fn):
+            started = time.monotonic()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._finished(scope, path, time.monotonic() - started, e)
+                raise
+            self._finished(scope, path, time.monotonic() - started, None)
+            return result
+
+        if self.mode == "fallback":
+            try:
+                result = await timed(primary_name, primary_fn)
+            except Exception:
+                self._fallback(scope)
+                result = await timed(alternate_name, alternate_fn)
+                self._won(scope, alternate_name, False)
+                return result
+            self._won(scope, primary_name, False)
+            return result
+
+        pending = {asyncio.ensure_future(timed(primary_name, primary_fn)): primary_name}
+        hedged = False
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.threshold(scope, primary_name))
+            if not done and self._admit_hedge(scope):
+                hedged = True
+                task = asyncio.ensure_future(timed(alternate_name, alternate_fn))
+                task.add_done_callback(lambda _: self._hedge_done())
+                pending[task] = alternate_name
+            error = None
+            started_alternate = hedged
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path = pending.pop(task)
+                    if not task.cancelled() and task.exception() is None:
+                        self._won(scope, path, hedged)
+                        return task.result()
+                    error = task.exception() if not task.cancelled() else asyncio.CancelledError()
+                if not pending and not started_alternate:
+                    started_alternate = True
+                    self._fallback(scope)
+                    pending[asyncio.ensure_future(timed(alternate_name, alternate_fn))] = alternate_name
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            scopes = []
+            for scope in self._scopes.values():
+                requests = scope.stats["requests"]
+                hedged = scope.stats["hedged"]
+                paths = {}
+                for name, counts in scope.paths.items():
+                    samples = list(scope.latencies[name])
+                    paths[name] = dict(
+                        counts,
+                        win_rate=round(counts["wins"] / requests, 4) if requests else None,
+                        hedge_win_rate=round(counts["hedge_wins"] / hedged, 4) if hedged else None,
+                        p50_seconds=round(_percentile(samples, 50), 3) if samples else None,
+                        p95_seconds=round(_percentile(samples, 95), 3) if samples else None,
+                    )
+                scopes.append(dict(
+                    scope.stats, endpoint=scope.endpoint, paths=paths,
+                    hedge_rate=round(hedged / requests, 4) if requests else None,
+                ))
+            inflight = self._inflight
+        return {
+            "mode": self.mode,
+            "percentile": self.percentile,
+            "delay": self.delay,
+            "max_inflight": self.max_inflight,
+            "budget": self.budget,
+            "inflight": inflight,
+            "endpoints": scopes,
+        }
+
+
+def create_hedger_from_env(metrics_registry=None):
+    """根据环境变量创建 Gemini 代理/官方 API 对冲策略"""
+    return Hedger(
+        mode=os.environ.get("GEMINI_HEDGE_MODE", "hedge").lower(),
+        percentile=float(os.environ.get("GEMINI_HEDGE_PERCENTILE", 95)),
+        delay=float(os.environ.get("GEMINI_HEDGE_DELAY", 8)),
+        min_samples=int(os.environ.get("GEMINI_HEDGE_MIN_SAMPLES", 20)),
+        window=int(os.environ.get("GEMINI_HEDGE_WINDOW", 200)),
+        max_inflight=int(os.environ.get("GEMINI_HEDGE_MAX_INFLIGHT", 8)),
+        budget=float(os.environ.get("GEMINI_HEDGE_BUDGET", 0.1)),
+        threads=int(os.environ.get("GEMINI_HEDGE_THREADS", 64)),
+        metrics_registry=metrics_registry,
+    )
@@ -0,0 +1,311 @@
+"""基于 SQLite 的持久化合成任务队列。
+
+提交任务只写入一行记录并立即返回任务 ID，由本地工作线程从表中领取执行，
+结果写入磁盘，之后可随时查询和下载。任务记录在数据库中，重启后排队中的任务会继续执行；
+执行中的任务定期刷新心跳，进程退出导致心跳超过 stale_after 秒未更新的任务会重新排队。
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tts_jobs (
+    id TEXT PRIMARY KEY,
+    api_key_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    request TEXT NOT NULL,
+    quota_day TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    mimetype TEXT,
+    result_size INTEGER,
+    cached BOOLEAN DEFAULT 0,
+    error_message TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    FOREIGN KEY (api_key_id) REFERENCES api_keys (id)
+);
+-- 领取任务：按状态 + 提交时间
+CREATE INDEX IF NOT EXISTS idx_tts_jobs_status_created
+    ON tts_jobs (status, created_at);
+-- 按密钥列出任务
+CREATE INDEX IF NOT EXISTS idx_tts_jobs_key_created
+    ON tts_jobs (api_key_id, created_at)
+"""
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+logger = logging.getLogger(__name__)
+
+
+def utc_timestamp(delta_seconds=0):
+    """与 CURRENT_TIMESTAMP 相同格式的 UTC 时间"""
+    moment = datetime.now(timezone.utc) + timedelta(seconds=delta_seconds)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class JobQueue:
+    """任务队列；handler(job) 执行单个任务并返回 (mimetype, 音频字节, 是否命中缓存)
+
+    job 为 dict，包含表中各列以及解析后的 request。
+    """
+
+    def __init__(self, connect, result_dir, handler, workers=2, poll_interval=1.0,
+                 stale_after=300.0, max_attempts=3, retention=7 * 86400):
+        self.connect = connect
+        self.result_dir = result_dir
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.retention = retention
+
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = set()  # 本进程正在执行的任务 ID，由心跳线程定期刷新
+        self._pid = None
+        self._last_maintenance = 0.0
+        self._stats = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "requeued": 0, "running": 0}
+
+    # --- 请求线程使用的接口（传入请求自己的数据库连接） ---
+    def submit(self, db, api_key_id, request_data, quota_day=None):
+        """写入一条排队中的任务，返回任务 ID"""
+        job_id = uuid.uuid4().hex
+        db.execute(
+            "INSERT INTO tts_jobs (id, api_key_id, status, request, quota_day, created_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+            (job_id, api_key_id, json.dumps(request_data, ensure_ascii=False), quota_day, utc_timestamp()),
+        )
+        db.commit()
+        with self._cond:
+            self._stats["submitted"] += 1
+            self._cond.notify_all()
+        self.start()
+        return job_id
+
+    def get(self, db, job_id, api_key_id):
+        """返回任务记录（dict），不存在或不属于该密钥时返回 None"""
+        row = db.execute(
+            "SELECT * FROM tts_jobs WHERE id = ? AND api_key_id = ?", (job_id, api_key_id)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        return job
+
+    def wait(self, db, job_id, api_key_id, timeout):
+        """长轮询：等待任务结束或超时，返回最新的任务记录
+
+        本进程内的工作线程完成任务时会立即唤醒；其他进程处理的任务按 poll_interval 轮询数据库。
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(db, job_id, api_key_id)
+            if job is None or job["status"] in FINISHED_STATUSES:
+                return job
+            # 结束读事务，下一次查询才能看到其他连接提交的新状态
+            db.commit()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            with self._cond:
+                self._cond.wait(min(remaining, self.poll_interval))
+
+    def cancel(self, db, job_id, api_key_id):
+        """取消未结束的任务，返回取消前的状态（任务不存在时为 None）
+
+        执行中的任务无法中断上游请求，完成后结果会被丢弃。
+        """
+        job = self.get(db, job_id, api_key_id)
+        if job is None or job["status"] in FINISHED_STATUSES:
+            return job["status"] if job else None
+        cursor = db.execute(
+            "UPDATE tts_jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = ?",
+            (utc_timestamp(), job_id, job["status"]),
+        )
+        db.commit()
+        if cursor.rowcount != 1:
+            # 状态刚好被工作线程改变，按最新状态重新处理
+            return self.cancel(db, job_id, api_key_id)
+        with self._cond:
+            self._stats["cancelled"] += 1
+            self._cond.notify_all()
+        return job["status"]
+
+    def is_cancelled(self, db, job_id):
+        """任务是否已被取消（或已被删除），供执行中的任务在等待期间检查"""
+        row = db.execute("SELECT status FROM tts_jobs WHERE id = ?", (job_id,)).fetchone()
+        # 结束读事务，下一次查询才能看到其他连接提交的新状态
+        db.commit()
+        return row is None or row[0] == "cancelled"
+
+    def result_path(self, job_id):
+        return os.path.join(self.result_dir, job_id[:2], job_id)
+
+    # --- 工作线程 ---
+    def start(self):
+        """启动工作线程（fork 后的子进程中会重新启动）"""
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._running = set()
+            self._threads = [threading.Thread(target=self._heartbeat, name="tts-job-heartbeat", daemon=True)]
+            for index in range(self.workers):
+                self._threads.append(threading.Thread(target=self._run, name=f"tts-job-{index}", daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def _claim(self, db):
+        """原子地领取最早的排队任务并标记为执行中"""
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT * FROM tts_jobs WHERE status = 'queued' ORDER BY created_at, rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                db.rollback()
+                return None
+            db.execute(
+                "UPDATE tts_jobs SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (utc_timestamp(), utc_timestamp(), row["id"]),
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        job["attempts"] += 1
+        return job
+
+    def _finish(self, db, job_id, status, **fields):
+        """写入结束状态；任务已被取消时返回 False"""
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        sql = f"UPDATE tts_jobs SET status = ?, finished_at = ?{', ' if columns else ''}{columns} WHERE id = ? AND status = 'running'"
+        cursor = db.execute(sql, (status, utc_timestamp(), *fields.values(), job_id))
+        db.commit()
+        return cursor.rowcount == 1
+
+    def _write_result(self, job_id, audio):
+        path = self.result_path(job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+        return path
+
+    def _remove_result(self, job_id):
+        try:
+            os.remove(self.result_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def _execute(self, db, job):
+        with self._cond:
+            self._stats["running"] += 1
+            self._running.add(job["id"])
+        try:
+            mimetype, audio, cached = self.handler(job)
+            self._write_result(job["id"], audio)
+        except Exception as e:
+            if self._finish(db, job["id"], "failed", error_message=str(e)[:1000]):
+                with self._cond:
+                    self._stats["failed"] += 1
+            return
+        finally:
+            with self._cond:
+                self._stats["running"] -= 1
+                self._running.discard(job["id"])
+                self._cond.notify_all()
+        if self._finish(db, job["id"], "succeeded", mimetype=mimetype, result_size=len(audio), cached=cached):
+            with self._cond:
+                self._stats["succeeded"] += 1
+                self._cond.notify_all()
+        else:
+            # 执行期间被取消
+            self._remove_result(job["id"])
+
+    def _maintenance(self, db):
+        """重新排队中断的任务，清理过期的已完成任务"""
+        stale_before = utc_timestamp(-self.stale_after)
+        requeued = db.execute(
+            "UPDATE tts_jobs SET status = 'queued' WHERE status = 'running' AND heartbeat_at < ? AND attempts < ?",
+            (stale_before, self.max_attempts),
+        ).rowcount
+        db.execute(
+            "UPDATE tts_jobs SET status = 'failed', finished_at = ?, error_message = 'Job interrupted too many times' "
+            "WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+            (utc_timestamp(), stale_before, self.max_attempts),
+        )
+        expired = [
+            row[0] for row in db.execute(
+                "SELECT id FROM tts_jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at < ?",
+                (utc_timestamp(-self.retention),),
+            ).fetchall()
+        ]
+        for job_id in expired:
+            self._remove_result(job_id)
+        db.executemany("DELETE FROM tts_jobs WHERE id = ?", [(job_id,) for job_id in expired])
+        db.commit()
+        if requeued:
+            with self._cond:
+                self._stats["requeued"] += requeued
+
+    def _heartbeat(self):
+        db = self.connect()
+        interval = max(self.stale_after / 3, 1.0)
+        while self._pid == os.getpid():
+            time.sleep(interval)
+            with self._cond:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                db.executemany(
+                    "UPDATE tts_jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                    [(utc_timestamp(), job_id) for job_id in running],
+                )
+                db.commit()
+            except Exception as e:
+                logger.error("Job heartbeat error", extra={"error": str(e)})
+
+    def _run(self):
+        db = self.connect()
+        while self._pid == os.getpid():
+            try:
+                if time.monotonic() - self._last_maintenance > 60:
+                    self._last_maintenance = time.monotonic()
+                    self._maintenance(db)
+                job = self._claim(db)
+            except Exception as e:
+                logger.error("Job queue error", extra={"error": str(e)})
+                job = None
+            if job is None:
+                with self._cond:
+                    self._cond.wait(self.poll_interval)
+                continue
+            try:
+                self._execute(db, job)
+            except Exception as e:
+                logger.exception("Job execution error", extra={"job_id": job["id"]})
+
+    def stats(self, db=None):
+        with self._cond:
+            stats = dict(self._stats)
+        stats["workers"] = self.workers
+        if db is not None:
+            stats["by_status"] = {
+                row[0]: row[1]
+                for row in db.execute("SELECT status, COUNT(*) FROM tts_jobs GROUP BY status").fetchall()
+            }
+        return stats
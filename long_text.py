@@ -0,0 +1,242 @@
+"""长文本合成：按句子切分、并发调用上游、免重编码拼接音频。"""
+import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import audio
+
+# 段落和句末标点（中英文），切分后标点保留在句子末尾
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[。！？!?；;…])|(?<=[.](?=\s))")
+_CLAUSE_RE = re.compile(r"(?<=[，,、：:])")
+
+
+def _pack(parts, limit, sep):
+    """将片段贪心合并为不超过 limit 的块"""
+    chunks = []
+    current = ""
+    for part in parts:
+        if not part:
+            continue
+        candidate = f"{current}{sep}{part}" if current else part
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            if current:
+                chunks.append(current)
+            current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split_long_sentence(sentence, limit):
+    """句子本身超长时，依次尝试按分句标点、空白切分，最后硬切"""
+    if len(sentence) <= limit:
+        return [sentence]
+    result = []
+    for piece in _pack([p.strip() for p in _CLAUSE_RE.split(sentence)], limit, " "):
+        if len(piece) <= limit:
+            result.append(piece)
+            continue
+        for word_piece in _pack(piece.split(), limit, " "):
+            while len(word_piece) > limit:
+                result.append(word_piece[:limit])
+                word_piece = word_piece[limit:]
+            if word_piece:
+                result.append(word_piece)
+    return result
+
+
+def split_text(text, limit):
+    """在段落/句子边界处切分文本，每块不超过 limit 个字符"""
+    text = text.strip()
+    if len(text) <= limit:
+        return [text] if text else []
+    chunks = []
+    for paragraph in _PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        sentences = []
+        for sentence in _SENTENCE_RE.split(paragraph):
+            sentence = sentence.strip()
+            if sentence:
+                sentences.extend(_split_long_sentence(sentence, limit))
+        chunks.extend(_pack(sentences, limit, " "))
+    # 相邻的短段落再合并，减少上游调用次数
+    return _pack(chunks, limit, "\n\n")
+
+
+# --- 音频拼接 ---
+def _parse_wav(data):
+    """返回 (fmt 块内容, PCM 数据的 memoryview)"""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("Not a WAV file")
+    view = memoryview(data)
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, offset)
+        body_start = offset + 8
+        if chunk_id == b"fmt ":
+            fmt = bytes(view[body_start:body_start + size])
+        elif chunk_id == b"data":
+            # 流式生成的 WAV 可能把 data 长度写成 0 或 0xFFFFFFFF，此时取到文件末尾
+            end = len(data) if size in (0, 0xFFFFFFFF) else min(body_start + size, len(data))
+            if fmt is None:
+                raise ValueError("WAV data chunk before fmt chunk")
+            return fmt, view[body_start:end]
+        offset = body_start + size + (size & 1)
+    raise ValueError("WAV file without data chunk")
+
+
+def _join_wav(chunks):
+    fmt = None
+    pcm_parts = []
+    for data in chunks:
+        chunk_fmt, pcm = _parse_wav(data)
+        if fmt is None:
+            fmt = chunk_fmt
+        elif chunk_fmt != fmt:
+            raise ValueError("WAV chunks have different formats")
+        pcm_parts.append(pcm)
+    data_size = sum(len(p) for p in pcm_parts)
+    header = (
+        struct.pack("<4sI4s", b"RIFF", 4 + (8 + len(fmt)) + (8 + data_size), b"WAVE")
+        + struct.pack("<4sI", b"fmt ", len(fmt)) + fmt
+        + struct.pack("<4sI", b"data", data_size)
+    )
+    return [header] + [bytes(p) for p in pcm_parts]
+
+
+_MP3_BITRATES = {
+    # (MPEG1?, layer3) -> kbps 表，索引 1..14
+    True: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    False: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _skip_id3v2(data):
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def _mp3_frame_length(data, offset):
+    """解析 Layer III 帧头，返回帧长度；不是合法帧头时返回 None"""
+    if offset + 4 > len(data):
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    if data[offset] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = (b2 >> 4) & 0x0F
+    rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[mpeg1][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 0x01
+    return (144 if mpeg1 else 72) * bitrate // sample_rate + padding
+
+
+def _mp3_audio_frames(data):
+    """去掉 ID3v2/ID3v1 标签和 Xing/Info/VBRI 信息帧，返回帧对齐的纯音频数据"""
+    view = memoryview(data)
+    start = _skip_id3v2(data)
+    # 找到第一个合法帧头
+    while start < len(data) and _mp3_frame_length(data, start) is None:
+        start += 1
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+
+    frame_length = _mp3_frame_length(data, start)
+    if frame_length:
+        b1, b3 = data[start + 1], data[start + 3]
+        mpeg1 = ((b1 >> 3) & 0x03) == 3
+        mono = ((b3 >> 6) & 0x03) == 3
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        tag_offset = start + 4 + side_info
+        if data[tag_offset:tag_offset + 4] in (b"Xing", b"Info") or data[start + 36:start + 40] == b"VBRI":
+            # 信息帧中的总帧数只描述单个片段，拼接后会误导播放器，直接去掉
+            start += frame_length
+    return bytes(view[start:end])
+
+
+def _join_mp3(chunks):
+    return [_mp3_audio_frames(data) for data in chunks]
+
+
+def sniff_join_format(data, hint=None):
+    """根据文件头判断拼接方式"""
+    fmt = audio.sniff_format(data)
+    if fmt is None or fmt == "m4a":
+        return hint or "raw"
+    return fmt
+
+
+def join_audio(chunks, hint=None):
+    """拼接多个同格式的音频片段，尽量不重新编码，返回分块列表
+
+    - WAV：合并 PCM 数据，只保留一个头部
+    - MP3：去掉每段的标签和信息帧后按帧拼接
+    - Ogg(Opus)/ADTS(AAC)/PCM：格式本身支持直接首尾相接（Ogg 为链式流）
+    - FLAC：无法免重编码拼接，抛出 ValueError
+    """
+    chunks = [c for c in chunks if c]
+    if not chunks:
+        raise ValueError("No audio to join")
+    if len(chunks) == 1:
+        return chunks
+    kind = sniff_join_format(chunks[0], hint)
+    if kind == "wav":
+        return _join_wav(chunks)
+    if kind == "mp3":
+        return _join_mp3(chunks)
+    if kind == "flac":
+        raise ValueError("FLAC output cannot be joined without re-encoding")
+    return chunks
+
+
+# 可拼接的输出格式（OpenAI 的 response_format）
+JOINABLE_FORMATS = ("mp3", "opus", "aac", "wav", "pcm")
+
+
+class LongTextSynthesizer:
+    """有界线程池：所有长文本请求共享，限制同时发往上游的分块请求数"""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="long-text")
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "chunks": 0, "failures": 0}
+
+    def synthesize(self, pieces, synthesize_piece):
+        """并发合成各文本块，按原顺序返回结果；任一块失败则取消其余块并抛出异常"""
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["chunks"] += len(pieces)
+        futures = [self._executor.submit(synthesize_piece, piece) for piece in pieces]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            with self._lock:
+                self._stats["failures"] += 1
+            raise
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_workers"] = self.max_workers
+        stats["queued"] = self._executor._work_queue.qsize()
+        return stats
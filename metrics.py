@@ -0,0 +1,404 @@
+"""Prometheus 文本格式的指标：计数器、仪表盘和直方图，支持多进程汇总。
+
+gunicorn 等多进程部署时设置共享目录（TTS_METRICS_DIR），每个进程定期把自己的指标快照
+写入 <目录>/<pid>-<启动时间>.json，被抓取的进程读取全部快照后合并输出：计数器和直方图累加，
+仪表盘只累加仍在运行的进程。进程退出（atexit、gunicorn 的 child_exit 调用 mark_process_dead，
+或抓取时发现进程已不存在）后，它的计数器和直方图并入 archive.json 并删除快照文件，
+目录不会随 worker 重启无限增长；文件名带启动时间，进程号被复用时也不会覆盖旧进程的计数。
+"""
+import atexit
+import contextlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows 不使用 gunicorn，多进程汇总时不加文件锁
+    fcntl = None
+
+# 秒为单位的默认分桶，覆盖从数据库查询到长文本合成的范围
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# 单个指标的标签组合上限，超出后归入 "other"，防止标签取值失控占满内存
+MAX_SERIES = 2000
+
+# 多进程目录中已退出进程的累计值和文件锁
+ARCHIVE_NAME = "archive.json"
+LOCK_NAME = ".lock"
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels_text(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            key = tuple("other" for _ in self.labelnames)
+        return key
+
+    def _snapshot(self):
+        return {
+            "type": self.type,
+            "help": self.documentation,
+            "labels": list(self.labelnames),
+            "series": [[list(key), value] for key, value in self._series.items()],
+        }
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        with self.registry._lock:
+            self.registry._check_pid()
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        with self.registry._lock:
+            self.registry._check_pid()
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.registry._lock:
+            self.registry._check_pid()
+            self._series[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        with self.registry._lock:
+            self.registry._check_pid()
+            key = self._key(labels)
+            # 每个标签组合保存 [各分桶计数..., 总和, 次数]，分桶计数不累计，输出时再累加
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def _snapshot(self):
+        snapshot = super()._snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        snapshot["series"] = [[key, list(value)] for key, value in snapshot["series"]]
+        return snapshot
+
+
+class Registry:
+    """指标注册表；multiprocess_dir 非空时启用多进程汇总"""
+
+    def __init__(self, multiprocess_dir=None, flush_interval=5.0):
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._pid = os.getpid()
+        self._started = time.time_ns()  # 区分复用同一进程号的不同进程
+        self._writer_pid = None
+        self._write_lock = threading.Lock()
+        self._exited_pid = None
+
+    def _check_pid(self):
+        # fork 出的子进程不继承父进程的计数（调用方已持有锁）
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._started = time.time_ns()
+            for metric in self._metrics.values():
+                metric._series.clear()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return {name: metric._snapshot() for name, metric in self._metrics.items()}
+
+    # --- 多进程汇总 ---
+    def start(self):
+        """启动快照写入线程（每个进程各一个，fork 后的子进程会重新启动）"""
+        if not self.multiprocess_dir or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        threading.Thread(target=self._write_loop, name="tts-metrics-writer", daemon=True).start()
+        atexit.register(self._exit)
+
+    def _write_loop(self):
+        while self._writer_pid == os.getpid():
+            time.sleep(self.flush_interval)
+            self.write_snapshot()
+
+    def _snapshot_name(self):
+        return f"{self._pid}-{self._started}.json"
+
+    def write_snapshot(self):
+        if not self.multiprocess_dir:
+            return
+        with self._write_lock:
+            # 退出时已并入归档的进程不再写快照，避免同一份计数被归档两次
+            if self._exited_pid == os.getpid():
+                return
+            snapshot = self.snapshot()
+            try:
+                _write_json(self.multiprocess_dir, self._snapshot_name(), snapshot)
+            except OSError as e:
+                logger.warning("Metrics snapshot write failed", extra={"error": str(e)})
+
+    def _exit(self):
+        """进程退出时写入最后的快照并并入归档"""
+        if self._writer_pid != os.getpid():
+            return
+        self._writer_pid = None
+        self.write_snapshot()
+        with self._write_lock:
+            self._exited_pid = os.getpid()
+        mark_process_dead(os.getpid(), self.multiprocess_dir)
+
+    def _other_snapshots(self):
+        """归档已退出进程的快照，返回 [(快照, 进程是否仍在运行)]，归档本身视为已退出（调用方已持有目录锁）"""
+        own = self._snapshot_name()
+        files = []
+        latest = {self._pid: self._started}
+        for name in os.listdir(self.multiprocess_dir):
+            key = _snapshot_key(name)
+            if key is None or name == own:
+                continue
+            files.append((name, key))
+            latest[key[0]] = max(latest.get(key[0], 0), key[1])
+        # 同一进程号只有最新启动的那份快照可能属于仍在运行的进程
+        live = [name for name, (pid, started) in files if started == latest[pid] and _pid_alive(pid)]
+        dead = [name for name, _ in files if name not in live]
+        if dead:
+            try:
+                _archive(self.multiprocess_dir, dead)
+            except OSError as e:
+                logger.warning("Metrics archive write failed", extra={"error": str(e)})
+        snapshots = []
+        for name, alive in [(ARCHIVE_NAME, False)] + [(name, True) for name in live]:
+            snapshot = _load_json(os.path.join(self.multiprocess_dir, name))
+            if snapshot is not None:
+                snapshots.append((snapshot, alive))
+        return snapshots
+
+    def collect(self):
+        """合并本进程的实时数值、其他进程的快照和已退出进程的归档"""
+        merged = self.snapshot()
+        if not self.multiprocess_dir or not os.path.isdir(self.multiprocess_dir):
+            return merged
+        totals = {
+            name: {tuple(key): value for key, value in metric["series"]} for name, metric in merged.items()
+        }
+        with _locked(self.multiprocess_dir):
+            snapshots = self._other_snapshots()
+        for snapshot, alive in snapshots:
+            for name, metric in snapshot.items():
+                if name not in merged or (metric["type"] == "gauge" and not alive):
+                    continue
+                _add_series(totals[name], metric)
+        for name, metric in merged.items():
+            metric["series"] = [[list(key), value] for key, value in totals[name].items()]
+        return merged
+
+    def render(self):
+        """输出 Prometheus 文本格式（text/plain; version=0.0.4）"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labels = metric["labels"]
+            for key, value in sorted(metric["series"]):
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_labels_text(labels, key)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + [math.inf], value[:-2] + [0]):
+                    # 超出最大分桶的观测值只计入 +Inf
+                    cumulative = value[-1] if bound == math.inf else cumulative + count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{name}_bucket{_labels_text(labels, key, le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels_text(labels, key)} {_format_value(value[-2])}")
+                lines.append(f"{name}_count{_labels_text(labels, key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _add_series(series, metric):
+    """把快照中一个指标的数值累加到 {标签元组: 数值}"""
+    for key, value in metric["series"]:
+        key = tuple(key)
+        current = series.get(key)
+        if current is None:
+            series[key] = value
+        elif metric["type"] == "histogram":
+            if len(current) == len(value):
+                series[key] = [a + b for a, b in zip(current, value)]
+        else:
+            series[key] = current + value
+
+
+def _snapshot_key(name):
+    """快照文件名 <pid>-<启动时间>.json（旧版为 <pid>.json）解析为 (pid, 启动时间)，其他文件返回 None"""
+    if not name.endswith(".json"):
+        return None
+    pid, _, started = name[:-5].partition("-")
+    try:
+        return int(pid), int(started or 0)
+    except ValueError:
+        return None
+
+
+def _load_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return None
+
+
+def _write_json(directory, name, data):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, os.path.join(directory, name))
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _locked(directory):
+    """多进程目录的排他锁：归档和读取快照不会与其他进程的归档交错"""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, LOCK_NAME), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _archive(directory, names):
+    """把快照中的计数器和直方图并入归档后删除快照（调用方已持有目录锁）"""
+    archive = _load_json(os.path.join(directory, ARCHIVE_NAME)) or {}
+    totals = {name: {tuple(key): value for key, value in metric["series"]} for name, metric in archive.items()}
+    for name in names:
+        snapshot = _load_json(os.path.join(directory, name)) or {}
+        for metric_name, metric in snapshot.items():
+            if metric["type"] == "gauge":
+                continue
+            if metric_name not in archive:
+                archive[metric_name] = dict(metric)
+                totals[metric_name] = {}
+            _add_series(totals[metric_name], metric)
+    for metric_name, metric in archive.items():
+        metric["series"] = [[list(key), value] for key, value in totals[metric_name].items()]
+    _write_json(directory, ARCHIVE_NAME, archive)
+    for name in names:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, name))
+
+
+def mark_process_dead(pid, multiprocess_dir=None):
+    """把已退出进程的计数并入归档并删除它的快照
+
+    在 gunicorn 配置中调用，worker 被强制杀死（未执行 atexit）时同样生效：
+        def child_exit(server, worker):
+            metrics.mark_process_dead(worker.pid)
+    """
+    directory = multiprocess_dir or os.environ.get("TTS_METRICS_DIR")
+    if not directory or not os.path.isdir(directory):
+        return
+    try:
+        with _locked(directory):
+            names = [name for name in os.listdir(directory) if (_snapshot_key(name) or (None,))[0] == pid]
+            if names:
+                _archive(directory, names)
+    except OSError as e:
+        logger.warning("Metrics archive write failed", extra={"pid": pid, "error": str(e)})
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def create_registry_from_env():
+    """根据环境变量创建指标注册表"""
+    return Registry(
+        multiprocess_dir=os.environ.get("TTS_METRICS_DIR") or None,
+        flush_interval=float(os.environ.get("TTS_METRICS_FLUSH_INTERVAL", 5)),
+    )
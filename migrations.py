@@ -0,0 +1,145 @@
+"""带版本号的数据库迁移，启动时按顺序幂等执行。"""
+import sqlite3
+
+import jobs
+import quota
+import rate_limit
+
+
+def _add_column(table, column, definition):
+    """生成“列不存在时才添加”的迁移步骤（SQLite 不支持 ADD COLUMN IF NOT EXISTS）"""
+    def migrate(db):
+        columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})").fetchall()]
+        if column not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return migrate
+
+
+def _add_key_limits(db):
+    # 0 表示不限制
+    _add_column("api_keys", "rps_limit", "REAL DEFAULT 0")(db)
+    _add_column("api_keys", "burst_limit", "INTEGER DEFAULT 0")(db)
+    _add_column("api_keys", "concurrency_limit", "INTEGER DEFAULT 0")(db)
+
+
+# (版本号, 说明, SQL 脚本或接收连接的函数)；已发布的迁移不要修改，只能追加
+MIGRATIONS = [
+    (1, "初始表结构", """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS tts_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    voice TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+CREATE TABLE IF NOT EXISTS api_settings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    service_name TEXT NOT NULL,
+    api_key TEXT,
+    api_endpoint TEXT,
+    model_name TEXT NOT NULL DEFAULT 'tts-1',
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    UNIQUE (user_id, service_name)
+);
+
+CREATE TABLE IF NOT EXISTS api_keys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    key_name TEXT NOT NULL,
+    api_key TEXT UNIQUE NOT NULL,
+    is_active BOOLEAN DEFAULT 1,
+    daily_limit INTEGER DEFAULT 1000,
+    provider_permissions TEXT DEFAULT '["openai","gemini"]',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+CREATE TABLE IF NOT EXISTS api_usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    api_key_id INTEGER NOT NULL,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    voice TEXT,
+    text_length INTEGER,
+    audio_duration REAL,
+    success BOOLEAN DEFAULT 1,
+    error_message TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (api_key_id) REFERENCES api_keys (id)
+);
+"""),
+    (2, "api_usage 增加 cached 列", _add_column("api_usage", "cached", "BOOLEAN DEFAULT 0")),
+    (3, "每日用量计数表", quota.SCHEMA),
+    (4, "热点查询索引", """
+-- 每日限额初始化、使用统计：按密钥 + 时间范围查询，success 放入索引以便覆盖查询
+CREATE INDEX IF NOT EXISTS idx_api_usage_key_created
+    ON api_usage (api_key_id, created_at, success);
+-- 管理界面的密钥列表
+CREATE INDEX IF NOT EXISTS idx_api_keys_user_created
+    ON api_keys (user_id, created_at);
+"""),
+    (5, "异步合成任务表", jobs.SCHEMA),
+    (6, "api_keys 增加速率和并发限制列", _add_key_limits),
+    (7, "速率限制拒绝计数表", rate_limit.SCHEMA),
+]
+
+
+def current_version(db):
+    """返回数据库当前的架构版本，未初始化时为 0"""
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        " version INTEGER PRIMARY KEY,"
+        " description TEXT,"
+        " applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(db):
+    """按顺序应用尚未执行的迁移，返回本次应用的版本号列表
+
+    每个迁移在独立的 IMMEDIATE 事务中执行并记录版本，
+    多个进程同时启动时只有一个会真正执行，其余会看到已更新的版本号并跳过。
+    """
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current_version(db):
+            continue
+        db.commit()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # 拿到写锁后再确认一次，避免与其他进程重复执行
+            if db.execute(
+                "SELECT 1 FROM schema_version WHERE version = ?", (version,)
+            ).fetchone():
+                db.rollback()
+                continue
+            if callable(step):
+                step(db)
+            else:
+                for statement in step.split(";"):
+                    if statement.strip():
+                        db.execute(statement)
+            db.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description),
+            )
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        applied.append(version)
+    return applied
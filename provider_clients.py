@@ -0,0 +1,506 @@
+"""进程级 TTS 服务商 SDK 客户端注册表，复用长连接池。"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ClientRegistry:
+    """按 (provider, api_key, api_endpoint) 缓存 SDK 客户端
+
+    每个客户端持有自己的 keep-alive 连接池，多线程共享同一实例；
+    fork 之后（gunicorn worker）检测到进程号变化会丢弃继承来的客户端。
+    客户端以引用计数借出：过期、超出数量或凭据变更被淘汰后不再借出，
+    仍在使用中的等最后一个借用者归还后才关闭。
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=10.0, read_timeout=60.0,
+                 max_retries=2, max_clients=64, idle_ttl=1800):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()  # key -> [client, last_used, 借出数, 已淘汰]
+        self._retiring = 0  # 已淘汰、等待归还后关闭的客户端数
+        self._pid = os.getpid()
+        self._stats = {"created": 0, "reused": 0, "invalidated": 0, "expired": 0}
+
+    # --- 客户端构造 ---
+    def _limits(self):
+        import httpx
+        return httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+        )
+
+    def _build_openai(self, api_key, api_endpoint):
+        import httpx
+        import openai
+
+        timeout = httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+        kwargs = {
+            "api_key": api_key,
+            "base_url": api_endpoint if api_endpoint else None,
+            "timeout": timeout,
+            "max_retries": self.max_retries,
+        }
+        if hasattr(openai, "DefaultHttpxClient"):
+            kwargs["http_client"] = openai.DefaultHttpxClient(limits=self._limits(), timeout=timeout)
+        return openai.OpenAI(**kwargs)
+
+    def _build_gemini(self, api_key, api_endpoint):
+        from google import genai
+        from google.genai import types
+
+        http_options = types.HttpOptions(
+            timeout=int(self.read_timeout * 1000),
+            client_args={"limits": self._limits()},
+        )
+        return genai.Client(api_key=api_key, http_options=http_options)
+
+    def _close(self, client):
+        close = getattr(client, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception:
+            pass
+
+    # --- 借出与归还（调用方已持有锁） ---
+    def _borrow(self, slot, now):
+        slot[1] = now
+        slot[2] += 1
+        released = False
+
+        def release():
+            nonlocal released
+            with self._lock:
+                if released:
+                    return
+                released = True
+                slot[2] -= 1
+                close = slot[3] and slot[2] == 0
+                if close:
+                    self._retiring -= 1
+            if close:
+                self._close(slot[0])
+
+        return slot[0], release
+
+    def _retire(self, slot, closing):
+        """淘汰客户端：没有借用者时放入 closing 立即关闭，否则等最后一个借用者归还"""
+        slot[3] = True
+        if slot[2] == 0:
+            closing.append(slot[0])
+        else:
+            self._retiring += 1
+
+    # --- 公共接口 ---
+    def lease(self, provider, api_key, api_endpoint=None):
+        """借出（必要时创建）对应凭据的 SDK 客户端，返回 (client, release)
+
+        用完后（流式响应则在响应体读完或关闭后）调用一次 release()。
+        """
+        key = (provider, api_key, api_endpoint or None)
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 后父进程的连接池不可共享，直接丢弃（不关闭，避免影响父进程的套接字）
+                self._clients.clear()
+                self._retiring = 0
+                self._pid = os.getpid()
+            slot = self._clients.get(key)
+            if slot is not None:
+                self._clients.move_to_end(key)
+                self._stats["reused"] += 1
+                return self._borrow(slot, now)
+
+        if provider == "openai":
+            client = self._build_openai(api_key, api_endpoint)
+        elif provider == "gemini":
+            client = self._build_gemini(api_key, api_endpoint)
+        else:
+            raise ValueError(f"Unsupported provider: {provider}")
+
+        closing = []
+        with self._lock:
+            slot = self._clients.get(key)
+            if slot is not None:
+                # 其他线程已抢先创建，使用已有实例
+                closing.append(client)
+                self._stats["reused"] += 1
+                leased = self._borrow(slot, now)
+            else:
+                slot = self._clients[key] = [client, now, 0, False]
+                self._stats["created"] += 1
+                leased = self._borrow(slot, now)
+                for k in list(self._clients):
+                    if self.idle_ttl and now - self._clients[k][1] > self.idle_ttl:
+                        self._retire(self._clients.pop(k), closing)
+                        self._stats["expired"] += 1
+                while len(self._clients) > self.max_clients:
+                    self._retire(self._clients.popitem(last=False)[1], closing)
+                    self._stats["expired"] += 1
+        for old in closing:
+            self._close(old)
+        return leased
+
+    def invalidate(self, provider, api_key=None, api_endpoint=None):
+        """凭据变更时淘汰客户端；只给 provider 时淘汰该服务商的全部客户端"""
+        closing = []
+        removed = 0
+        with self._lock:
+            for key in list(self._clients):
+                if key[0] != provider:
+                    continue
+                if api_key is not None and key[1] != api_key:
+                    continue
+                if api_endpoint is not None and key[2] != (api_endpoint or None):
+                    continue
+                self._retire(self._clients.pop(key), closing)
+                removed += 1
+            self._stats["invalidated"] += removed
+        for client in closing:
+            self._close(client)
+        return removed
+
+    def stats(self):
+        """返回客户端数量、借出数及创建/复用计数"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["clients"] = len(self._clients)
+            stats["leased"] = sum(slot[2] for slot in self._clients.values())
+            stats["retiring"] = self._retiring
+            stats["pool_size"] = self.pool_size
+        return stats
+
+
+def create_registry_from_env():
+    """根据环境变量创建客户端注册表"""
+    return ClientRegistry(
+        pool_size=int(os.environ.get("TTS_CLIENT_POOL_SIZE", 10)),
+        connect_timeout=float(os.environ.get("TTS_CLIENT_CONNECT_TIMEOUT", 10)),
+        read_timeout=float(os.environ.get("TTS_CLIENT_READ_TIMEOUT", 60)),
+        max_retries=int(os.environ.get("TTS_CLIENT_MAX_RETRIES", 2)),
+    )
+
+
+class AsyncClientRegistry:
+    """ASGI 模式的异步上游客户端：代理请求和 OpenAI 共用一组 httpx.AsyncClient 连接池
+
+    httpcore 每完成一个请求都要遍历连接池中的全部连接，上千个连接放在同一个池中时开销
+    随连接数平方增长，因此按 SHARD_CONNECTIONS 拆成多个连接池，轮流使用。
+    只能在事件循环中使用；fork 之后或事件循环更换后重新创建。
+    """
+
+    SHARD_CONNECTIONS = 50
+
+    def __init__(self, max_connections=1000, connect_timeout=10.0, read_timeout=60.0, max_retries=2):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.shards = max(1, -(-max_connections // self.SHARD_CONNECTIONS))
+
+        self._owner = None  # (pid, 事件循环)
+        self._http = []
+        self._next = 0
+        self._openai = OrderedDict()
+        self._stats = {"created": 0, "reused": 0}
+
+    def _check_owner(self):
+        owner = (os.getpid(), asyncio.get_running_loop())
+        if self._owner != owner:
+            # 旧连接池属于其他进程或已结束的事件循环，直接丢弃
+            self._owner = owner
+            self._http = []
+            self._openai.clear()
+
+    def _shard(self):
+        import httpx
+
+        self._check_owner()
+        if not self._http:
+            per_shard = -(-self.max_connections // self.shards)
+            # 各连接池共用一个 SSL 上下文（加载 CA 证书较慢）
+            ssl_context = httpx.create_ssl_context()
+            self._http = [
+                httpx.AsyncClient(
+                    verify=ssl_context,
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                    limits=httpx.Limits(max_connections=per_shard, max_keepalive_connections=per_shard),
+                )
+                for _ in range(self.shards)
+            ]
+        self._next = (self._next + 1) % self.shards
+        return self._next
+
+    def http(self):
+        """轮流返回共享的 httpx.AsyncClient"""
+        shard = self._shard()  # 可能重建 self._http，须先于下标取值
+        return self._http[shard]
+
+    def openai(self, api_key, api_endpoint=None):
+        """按凭据缓存的 openai.AsyncOpenAI（每个连接池一个），底层使用共享连接池"""
+        import openai
+
+        shard = self._shard()
+        key = (api_key, api_endpoint or None)
+        clients = self._openai.get(key)
+        if clients is None:
+            clients = self._openai[key] = [None] * self.shards
+            while len(self._openai) > 64:
+                self._openai.popitem(last=False)
+        else:
+            self._openai.move_to_end(key)
+        client = clients[shard]
+        if client is not None:
+            self._stats["reused"] += 1
+            return client
+        client = clients[shard] = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=api_endpoint if api_endpoint else None,
+            max_retries=self.max_retries,
+            http_client=self._http[shard],
+        )
+        self._stats["created"] += 1
+        return client
+
+    async def aclose(self):
+        if self._owner == (os.getpid(), asyncio.get_running_loop()):
+            for http in self._http:
+                await http.aclose()
+        self._owner = None
+        self._http = []
+        self._openai.clear()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["openai_clients"] = len(self._openai)
+        stats["max_connections"] = self.max_connections
+        stats["shards"] = self.shards
+        return stats
+
+
+class ProxySessionPool:
+    """Gemini 自定义端点（代理）的长连接 HTTP 会话池
+
+    每个代理源（scheme://host:port）一个 requests.Session，配置连接池大小、
+    重试策略和连接/读取超时；同时统计连接复用率和连接池饱和次数。
+    传入 metrics_registry 时同时以 tts_proxy_* 指标导出。
+    """
+
+    def __init__(self, pool_size=10, max_retries=2, backoff_factor=0.3,
+                 connect_timeout=10.0, read_timeout=30.0, pool_block=False, metrics_registry=None):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_block = pool_block
+
+        self._lock = threading.Lock()
+        self._sessions = {}  # origin -> dict(session, adapter, 计数)
+        self._pid = os.getpid()
+        self._metrics = None
+        if metrics_registry is not None:
+            labels = ("origin",)
+            self._metrics = {
+                "requests": metrics_registry.counter(
+                    "tts_proxy_requests_total", "Requests sent through the Gemini proxy session pool", labels
+                ),
+                "errors": metrics_registry.counter(
+                    "tts_proxy_errors_total", "Gemini proxy requests that raised a connection or timeout error", labels
+                ),
+                "opened": metrics_registry.counter(
+                    "tts_proxy_connections_opened_total", "New connections opened to a Gemini proxy", labels
+                ),
+                "reused": metrics_registry.counter(
+                    "tts_proxy_connections_reused_total", "Gemini proxy requests served on a kept-alive connection",
+                    labels
+                ),
+                "saturated": metrics_registry.counter(
+                    "tts_proxy_pool_saturated_total",
+                    "Gemini proxy requests started while the connection pool was already full", labels
+                ),
+                "in_flight": metrics_registry.gauge(
+                    "tts_proxy_requests_in_flight", "Gemini proxy requests holding a pooled connection", labels
+                ),
+            }
+
+    @staticmethod
+    def _origin(url):
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _build_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # 合成请求（POST）按次计费，只在连接建立失败（请求尚未发出）时重试；
+        # 网关类错误只对幂等方法（如下载音频的 GET）重试；400/500 交给调用方切换请求格式
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+            pool_block=self.pool_block,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session, adapter
+
+    def _entry(self, url):
+        origin = self._origin(url)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sessions.clear()
+                self._pid = os.getpid()
+            entry = self._sessions.get(origin)
+            if entry is None:
+                session, adapter = self._build_session()
+                entry = {
+                    "origin": origin,
+                    "session": session,
+                    "adapter": adapter,
+                    "requests": 0,
+                    "errors": 0,
+                    "in_flight": 0,
+                    "peak_in_flight": 0,
+                    "saturated": 0,
+                    "reported_opened": 0,  # 已计入指标的新建/复用连接数
+                    "reported_reused": 0,
+                }
+                self._sessions[origin] = entry
+            return entry
+
+    def session(self, url):
+        """返回指定代理源的共享会话"""
+        return self._entry(url)["session"]
+
+    def request(self, method, url, **kwargs):
+        """通过共享会话发送请求，默认使用配置的连接/读取超时"""
+        entry = self._entry(url)
+        origin = entry["origin"]
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        with self._lock:
+            entry["in_flight"] += 1
+            entry["peak_in_flight"] = max(entry["peak_in_flight"], entry["in_flight"])
+            saturated = entry["in_flight"] > self.pool_size
+            if saturated:
+                # 并发超过连接池上限：多出的请求需要新建（且不会被复用的）连接或排队等待
+                entry["saturated"] += 1
+        self._count("in_flight", origin=origin)
+        if saturated:
+            self._count("saturated", origin=origin)
+        try:
+            return entry["session"].request(method, url, **kwargs)
+        except Exception:
+            with self._lock:
+                entry["errors"] += 1
+            self._count("errors", origin=origin)
+            raise
+        finally:
+            with self._lock:
+                entry["in_flight"] -= 1
+                entry["requests"] += 1
+            if self._metrics is not None:
+                self._metrics["in_flight"].dec(origin=origin)
+                self._count("requests", origin=origin)
+                self._report_connections(entry)
+
+    def _count(self, name, amount=1, **labels):
+        if self._metrics is not None and amount > 0:
+            self._metrics[name].inc(amount, **labels)
+
+    @staticmethod
+    def _connections(entry):
+        """从 urllib3 连接池读取 (新建连接数, 复用连接的请求数)"""
+        opened = 0
+        upstream_requests = 0
+        pools = entry["adapter"].poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            opened += getattr(pool, "num_connections", 0)
+            upstream_requests += getattr(pool, "num_requests", 0)
+        return opened, max(upstream_requests - opened, 0)
+
+    def _report_connections(self, entry):
+        # urllib3 只提供累计值，把自上次以来的增量计入计数器
+        opened, reused = self._connections(entry)
+        with self._lock:
+            new_opened = opened - entry["reported_opened"]
+            new_reused = reused - entry["reported_reused"]
+            entry["reported_opened"] = max(entry["reported_opened"], opened)
+            entry["reported_reused"] = max(entry["reported_reused"], reused)
+        self._count("opened", new_opened, origin=entry["origin"])
+        self._count("reused", new_reused, origin=entry["origin"])
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def stats(self):
+        """按代理源返回请求数、新建/复用连接数和连接池饱和次数"""
+        result = {}
+        with self._lock:
+            entries = list(self._sessions.items())
+        for origin, entry in entries:
+            opened, reused = self._connections(entry)
+            with self._lock:
+                result[origin] = {
+                    "requests": entry["requests"],
+                    "errors": entry["errors"],
+                    "in_flight": entry["in_flight"],
+                    "peak_in_flight": entry["peak_in_flight"],
+                    "saturated": entry["saturated"],
+                    "connections_opened": opened,
+                    "connections_reused": reused,
+                    "pool_size": self.pool_size,
+                }
+        return result
+
+
+def create_async_registry_from_env():
+    """根据环境变量创建 ASGI 模式的异步客户端注册表"""
+    return AsyncClientRegistry(
+        max_connections=int(os.environ.get("TTS_ASGI_MAX_UPSTREAM", 1000)),
+        connect_timeout=float(os.environ.get("TTS_CLIENT_CONNECT_TIMEOUT", 10)),
+        read_timeout=float(os.environ.get("TTS_CLIENT_READ_TIMEOUT", 60)),
+        max_retries=int(os.environ.get("TTS_CLIENT_MAX_RETRIES", 2)),
+    )
+
+
+def create_proxy_pool_from_env(metrics_registry=None):
+    """根据环境变量创建代理会话池"""
+    return ProxySessionPool(
+        pool_size=int(os.environ.get("GEMINI_PROXY_POOL_SIZE", 10)),
+        max_retries=int(os.environ.get("GEMINI_PROXY_MAX_RETRIES", 2)),
+        backoff_factor=float(os.environ.get("GEMINI_PROXY_BACKOFF", 0.3)),
+        connect_timeout=float(os.environ.get("GEMINI_PROXY_CONNECT_TIMEOUT", 10)),
+        read_timeout=float(os.environ.get("GEMINI_PROXY_READ_TIMEOUT", 30)),
+        pool_block=os.environ.get("GEMINI_PROXY_POOL_BLOCK", "0").lower() in ("1", "true", "yes"),
+        metrics_registry=metrics_registry,
+    )
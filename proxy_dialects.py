@@ -0,0 +1,152 @@
+"""Gemini 代理端点的请求格式（方言）探测与记忆。
+
+不同代理接受的 generationConfig 写法不一样。原先每次请求都从标准格式开始，
+失败（400/500）后再依次尝试其他格式；这里按 (端点, 模型) 记住上次成功的格式，
+之后直接优先使用，失败或过期后重新探测。
+"""
+import logging
+import os
+import threading
+import time
+
+# 按默认探测顺序排列
+DIALECTS = ("standard", "alternative", "minimal")
+
+# 视为“格式不被接受”、需要换一种格式重试的状态码
+RETRY_STATUSES = (400, 500)
+
+logger = logging.getLogger(__name__)
+
+
+def build_payload(dialect, text, voice):
+    """按指定方言构造请求体"""
+    if dialect == "standard":
+        generation_config = {
+            "response_modalities": ["AUDIO"],
+            "speech_config": {
+                "voice_config": {
+                    "prebuilt_voice_config": {
+                        "voice_name": voice
+                    }
+                }
+            }
+        }
+    elif dialect == "alternative":
+        # 使用 responseModalities 而不是 response_modalities
+        generation_config = {
+            "responseModalities": ["AUDIO"],
+            "candidateCount": 1,
+            "topK": 40,
+            "topP": 0.9,
+            "temperature": 0.7
+        }
+    elif dialect == "minimal":
+        generation_config = {
+            "responseModalities": ["AUDIO"]
+        }
+    else:
+        raise ValueError(f"Unknown payload dialect: {dialect}")
+    return {
+        "contents": [{"parts": [{"text": text}]}],
+        "generationConfig": generation_config,
+    }
+
+
+class DialectMemory:
+    """记录每个 (端点, 模型) 上次成功的请求格式，ttl 秒后过期重新探测"""
+
+    def __init__(self, ttl=3600.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._known = {}  # (endpoint, model) -> (dialect, expires_at)
+        self._pid = os.getpid()
+        self._stats = {"hits": 0, "probes": 0, "fallbacks": 0, "forgotten": 0}
+
+    @staticmethod
+    def _key(endpoint, model):
+        return endpoint.rstrip('/'), model
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._known.clear()
+            self._pid = os.getpid()
+
+    def order(self, endpoint, model):
+        """返回本次请求的格式尝试顺序：记住的格式在前，其余按默认顺序"""
+        key = self._key(endpoint, model)
+        with self._lock:
+            self._check_pid()
+            known = self._known.get(key)
+            if known is not None and known[1] <= time.monotonic():
+                del self._known[key]
+                known = None
+            if known is None:
+                self._stats["probes"] += 1
+                return list(DIALECTS)
+            self._stats["hits"] += 1
+        return [known[0]] + [d for d in DIALECTS if d != known[0]]
+
+    def record_success(self, endpoint, model, dialect):
+        with self._lock:
+            self._check_pid()
+            self._known[self._key(endpoint, model)] = (dialect, time.monotonic() + self.ttl)
+
+    def record_failure(self, endpoint, model, dialect):
+        """记住的格式失败时遗忘它，本次请求继续尝试其他格式（即重新探测）"""
+        key = self._key(endpoint, model)
+        with self._lock:
+            self._stats["fallbacks"] += 1
+            known = self._known.get(key)
+            if known is not None and known[0] == dialect:
+                del self._known[key]
+                self._stats["forgotten"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["endpoints"] = {
+                f"{endpoint} {model}": dialect
+                for (endpoint, model), (dialect, _) in self._known.items()
+            }
+        stats["ttl"] = self.ttl
+        return stats
+
+
+def post(proxy_sessions, memory, api_url, endpoint, model, headers, text, voice, **kwargs):
+    """按记住的格式优先向代理发送请求，返回最后一次的响应"""
+    response = None
+    for dialect in memory.order(endpoint, model):
+        if response is not None:
+            response.close()
+        response = proxy_sessions.post(
+            api_url, headers=headers, json=build_payload(dialect, text, voice), **kwargs
+        )
+        if response.status_code in RETRY_STATUSES:
+            logger.info(
+                "Proxy rejected payload format, trying next",
+                extra={"endpoint": endpoint, "model": model, "dialect": dialect, "status": response.status_code},
+            )
+            memory.record_failure(endpoint, model, dialect)
+            continue
+        if response.status_code == 200:
+            memory.record_success(endpoint, model, dialect)
+        break
+    return response
+
+
+async def post_async(client, memory, api_url, endpoint, model, headers, text, voice, **kwargs):
+    """post 的异步版本（ASGI 模式），client 为 httpx.AsyncClient"""
+    response = None
+    for dialect in memory.order(endpoint, model):
+        response = await client.post(api_url, headers=headers, json=build_payload(dialect, text, voice), **kwargs)
+        if response.status_code in RETRY_STATUSES:
+            logger.info(
+                "Proxy rejected payload format, trying next",
+                extra={"endpoint": endpoint, "model": model, "dialect": dialect, "status": response.status_code},
+            )
+            memory.record_failure(endpoint, model, dialect)
+            continue
+        if response.status_code == 200:
+            memory.record_success(endpoint, model, dialect)
+        break
+    return response
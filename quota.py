@@ -0,0 +1,87 @@
+"""按密钥、按天的用量计数器，支持原子预占与失败退还。"""
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_quota_usage (
+    api_key_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (api_key_id, day)
+)
+"""
+
+
+def today():
+    """计数器使用的日期键，与原先的每日限制检查保持一致"""
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+def day_range(day):
+    """返回 created_at 的半开区间 [day, 次日)，可走 (api_key_id, created_at) 索引，
+    与 DATE(created_at) = day 等价"""
+    next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    return day, next_day
+
+
+def _ensure_row(db, api_key_id, day):
+    # 当天第一次访问时用 api_usage 中已有的成功记录初始化，兼容升级前产生的用量
+    start, end = day_range(day)
+    db.execute(
+        """
+        INSERT OR IGNORE INTO api_quota_usage (api_key_id, day, used)
+        SELECT ?, ?, COUNT(*) FROM api_usage
+        WHERE api_key_id = ? AND created_at >= ? AND created_at < ? AND success = 1
+        """,
+        (api_key_id, day, api_key_id, start, end),
+    )
+
+
+def used(db, api_key_id, day=None):
+    """查询某密钥当天已用次数（主键查找，O(1)）"""
+    day = day or today()
+    row = db.execute(
+        "SELECT used FROM api_quota_usage WHERE api_key_id = ? AND day = ?",
+        (api_key_id, day),
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    _ensure_row(db, api_key_id, day)
+    db.commit()
+    row = db.execute(
+        "SELECT used FROM api_quota_usage WHERE api_key_id = ? AND day = ?",
+        (api_key_id, day),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def reserve(db, api_key_id, limit, amount=1, day=None):
+    """原子地预占 amount 次用量，返回 (是否成功, 当前已用次数)
+
+    检查与自增在同一条 UPDATE 中完成，SQLite 的写锁保证并发请求
+    （包括不同 worker 进程）不会同时越过限制。
+    """
+    day = day or today()
+    sql = "UPDATE api_quota_usage SET used = used + ? WHERE api_key_id = ? AND day = ? AND used + ? <= ?"
+    params = (amount, api_key_id, day, amount, limit)
+    reserved = db.execute(sql, params).rowcount == 1
+    if not reserved:
+        exists = db.execute(
+            "SELECT 1 FROM api_quota_usage WHERE api_key_id = ? AND day = ?",
+            (api_key_id, day),
+        ).fetchone()
+        if exists is None:
+            # 当天的计数行尚未创建，初始化后重试一次
+            _ensure_row(db, api_key_id, day)
+            reserved = db.execute(sql, params).rowcount == 1
+    db.commit()
+    return reserved, used(db, api_key_id, day)
+
+
+def refund(db, api_key_id, amount=1, day=None):
+    """请求失败时退还预占的用量"""
+    day = day or today()
+    db.execute(
+        "UPDATE api_quota_usage SET used = MAX(used - ?, 0) WHERE api_key_id = ? AND day = ?",
+        (amount, api_key_id, day),
+    )
+    db.commit()
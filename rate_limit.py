@@ -0,0 +1,201 @@
+"""API密钥的请求速率（令牌桶）和并发上限。
+
+每次检查只在进程内存中做 O(1) 计算，不访问数据库。被拒绝的次数在内存中合并，
+由后台线程定期批量写入 api_rate_limit_rejections 表，供 /api/v1/usage 按天查询。
+多进程部署时每个进程各自计数，实际上限为配置值乘以进程数。
+"""
+import atexit
+import math
+import os
+import threading
+import time
+
+import quota
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_rate_limit_rejections (
+    api_key_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (api_key_id, day, reason)
+)
+"""
+
+REASONS = ("rate", "concurrency")
+
+
+class RateLimited(Exception):
+    """超过密钥的速率（rate）或并发（concurrency）上限"""
+
+    def __init__(self, reason, retry_after, headers):
+        super().__init__(f"API key {reason} limit exceeded, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+class _KeyState:
+    __slots__ = ("tokens", "updated", "in_flight")
+
+    def __init__(self, now):
+        self.tokens = None  # 首次使用时装满
+        self.updated = now
+        self.in_flight = 0
+
+
+class Ticket:
+    """已放行的请求；响应结束时调用 release 归还并发名额（可重复调用）"""
+
+    def __init__(self, limiter, state, headers):
+        self.limiter = limiter
+        self.state = state
+        self.headers = headers
+
+    def release(self):
+        state, self.state = self.state, None
+        if state is not None:
+            with self.limiter._lock:
+                state.in_flight -= 1
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+class KeyRateLimiter:
+    """按密钥 ID 保存令牌桶和进行中的请求数；限制值随每次请求传入（来自认证缓存中的密钥记录）"""
+
+    def __init__(self, connect, interval=10):
+        self.connect = connect
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._states = {}  # key_id -> _KeyState
+        self._pending = {}  # (key_id, day, reason) -> 待写入的拒绝次数
+        self._pid = os.getpid()
+        self._thread_pid = None
+        self._stats = {"allowed": 0, **{reason: 0 for reason in REASONS}, "flushes": 0, "errors": 0}
+        atexit.register(self.flush)
+
+    def _check_pid(self):
+        # fork 出的子进程不继承父进程的桶和进行中的请求（调用方已持有锁）
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._states.clear()
+            self._pending.clear()
+
+    def acquire(self, key_id, rps=0, burst=0, max_concurrency=0):
+        """检查并占用一次请求，返回 Ticket；超出限制时抛出 RateLimited
+
+        rps 为每秒补充的令牌数，burst 为桶容量（0 表示 rps 向上取整）；0 表示不限制。
+        """
+        rps = rps or 0
+        max_concurrency = max_concurrency or 0
+        if rps <= 0 and max_concurrency <= 0:
+            return Ticket(self, None, {})
+        now = time.monotonic()
+        headers = {}
+        with self._lock:
+            self._check_pid()
+            state = self._states.get(key_id)
+            if state is None:
+                state = self._states[key_id] = _KeyState(now)
+            if rps > 0:
+                capacity = burst if burst and burst > 0 else max(math.ceil(rps), 1)
+                if state.tokens is None:
+                    state.tokens = capacity
+                state.tokens = min(capacity, state.tokens + (now - state.updated) * rps)
+                state.updated = now
+                headers["X-RateLimit-Limit"] = _number(rps)
+                headers["X-RateLimit-Burst"] = str(capacity)
+                if state.tokens < 1:
+                    headers["X-RateLimit-Remaining"] = "0"
+                    headers["X-RateLimit-Reset"] = str(math.ceil((capacity - state.tokens) / rps))
+                    raise self._reject(key_id, "rate", (1 - state.tokens) / rps, headers)
+            if max_concurrency > 0:
+                headers["X-Concurrency-Limit"] = str(max_concurrency)
+                if state.in_flight >= max_concurrency:
+                    headers["X-Concurrency-Remaining"] = "0"
+                    raise self._reject(key_id, "concurrency", 1, headers)
+            if rps > 0:
+                state.tokens -= 1
+                headers["X-RateLimit-Remaining"] = str(int(state.tokens))
+                headers["X-RateLimit-Reset"] = str(math.ceil((capacity - state.tokens) / rps))
+            state.in_flight += 1
+            if max_concurrency > 0:
+                headers["X-Concurrency-Remaining"] = str(max_concurrency - state.in_flight)
+            self._stats["allowed"] += 1
+        return Ticket(self, state, headers)
+
+    def _reject(self, key_id, reason, retry_after, headers):
+        # 调用方已持有锁
+        retry_after = max(math.ceil(retry_after), 1)
+        headers["Retry-After"] = str(retry_after)
+        key = (key_id, quota.today(), reason)
+        self._pending[key] = self._pending.get(key, 0) + 1
+        self._stats[reason] += 1
+        if self._thread_pid != os.getpid() and self.interval > 0:
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="rate-limit-flusher", daemon=True).start()
+        return RateLimited(reason, retry_after, headers)
+
+    # --- 拒绝次数 ---
+    def _run(self):
+        while self._thread_pid == os.getpid():
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """把合并的拒绝次数在一个事务中写入数据库"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+        try:
+            db = self.connect()
+            try:
+                db.executemany(
+                    """
+                    INSERT INTO api_rate_limit_rejections (api_key_id, day, reason, count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (api_key_id, day, reason) DO UPDATE SET count = count + excluded.count
+                    """,
+                    [(key_id, day, reason, count) for (key_id, day, reason), count in pending.items()],
+                )
+                db.commit()
+            finally:
+                db.close()
+        except Exception:
+            # 写入失败时放回，下次再试
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + count
+                self._stats["errors"] += 1
+            return 0
+        with self._lock:
+            self._stats["flushes"] += 1
+        return len(pending)
+
+    def rejections(self, db, key_id, day=None):
+        """某密钥的拒绝次数：返回 (当天, 累计)，各为 {reason: 次数}"""
+        self.flush()
+        day = day or quota.today()
+        today = dict.fromkeys(REASONS, 0)
+        total = dict.fromkeys(REASONS, 0)
+        for row in db.execute(
+            "SELECT day, reason, count FROM api_rate_limit_rejections WHERE api_key_id = ?", (key_id,)
+        ).fetchall():
+            if row[1] not in total:
+                continue
+            total[row[1]] += row[2]
+            if row[0] == day:
+                today[row[1]] += row[2]
+        return today, total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["keys"] = len(self._states)
+            stats["in_flight"] = sum(state.in_flight for state in self._states.values())
+            stats["pending"] = sum(self._pending.values())
+        return stats
@@ -0,0 +1,262 @@
+"""进程内的上游请求合并（single-flight）：参数完全相同的并发合成只调用一次上游。
+
+第一个请求调用上游，同时到达的相同请求等待并共享同一份音频。上游响应体写入共享缓冲区，
+每个请求各自从头读取，读到缓冲区末尾的请求负责从上游取下一块，因此流式响应同样可以合并，
+某个客户端慢或断开也不影响其他请求。上游输出完毕后合并结束，之后的请求由合成缓存或新的
+上游调用处理。计费和用量记录仍在各请求自己的路由中进行。
+"""
+import asyncio
+import os
+import threading
+
+
+class _Flight:
+    """一次进行中的上游调用及其共享缓冲区"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.ready = False
+        self.shared = False  # 上游返回可共享的 200 响应
+        self.error = None  # 上游调用失败时的异常，等待中的请求同样抛出
+        self.template = None  # 状态码和响应头的来源
+        self.source = None  # 上游响应体
+        self.iterator = None
+        self.chunks = []
+        self.done = False
+        self.failure = None  # 上游响应体输出中途失败
+        self.pumping = False
+        self.readers = 0
+        self.followers = 0
+
+
+class _Reader:
+    """某个请求读取共享缓冲区的响应体；close 时最后一个读者会中止尚未完成的上游输出"""
+
+    def __init__(self, group, key, flight):
+        self.group = group
+        self.key = key
+        self.flight = flight
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self.flight
+        while True:
+            with flight.cond:
+                while self.index >= len(flight.chunks) and not flight.done and flight.pumping:
+                    flight.cond.wait()
+                if self.index < len(flight.chunks):
+                    chunk = flight.chunks[self.index]
+                    self.index += 1
+                    return chunk
+                if flight.done:
+                    if flight.failure is not None:
+                        raise flight.failure
+                    raise StopIteration
+                flight.pumping = True
+            self.group._pump(self.key, flight)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.group._detach(self.key, self.flight)
+
+
+class SingleFlight:
+    """按键合并同步（线程中）和异步（事件循环中）的上游调用；两者各自合并，互不共享"""
+
+    def __init__(self, enabled=True, metrics_registry=None):
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> _Flight
+        self._tasks = {}  # (事件循环, key) -> asyncio.Task
+        self._pid = os.getpid()
+        self._stats = {"leaders": 0, "followers": 0, "shared_errors": 0, "aborted": 0}
+        self._coalesced = None
+        if metrics_registry is not None:
+            self._coalesced = metrics_registry.counter(
+                "tts_upstream_coalesced_total",
+                "Synthesis requests served by joining an identical in-flight upstream call",
+                ("provider",),
+            )
+
+    def _check_pid(self):
+        # fork 出的子进程不继承父进程的进行中调用（调用方已持有锁）
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._flights.clear()
+            self._tasks.clear()
+
+    def _joined(self, provider):
+        self._stats["followers"] += 1
+        if self._coalesced is not None:
+            self._coalesced.inc(provider=provider)
+
+    # --- 同步 ---
+    def do(self, key, call, provider=""):
+        """调用 call() 或加入相同 key 的进行中调用，返回各自独立的响应对象
+
+        call() 返回带 status_code/headers/response 的响应（如 Flask Response）；只有 200 响应
+        会被共享，其他结果只返回给发起调用的请求，等待中的请求改为各自调用。
+        """
+        if not self.enabled:
+            return call()
+        with self._lock:
+            self._check_pid()
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._stats["leaders"] += 1
+            else:
+                self._joined(provider)
+            with flight.cond:
+                flight.readers += 1
+                if not leader:
+                    flight.followers += 1
+
+        if leader:
+            return self._lead(key, flight, call)
+
+        with flight.cond:
+            while not flight.ready:
+                flight.cond.wait()
+        if flight.error is not None:
+            self._detach(key, flight)
+            with self._lock:
+                self._stats["shared_errors"] += 1
+            raise flight.error
+        if not flight.shared:
+            self._detach(key, flight)
+            return call()
+        return self._clone(key, flight)
+
+    def _lead(self, key, flight, call):
+        try:
+            result = call()
+        except Exception as e:
+            self._settle(key, flight, error=e)
+            self._detach(key, flight)
+            raise
+        if getattr(result, "status_code", None) != 200:
+            self._settle(key, flight)
+            self._detach(key, flight)
+            return result
+        flight.template = result
+        flight.source = result.response
+        self._settle(key, flight, shared=True)
+        return self._attach(result, _Reader(self, key, flight))
+
+    @staticmethod
+    def _attach(response, reader):
+        # 调用方可能再包装响应体（写缓存、转码等），外层生成器尚未开始就被关闭时不会关闭内层，
+        # 因此同时在响应关闭时关闭读者，保证离开的请求总能归还上游调用
+        response.response = reader
+        if hasattr(response, "call_on_close"):
+            response.call_on_close(reader.close)
+        return response
+
+    def _settle(self, key, flight, shared=False, error=None):
+        if not shared:
+            # 不可共享的结果：之后到达的相同请求重新发起调用
+            self._forget(key, flight)
+        with flight.cond:
+            flight.ready = True
+            flight.shared = shared
+            flight.error = error
+            flight.cond.notify_all()
+
+    def _clone(self, key, flight):
+        template = flight.template
+        response = template.__class__(status=template.status_code, headers=list(template.headers.items()))
+        response.headers["X-TTS-Coalesced"] = "1"
+        return self._attach(response, _Reader(self, key, flight))
+
+    def _pump(self, key, flight):
+        """从上游取下一块放入缓冲区（调用方已把 pumping 置为 True）"""
+        try:
+            if flight.iterator is None:
+                flight.iterator = iter(flight.source)
+            chunk = next(flight.iterator)
+        except StopIteration:
+            self._finish(key, flight)
+            return
+        except Exception as e:
+            self._finish(key, flight, e)
+            return
+        with flight.cond:
+            flight.chunks.append(chunk)
+            flight.pumping = False
+            flight.cond.notify_all()
+
+    def _finish(self, key, flight, failure=None):
+        self._forget(key, flight)
+        with flight.cond:
+            flight.done = True
+            flight.failure = failure
+            flight.pumping = False
+            flight.cond.notify_all()
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _detach(self, key, flight):
+        """某个请求不再读取；所有请求都离开而上游尚未输出完时关闭上游响应体"""
+        with self._lock:
+            with flight.cond:
+                flight.readers -= 1
+                abort = flight.readers == 0 and flight.source is not None and not flight.done
+                if abort:
+                    flight.done = True
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                    self._stats["aborted"] += 1
+        if abort and hasattr(flight.source, "close"):
+            flight.source.close()
+
+    # --- 异步 ---
+    async def do_async(self, key, call, provider=""):
+        """在事件循环中合并 await call()；上游调用在独立的任务中执行，个别请求取消不影响其他请求"""
+        if not self.enabled:
+            return await call()
+        loop = asyncio.get_running_loop()
+        task_key = (loop, key)
+        with self._lock:
+            self._check_pid()
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = self._tasks[task_key] = loop.create_task(call())
+                task.add_done_callback(lambda _: self._forget_task(task_key, task))
+                self._stats["leaders"] += 1
+            else:
+                self._joined(provider)
+        return await asyncio.shield(task)
+
+    def _forget_task(self, task_key, task):
+        if not task.cancelled():
+            # 所有等待的请求都已取消时，避免“异常未被读取”的警告
+            task.exception()
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["enabled"] = self.enabled
+            stats["in_flight"] = len(self._flights) + len(self._tasks)
+        return stats
+
+
+def create_singleflight_from_env(metrics_registry=None):
+    """根据环境变量创建上游请求合并"""
+    return SingleFlight(
+        enabled=os.environ.get("TTS_COALESCE_ENABLED", "1").lower() not in ("0", "false", "no"),
+        metrics_registry=metrics_registry,
+    )
@@ -58,6 +58,10 @@ document.addEventListener('DOMContentLoaded', () => {
             'key-name': '密钥名称',
             'key-name-placeholder': '例如: 我的项目API密钥',
             'daily-limit': '每日调用限制',
+            'rps-limit': '每秒请求数',
+            'burst-limit': '突发容量',
+            'concurrency-limit': '最大并发请求',
+            'limits-hint': '0 表示不限制；突发容量为 0 时等于每秒请求数',
             'provider-permissions': '允许的服务商',
             'existing-keys': '现有API密钥',
             'loading-keys': '正在加载...',
@@ -88,6 +92,8 @@ document.addEventListener('DOMContentLoaded', () => {
             'key-created': 'API密钥创建成功',
             'key-deleted': 'API密钥删除成功',
             'confirm-delete': '确定要删除这个API密钥吗？',
+            'edit-limits': '编辑限制',
+            'unlimited': '不限制',
             
             // 状态信息
             'processing': '正在处理...',
@@ -152,6 +158,10 @@ document.addEventListener('DOMContentLoaded', () => {
             'key-name': 'Key Name',
             'key-name-placeholder': 'e.g., My Project API Key',
             'daily-limit': 'Daily Call Limit',
+            'rps-limit': 'Requests per Second',
+            'burst-limit': 'Burst Capacity',
+            'concurrency-limit': 'Max Concurrent Requests',
+            'limits-hint': '0 means unlimited; a burst of 0 equals the requests per second',
             'provider-permissions': 'Allowed Providers',
             'existing-keys': 'Existing API Keys',
             'loading-keys': 'Loading...',
@@ -182,6 +192,8 @@ document.addEventListener('DOMContentLoaded', () => {
             'key-created': 'API Key Created Successfully',
             'key-deleted': 'API Key Deleted Successfully',
             'confirm-delete': 'Are you sure you want to delete this API key?',
+            'edit-limits': 'Edit Limits',
+            'unlimited': 'Unlimited',
             
             // 状态信息
             'processing': 'Processing...',
@@ -304,6 +316,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const apiKeysContainer = document.getElementById('api-keys-container');
     const newKeyName = document.getElementById('new-key-name');
     const dailyLimit = document.getElementById('daily-limit');
+    const rpsLimit = document.getElementById('rps-limit');
+    const burstLimit = document.getElementById('burst-limit');
+    const concurrencyLimit = document.getElementById('concurrency-limit');
     const providerOpenai = document.getElementById('provider-openai');
     const providerGemini = document.getElementById('provider-gemini');
     const createKeyStatus = document.getElementById('create-key-status');
@@ -546,6 +561,8 @@ document.addEventListener('DOMContentLoaded', () => {
                     <div class="key-details">
                         <p><strong>API密钥:</strong> <code class="api-key-display">${key.api_key_masked}</code></p>
                         <p><strong>每日限制:</strong> ${key.daily_limit}</p>
+                        <p><strong>速率限制:</strong> ${formatRateLimit(key)}</p>
+                        <p><strong>并发限制:</strong> ${key.concurrency_limit || getLocalizedText('unlimited')}</p>
                         <p><strong>允许服务商:</strong> ${key.provider_permissions.join(', ')}</p>
                         <p><strong>创建时间:</strong> ${new Date(key.created_at).toLocaleString()}</p>
                         ${key.last_used_at ? `<p><strong>最后使用:</strong> ${new Date(key.last_used_at).toLocaleString()}</p>` : ''}
@@ -555,6 +572,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     <button class="btn-small toggle-key-btn" data-key-id="${key.id}" data-is-active="${key.is_active}">
                         ${key.is_active ? '禁用' : '启用'}
                     </button>
+                    <button class="btn-small edit-limits-btn" data-key-id="${key.id}"
+                        data-rps="${key.rps_limit || 0}" data-burst="${key.burst_limit || 0}"
+                        data-concurrency="${key.concurrency_limit || 0}">
+                        ${getLocalizedText('edit-limits')}
+                    </button>
                     <button class="btn-small delete-key-btn" data-key-id="${key.id}">
                         ${getLocalizedText('delete-key')}
                     </button>
@@ -569,11 +591,21 @@ document.addEventListener('DOMContentLoaded', () => {
             btn.addEventListener('click', toggleApiKey);
         });
 
+        apiKeysContainer.querySelectorAll('.edit-limits-btn').forEach(btn => {
+            btn.addEventListener('click', editApiKeyLimits);
+        });
+
         apiKeysContainer.querySelectorAll('.delete-key-btn').forEach(btn => {
             btn.addEventListener('click', deleteApiKey);
         });
     }
 
+    function formatRateLimit(key) {
+        if (!key.rps_limit) return getLocalizedText('unlimited');
+        const burst = key.burst_limit || Math.max(Math.ceil(key.rps_limit), 1);
+        return `${key.rps_limit} 次/秒 (突发 ${burst})`;
+    }
+
     async function createApiKey() {
         if (!newKeyName || !dailyLimit || !providerOpenai || !providerGemini) return;
         
@@ -606,7 +638,10 @@ document.addEventListener('DOMContentLoaded', () => {
                 body: JSON.stringify({
                     key_name: keyName,
                     daily_limit: limit,
-                    provider_permissions: providers
+                    provider_permissions: providers,
+                    rps_limit: parseFloat(rpsLimit.value) || 0,
+                    burst_limit: parseInt(burstLimit.value) || 0,
+                    concurrency_limit: parseInt(concurrencyLimit.value) || 0
                 })
             });
             
@@ -626,6 +661,9 @@ document.addEventListener('DOMContentLoaded', () => {
             // 清空表单
             newKeyName.value = '';
             dailyLimit.value = '1000';
+            rpsLimit.value = '0';
+            burstLimit.value = '0';
+            concurrencyLimit.value = '0';
             providerOpenai.checked = true;
             providerGemini.checked = true;
             
@@ -657,6 +695,31 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    async function editApiKeyLimits(event) {
+        const btn = event.target;
+        const limits = {};
+        for (const [field, name, current] of [
+            ['rps_limit', 'rps-limit', btn.dataset.rps],
+            ['burst_limit', 'burst-limit', btn.dataset.burst],
+            ['concurrency_limit', 'concurrency-limit', btn.dataset.concurrency]
+        ]) {
+            const value = prompt(`${getLocalizedText(name)} (${getLocalizedText('limits-hint')})`, current);
+            if (value === null) return;
+            limits[field] = Number(value) || 0;
+        }
+        
+        try {
+            await apiFetch(`/api/keys/${btn.dataset.keyId}/limits`, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(limits)
+            });
+            await loadApiKeys();
+        } catch (error) {
+            alert(getLocalizedText('error') + ': ' + error.message);
+        }
+    }
+
     async function deleteApiKey(event) {
         const keyId = event.target.dataset.keyId;
         
@@ -897,9 +960,20 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorData.error || 'Failed to generate audio.');
             }
             
-            // The response is audio data. We need to convert it to a playable format.
-            const audioBlob = await response.blob();
-            const audioUrl = URL.createObjectURL(audioBlob);
+            // 服务端保存的音频有稳定URL，支持 Range 请求，拖动进度和断点续传不会重新合成
+            const audioId = response.headers.get('X-TTS-Audio-Id');
+            const storedUrl = audioId ? `/api/audio/${audioId}` : null;
+            let audioBlob = null;
+            let audioUrl;
+            if (storedUrl && response.headers.get('X-TTS-Cache') === 'HIT') {
+                // 已保存的音频无需下载整个响应体，播放器按需分段读取
+                response.body.cancel();
+                audioUrl = storedUrl;
+            } else {
+                // 新合成的音频：读完响应体（服务端随之保存），本次直接播放已下载的数据
+                audioBlob = await response.blob();
+                audioUrl = URL.createObjectURL(audioBlob);
+            }
             currentAudioUrl = audioUrl; // 保存当前音频URL以便后续清理
             
             // Create a wrapper for audio controls and download button
@@ -947,9 +1021,16 @@ document.addEventListener('DOMContentLoaded', () => {
                     
                     try {
                         // 重新获取音频数据以跟踪下载进度
-                        const response = await fetch(audioUrl);
+                        let response = storedUrl ? await fetch(storedUrl) : null;
+                        if ((!response || !response.ok) && audioUrl !== storedUrl) {
+                            // 音频未保存或已过期时改用本次已下载的数据
+                            response = await fetch(audioUrl);
+                        }
+                        if (!response.ok) {
+                            throw new Error('Failed to download audio.');
+                        }
                         const reader = response.body.getReader();
-                        const contentLength = +response.headers.get('Content-Length') || audioBlob.size;
+                        const contentLength = +response.headers.get('Content-Length') || (audioBlob ? audioBlob.size : 0);
                         
                         let receivedLength = 0;
                         let chunks = [];
@@ -0,0 +1,207 @@
+"""结构化日志：级别、请求 ID、超长字段截断、调试事件采样，经队列由后台线程写出。
+
+调用方照常使用标准库 logging，附加字段通过 extra 传入：
+
+    logger.info("Proxy audio received", extra={"provider": "gemini", "bytes": 12345})
+
+请求线程只把日志记录放入有界队列，格式化和写 stderr 都在后台线程中完成；
+队列满时丢弃新记录并计数，不阻塞请求。
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# 当前请求的 ID；请求开始时设置，后台任务可设置为任务 ID
+request_id = contextvars.ContextVar("tts_request_id", default="-")
+
+# LogRecord 自带的属性，其余属性视为 extra 附加字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def truncate(value, limit):
+    """截断超长字段；字节数据只记录长度，不写入内容"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if not isinstance(value, (str, int, float, bool, type(None))):
+        value = str(value)
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}...<{len(value) - limit} more chars>"
+    return value
+
+
+def record_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class RequestContextFilter(logging.Filter):
+    """在产生日志的线程中记下请求 ID（后台写出线程中已无法取得）"""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """DEBUG 级别的记录按比例采样，其余级别全部保留"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行 JSON，附加字段与固定字段并列"""
+
+    def __init__(self, max_field_chars=512):
+        super().__init__()
+        self.max_field_chars = max_field_chars
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": truncate(record.getMessage(), self.max_field_chars),
+        }
+        for key, value in record_fields(record).items():
+            entry[key] = truncate(value, self.max_field_chars)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """便于本地阅读的单行文本格式，附加字段以 key=value 追加在消息后"""
+
+    def __init__(self, max_field_chars=512):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+        self.max_field_chars = max_field_chars
+
+    def format(self, record):
+        record.message = truncate(record.getMessage(), self.max_field_chars)
+        fields = " ".join(
+            f"{key}={truncate(value, self.max_field_chars)}" for key, value in record_fields(record).items()
+        )
+        record.asctime = self.formatTime(record)
+        line = self.formatMessage(record) + (f" {fields}" if fields else "")
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """放入有界队列，由 QueueListener 线程写出；fork 后的子进程会重新启动写出线程"""
+
+    def __init__(self, handlers, queue_size=10000):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.handlers = list(handlers)
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._stopped = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # 父进程的写出线程没有被继承，换一个新队列
+                self.queue = queue.Queue(maxsize=self.queue_size)
+            self._pid = os.getpid()
+            self._listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+
+    def stop(self):
+        """写出队列中剩余的记录（进程退出时调用）"""
+        self._stopped = True
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def prepare(self, record):
+        # 只合并消息参数、固化异常文本，格式化留给写出线程
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._stopped:
+            # 进程退出阶段（如垃圾回收时）产生的记录直接写出，不再启动写出线程
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+
+
+def configure_from_env():
+    """根据环境变量配置根日志器，可重复调用（只配置一次）
+
+    TTS_LOG_LEVEL: 日志级别，默认 INFO
+    TTS_LOG_FORMAT: json（默认）或 text
+    TTS_LOG_DEBUG_SAMPLE_RATE: DEBUG 记录的采样比例，默认 1（全部保留）
+    TTS_LOG_MAX_FIELD_CHARS: 单个字段的最大长度，默认 512
+    TTS_LOG_QUEUE_SIZE: 待写出队列长度，默认 10000
+    """
+    global _handler
+    if _handler is not None:
+        return _handler
+    max_field_chars = int(os.environ.get("TTS_LOG_MAX_FIELD_CHARS", 512))
+    if os.environ.get("TTS_LOG_FORMAT", "json").lower() == "text":
+        formatter = TextFormatter(max_field_chars)
+    else:
+        formatter = JsonFormatter(max_field_chars)
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+
+    _handler = AsyncQueueHandler([stream], queue_size=int(os.environ.get("TTS_LOG_QUEUE_SIZE", 10000)))
+    _handler.addFilter(RequestContextFilter())
+    _handler.addFilter(DebugSamplingFilter(float(os.environ.get("TTS_LOG_DEBUG_SAMPLE_RATE", 1))))
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("TTS_LOG_LEVEL", "INFO").upper())
+    root.addHandler(_handler)
+    atexit.register(_handler.stop)
+    return _handler
+
+
+def stats():
+    if _handler is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "level": logging.getLevelName(logging.getLogger().level),
+        "queued": _handler.queue.qsize(),
+        "dropped": _handler.dropped,
+    }
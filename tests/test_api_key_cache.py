@@ -0,0 +1,54 @@
+"""认证缓存的跨进程失效检查和当日已用次数缓存。
+
+运行：python -m pytest -q tests
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from api_key_cache import ApiKeyCache  # noqa: E402
+
+
+def test_generation_checked_at_most_once_per_interval(tmp_path, monkeypatch):
+    marker = str(tmp_path / "keys-gen")
+    writer = ApiKeyCache(generation_file=marker)
+    reader = ApiKeyCache(generation_file=marker, generation_interval=0.2)
+    reader.put("k", {"id": 1})
+    reader.put_quota(1, "2026-01-01", 3)
+
+    reads = []
+    real_read = ApiKeyCache._read_generation
+    monkeypatch.setattr(ApiKeyCache, "_read_generation", staticmethod(lambda path: reads.append(path) or real_read(path)))
+    for _ in range(100):
+        assert reader.get("k") == (True, {"id": 1})
+    assert reads == []
+
+    writer.invalidate(1)
+    time.sleep(0.25)
+    assert reader.get("k") == (False, None)
+    assert reader.get_quota(1, "2026-01-01") is None
+
+
+def test_quota_cached_per_day_until_refund():
+    cache = ApiKeyCache(quota_ttl=5)
+    cache.put_quota(1, "2026-01-01", 10)
+    assert cache.get_quota(1, "2026-01-01") == 10
+    assert cache.get_quota(1, "2026-01-02") is None
+    cache.forget_quota(1)
+    assert cache.get_quota(1, "2026-01-01") is None
+
+
+def test_refund_in_other_worker_drops_cached_quota(tmp_path):
+    marker = str(tmp_path / "quota-gen")
+    refunder = ApiKeyCache(quota_generation_file=marker)
+    worker = ApiKeyCache(quota_generation_file=marker, generation_interval=0.2)
+    worker.put_quota(1, "2026-01-01", 10)
+    worker.put_quota(2, "2026-01-01", 10)
+
+    refunder.forget_quota(1)
+    time.sleep(0.25)
+    assert worker.get_quota(1, "2026-01-01") is None
+    assert worker.get_quota(2, "2026-01-01") is None
@@ -0,0 +1,113 @@
+"""客户端中途断开后，合并的上游调用、准入名额和每日额度都应归还。
+
+运行：python -m pytest -q tests
+"""
+import contextlib
+import importlib
+import io
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp()
+os.environ.update(
+    DATABASE_PATH=os.path.join(TMP, "tts.db"),
+    TTS_CACHE_DIR=os.path.join(TMP, "cache"),
+    TTS_TRANSCODER="none",
+    TTS_ADMISSION_MAX_CONCURRENCY="2",
+    TTS_ADMISSION_MAX_WAIT="1",
+    TTS_LOG_LEVEL="ERROR",
+)
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope="module", params=["app_production", "app"])
+def client(request):
+    server, url = benchmark.start_fake_upstream(0.2)
+    module = importlib.import_module(request.param)
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.init_db()
+    c = module.app.test_client()
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    c.post("/api/settings", json={
+        "service_name": "openai", "api_key": "k", "api_endpoint": url + "/v1", "model_name": "tts-1",
+    })
+    key = c.post("/api/keys", json={"key_name": "disconnect"}).get_json()["api_key"]
+    yield module, {"Authorization": "Bearer " + key}
+    server.shutdown()
+
+
+def active(module):
+    return sum(gate["active"] for gate in module.upstream_admission.stats()["gates"])
+
+
+def synthesize(module, headers, text, read=0, **extra):
+    """发起合成请求，读取 read 块后断开"""
+    response = module.app.test_client().post(
+        "/api/v1/tts/synthesize", json=dict(text=text, provider="openai", **extra), headers=headers, buffered=False
+    )
+    body = iter(response.response)
+    for _ in range(read):
+        next(body, None)
+    response.close()
+    return response.status_code
+
+
+@pytest.mark.parametrize("read", [0, 1])
+@pytest.mark.parametrize("extra", [{}, {"return_base64": True}])
+def test_disconnect_releases_admission(client, read, extra):
+    module, headers = client
+    for i in range(10):
+        assert synthesize(module, headers, f"disconnect {read} {extra} {i}", read, **extra) == 200
+    assert active(module) == 0
+    assert module.upstream_flights.stats()["in_flight"] == 0
+    assert module.provider_clients.stats()["leased"] == 0
+
+
+def test_coalesced_disconnect_releases_admission(client):
+    module, headers = client
+    statuses = []
+    threads = [
+        threading.Thread(target=lambda: statuses.append(synthesize(module, headers, "coalesced disconnect")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 8
+    assert active(module) == 0
+    assert module.upstream_flights.stats()["in_flight"] == 0
+    assert module.provider_clients.stats()["leased"] == 0
+    # 名额已归还，新的请求不会被 503 拒绝
+    assert synthesize(module, headers, "after disconnect", read=100) == 200
+
+
+@pytest.mark.parametrize("extra", [{}, {"return_base64": True}])
+def test_disconnect_refunds_quota_and_logs_failure(client, extra):
+    module, _ = client
+    c = module.app.test_client()
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    created = c.post("/api/keys", json={"key_name": f"refund {extra}"}).get_json()
+    headers = {"Authorization": "Bearer " + created["api_key"]}
+    with module.app.app_context():
+        key_id = module.get_db().execute(
+            "SELECT id FROM api_keys WHERE key_name = ?", (f"refund {extra}",)
+        ).fetchone()[0]
+    assert synthesize(module, headers, f"refund {extra}", **extra) == 200
+    assert synthesize(module, headers, f"complete {extra}", read=100, **extra) == 200
+    module.usage_writer.flush()
+    with module.app.app_context():
+        db = module.get_db()
+        assert module.quota.used(db, key_id) == 1
+        rows = db.execute(
+            "SELECT success FROM api_usage WHERE api_key_id = ? ORDER BY id", (key_id,)
+        ).fetchall()
+    assert [row[0] for row in rows] == [0, 1]
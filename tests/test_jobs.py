@@ -0,0 +1,107 @@
+"""上游持续满载时，异步任务不会无限占用工作线程：超时或被取消后失败并退还额度。
+
+运行：python -m pytest -q tests
+"""
+import contextlib
+import importlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp()
+for name, value in (
+    ("DATABASE_PATH", os.path.join(TMP, "tts.db")),
+    ("TTS_CACHE_DIR", os.path.join(TMP, "cache")),
+    ("TTS_JOB_RESULT_DIR", os.path.join(TMP, "jobs")),
+    ("TTS_TRANSCODER", "none"),
+    ("TTS_LOG_LEVEL", "ERROR"),
+):
+    os.environ.setdefault(name, value)
+
+import admission  # noqa: E402
+
+
+@pytest.fixture(scope="module", params=["app_production", "app"])
+def client(request):
+    module = importlib.import_module(request.param)
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.init_db()
+    c = module.app.test_client()
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    c.post("/api/settings", json={
+        "service_name": "openai", "api_key": "k", "api_endpoint": "http://127.0.0.1:9/v1", "model_name": "tts-1",
+    })
+    module.job_queue.poll_interval = 0.05
+    yield module, c
+    module.job_queue.poll_interval = 1.0
+
+
+@pytest.fixture
+def overloaded(client, monkeypatch):
+    """让任务的每次合成都被准入控制拒绝，返回调用次数列表"""
+    module, _ = client
+    calls = []
+
+    def synthesize_item(item):
+        calls.append(item)
+        raise admission.Overloaded("openai", "default", "queue_full", 0.2)
+
+    monkeypatch.setattr(module, "synthesize_item", synthesize_item)
+    return calls
+
+
+def new_key(module, c, name):
+    api_key = c.post("/api/keys", json={"key_name": name}).get_json()["api_key"]
+    with module.app.app_context():
+        key_id = module.get_db().execute("SELECT id FROM api_keys WHERE key_name = ?", (name,)).fetchone()[0]
+    return {"Authorization": "Bearer " + api_key}, key_id
+
+
+def submit(c, headers, text):
+    response = c.post("/api/v1/tts/jobs", json={"text": text, "provider": "openai"}, headers=headers)
+    assert response.status_code == 202, response.get_json()
+    return response.get_json()["data"]["id"]
+
+
+def used_today(module, key_id):
+    with module.app.app_context():
+        return module.quota.used(module.get_db(), key_id)
+
+
+def test_job_fails_after_overload_timeout(client, overloaded, monkeypatch):
+    module, c = client
+    monkeypatch.setattr(module, "JOB_OVERLOAD_TIMEOUT", 2)
+    headers, key_id = new_key(module, c, f"overload timeout {module.__name__}")
+    job_id = submit(c, headers, "overload timeout")
+
+    job = c.get(f"/api/v1/tts/jobs/{job_id}?wait=10", headers=headers).get_json()["data"]
+    assert job["status"] == "failed"
+    assert "overloaded" in job["error"]
+    assert len(overloaded) >= 2
+    assert used_today(module, key_id) == 0
+
+
+def test_cancel_while_waiting_frees_worker(client, overloaded, monkeypatch):
+    module, c = client
+    monkeypatch.setattr(module, "JOB_OVERLOAD_TIMEOUT", 600)
+    headers, key_id = new_key(module, c, f"overload cancel {module.__name__}")
+    job_id = submit(c, headers, "overload cancel")
+
+    deadline = time.monotonic() + 10
+    while not overloaded and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert overloaded
+    assert c.delete(f"/api/v1/tts/jobs/{job_id}", headers=headers).status_code == 200
+
+    deadline = time.monotonic() + 5
+    while module.job_queue.stats()["running"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert module.job_queue.stats()["running"] == 0
+    assert used_today(module, key_id) == 0
@@ -0,0 +1,76 @@
+"""多进程指标汇总：已退出进程的计数并入归档、快照文件被删除，进程号复用时计数不回退。
+
+运行：python -m pytest -q tests
+"""
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics  # noqa: E402
+
+DEAD_PID = 2 ** 22 + 12345  # 超过 Linux 默认 pid_max，不会是正在运行的进程
+
+
+def registry(directory, started=None):
+    r = metrics.Registry(multiprocess_dir=str(directory))
+    if started is not None:
+        r._started = started
+    r.counter("tts_test_total", "Test counter").inc(0)
+    r.gauge("tts_test_active", "Test gauge").set(0)
+    return r
+
+
+def write_dead_snapshot(directory, pid, count, active):
+    snapshot = {
+        "tts_test_total": {"type": "counter", "help": "Test counter", "labels": [], "series": [[[], count]]},
+        "tts_test_active": {"type": "gauge", "help": "Test gauge", "labels": [], "series": [[[], active]]},
+    }
+    with open(os.path.join(directory, f"{pid}-1.json"), "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+
+
+def snapshot_files(directory):
+    return sorted(name for name in os.listdir(directory) if metrics._snapshot_key(name))
+
+
+def test_dead_worker_folded_into_archive(tmp_path):
+    write_dead_snapshot(tmp_path, DEAD_PID, 5, 3)
+    r = registry(tmp_path)
+    r.counter("tts_test_total", "Test counter").inc(2)
+
+    for _ in range(2):
+        text = r.render()
+        assert "tts_test_total 7" in text
+        assert "tts_test_active 0" in text  # 已退出进程的仪表盘不计入
+    assert snapshot_files(tmp_path) == []
+    assert os.path.exists(tmp_path / metrics.ARCHIVE_NAME)
+
+
+def test_mark_process_dead_and_exit_remove_snapshots(tmp_path):
+    write_dead_snapshot(tmp_path, DEAD_PID, 5, 3)
+    metrics.mark_process_dead(DEAD_PID, str(tmp_path))
+    assert snapshot_files(tmp_path) == []
+
+    worker = registry(tmp_path)
+    worker.counter("tts_test_total", "Test counter").inc(4)
+    worker._writer_pid = os.getpid()  # 相当于已调用 start()
+    worker._exit()
+    worker.write_snapshot()  # 退出后不再写出快照
+    assert snapshot_files(tmp_path) == []
+    assert "tts_test_total 9" in registry(tmp_path).render()
+
+
+def test_reused_pid_does_not_overwrite_counts(tmp_path):
+    # 同一进程号先后两个进程：新进程的快照不覆盖旧进程的计数
+    old = registry(tmp_path, started=1)
+    old.counter("tts_test_total", "Test counter").inc(5)
+    old.write_snapshot()
+    new = registry(tmp_path)
+    new.counter("tts_test_total", "Test counter").inc(2)
+    new.write_snapshot()
+
+    assert "tts_test_total 7" in new.render()
+    assert snapshot_files(tmp_path) == [new._snapshot_name()]
@@ -0,0 +1,106 @@
+"""SDK 客户端注册表：被淘汰的客户端在最后一个借用者归还后才关闭；代理会话不重试计费的 POST，
+连接复用和并发情况导出为指标。
+
+运行：python -m pytest -q tests
+"""
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics  # noqa: E402
+from provider_clients import ClientRegistry, ProxySessionPool  # noqa: E402
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def registry(**kwargs):
+    clients = ClientRegistry(**kwargs)
+    clients._build_openai = lambda api_key, api_endpoint: FakeClient()
+    return clients
+
+
+def test_invalidate_waits_for_last_release():
+    clients = registry()
+    first, release_first = clients.lease("openai", "k")
+    second, release_second = clients.lease("openai", "k")
+    assert first is second
+
+    assert clients.invalidate("openai", "k") == 1
+    assert not first.closed
+    replacement, release_replacement = clients.lease("openai", "k")
+    assert replacement is not first
+
+    release_first()
+    release_first()  # 重复归还不影响计数
+    assert not first.closed
+    release_second()
+    assert first.closed
+    assert clients.stats()["retiring"] == 0
+
+    release_replacement()
+    assert not replacement.closed
+    assert clients.invalidate("openai") == 1
+    assert replacement.closed
+
+
+def test_evicted_client_closed_after_release():
+    clients = registry(max_clients=1)
+    first, release_first = clients.lease("openai", "a")
+    second, release_second = clients.lease("openai", "b")
+    assert not first.closed
+    assert clients.stats()["retiring"] == 1
+    release_first()
+    assert first.closed
+    release_second()
+    assert not second.closed
+
+
+def test_proxy_retries_only_idempotent_status_errors():
+    retry = ProxySessionPool().session("http://proxy.example").get_adapter("http://proxy.example").max_retries
+    assert not retry.is_retry("POST", 503)
+    assert retry.is_retry("GET", 503)
+    assert retry.connect == 2
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_proxy_pool_exports_connection_metrics():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        registry = metrics.Registry()
+        pool = ProxySessionPool(metrics_registry=registry)
+        for _ in range(3):
+            assert pool.get(origin + "/audio").content == b"ok"
+        text = registry.render()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    label = f'{{origin="{origin}"}}'
+    assert f"tts_proxy_requests_total{label} 3" in text
+    assert f"tts_proxy_connections_opened_total{label} 1" in text
+    assert f"tts_proxy_connections_reused_total{label} 2" in text
+    assert f"tts_proxy_requests_in_flight{label} 0" in text
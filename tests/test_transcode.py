@@ -0,0 +1,87 @@
+"""转码器满载拒绝请求时，源响应（合并的上游调用、准入名额）同样要归还。
+
+运行：python -m pytest -q tests
+"""
+import contextlib
+import importlib
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp()
+for name, value in (
+    ("DATABASE_PATH", os.path.join(TMP, "tts.db")),
+    ("TTS_CACHE_DIR", os.path.join(TMP, "cache")),
+    ("TTS_TRANSCODER", "none"),
+    ("TTS_LOG_LEVEL", "ERROR"),
+):
+    os.environ.setdefault(name, value)
+
+import benchmark  # noqa: E402
+import transcode  # noqa: E402
+
+
+class PassthroughEncoder:
+    """不依赖 ffmpeg/lameenc 的假编码器：原样输出源音频"""
+
+    name = "passthrough"
+    formats = ("mp3",)
+
+    def available(self):
+        return True
+
+    def encode(self, chunks, format):
+        for chunk in chunks:
+            yield bytes(chunk)
+
+
+@pytest.fixture(scope="module", params=["app_production", "app"])
+def client(request):
+    server, url = benchmark.start_fake_upstream(0.05)
+    module = importlib.import_module(request.param)
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.init_db()
+    c = module.app.test_client()
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    c.post("/api/settings", json={
+        "service_name": "gemini", "api_key": "g", "api_endpoint": url,
+        "model_name": "gemini-2.5-flash-preview-tts",
+    })
+    key = c.post("/api/keys", json={"key_name": "transcode"}).get_json()["api_key"]
+    saved = module.transcoder
+    module.transcoder = transcode.Transcoder([PassthroughEncoder()], max_pending=1)
+    yield module, {"Authorization": "Bearer " + key}
+    module.transcoder = saved
+    server.shutdown()
+
+
+def synthesize(module, headers, text):
+    response = module.app.test_client().post(
+        "/api/v1/tts/synthesize", json={"text": text, "provider": "gemini", "format": "mp3"}, headers=headers
+    )
+    response.close()
+    return response
+
+
+def test_transcode_overload_releases_source(client):
+    module, headers = client
+    assert synthesize(module, headers, "transcode ok").status_code == 200
+
+    # 占满转码名额，之后的转码请求被拒绝
+    module.transcoder._slots.acquire()
+    try:
+        response = synthesize(module, headers, "transcode overloaded")
+    finally:
+        module.transcoder._slots.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+    assert module.transcoder.stats()["rejected"] == 1
+    assert sum(gate["active"] for gate in module.upstream_admission.stats()["gates"]) == 0
+    assert module.upstream_flights.stats()["in_flight"] == 0
+    assert module.provider_clients.stats()["leased"] == 0
@@ -0,0 +1,58 @@
+"""使用记录后台写入：队列深度、每批写入耗时和丢弃记录数导出为指标。
+
+运行：python -m pytest -q tests
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics  # noqa: E402
+from usage_writer import UsageWriter  # noqa: E402
+
+ROW = (1, "openai", "tts-1", "alloy", 5, 0.1, 1, None, 0)
+
+
+def connect_to(path):
+    def connect():
+        db = sqlite3.connect(path)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS api_usage (api_key_id, provider, model, voice, text_length, "
+            "audio_duration, success, error_message, cached, created_at)"
+        )
+        return db
+    return connect
+
+
+def test_writer_exports_queue_flush_and_drop_metrics(tmp_path):
+    registry = metrics.Registry()
+    writer = UsageWriter(connect_to(str(tmp_path / "usage.db")), max_queue=1, flush_interval=0, overflow="drop",
+                         metrics_registry=registry)
+    # 挡住后台线程的第一次写入，让后续记录留在队列中
+    blocked = threading.Event()
+    original = writer._write_batch
+
+    def write_batch(rows):
+        blocked.wait(5)
+        original(rows)
+
+    writer._write_batch = write_batch
+    writer.submit(ROW)
+    deadline = time.monotonic() + 5
+    while writer._queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.submit(ROW)
+    assert "tts_usage_writer_queue_depth 1" in registry.render()
+    writer.submit(ROW)  # 队列已满：丢弃
+
+    blocked.set()
+    assert writer.flush()
+    text = registry.render()
+    assert "tts_usage_writer_queue_depth 0" in text
+    assert 'tts_usage_writer_dropped_total{reason="overflow"} 1' in text
+    assert "tts_usage_writer_flush_seconds_count 2" in text
+    writer.close()
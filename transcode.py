@@ -0,0 +1,421 @@
+"""服务端转码：把 Gemini 返回的 PCM WAV 转为 MP3/Opus/AAC/FLAC 等更紧凑的格式。
+
+编码后端可替换：本地 ffmpeg 可执行文件，或进程内的编码库（lameenc，仅 MP3）。
+转码在共享的工作线程池中执行，编码结果经有界队列边产出边输出。
+排队的转码数有上限（满载时抛出 admission.Overloaded，调用方返回 503），编码结果长时间没有进展时
+取消转码并抛出 TranscodeError，不会无限占用请求线程和转码线程。
+"""
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+
+MIMETYPES = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+}
+
+# 语音内容的默认码率（kbps）
+DEFAULT_BITRATES = {"mp3": 64, "opus": 32, "aac": 64}
+
+READ_SIZE = 64 * 1024
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def _iter_wav_pcm(chunks):
+    """从 WAV 分块流中解析头部，返回 (采样率, 声道数, 位深, PCM 分块迭代器)
+
+    流式生成的 WAV 的 data 长度可能未知，PCM 一律读到流结束为止。
+    """
+    chunks = iter(chunks)
+    head = b""
+    while True:
+        if len(head) >= 12 and (head[:4] != b"RIFF" or head[8:12] != b"WAVE"):
+            raise TranscodeError("Source is not a PCM WAV stream")
+        offset = 12
+        fmt = None
+        while len(head) >= 12 and offset + 8 <= len(head):
+            chunk_id, size = struct.unpack_from("<4sI", head, offset)
+            if chunk_id == b"fmt ":
+                if offset + 8 + 16 > len(head):
+                    break
+                fmt = struct.unpack_from("<HHIIHH", head, offset + 8)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise TranscodeError("WAV data chunk before fmt chunk")
+                rest = head[offset + 8:]
+
+                def pcm():
+                    if rest:
+                        yield rest
+                    yield from chunks
+
+                _, channels, sample_rate, _, _, bits_per_sample = fmt
+                return sample_rate, channels, bits_per_sample, pcm()
+            offset += 8 + size + (size & 1)
+        chunk = next(chunks, None)
+        if chunk is None or len(head) > 65536:
+            raise TranscodeError("Source is not a PCM WAV stream")
+        head += bytes(chunk)
+
+
+class FFmpegEncoder:
+    """调用本地 ffmpeg，WAV 从 stdin 输入，编码结果从 stdout 读出"""
+
+    name = "ffmpeg"
+    formats = ("mp3", "opus", "aac", "flac")
+
+    def __init__(self, binary="ffmpeg", bitrates=None):
+        self.binary = binary
+        self.bitrates = dict(DEFAULT_BITRATES, **(bitrates or {}))
+
+    def available(self):
+        return shutil.which(self.binary) is not None
+
+    def _args(self, format):
+        codecs = {
+            "mp3": ["-c:a", "libmp3lame", "-f", "mp3"],
+            "opus": ["-c:a", "libopus", "-f", "ogg"],
+            "aac": ["-c:a", "aac", "-f", "adts"],
+            "flac": ["-c:a", "flac", "-f", "flac"],
+        }[format]
+        if format in self.bitrates:
+            codecs = [*codecs[:2], "-b:a", f"{self.bitrates[format]}k", *codecs[2:]]
+        return [self.binary, "-hide_banner", "-loglevel", "error", "-f", "wav", "-i", "pipe:0", *codecs, "pipe:1"]
+
+    def encode(self, chunks, format):
+        process = subprocess.Popen(
+            self._args(format), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        feed_error = []
+
+        def feed():
+            # 单独线程写 stdin，避免 stdout 管道写满时双方互相等待
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        feeder = threading.Thread(target=feed, name="tts-transcode-feed", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                data = process.stdout.read1(READ_SIZE)
+                if not data:
+                    break
+                yield data
+            feeder.join()
+            stderr = process.stderr.read()
+            if process.wait() != 0:
+                raise TranscodeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace')[:500]}")
+            if feed_error and not isinstance(feed_error[0], BrokenPipeError):
+                raise feed_error[0]
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+
+class LameEncoder:
+    """进程内 MP3 编码（需要安装 lameenc），不依赖外部程序"""
+
+    name = "lameenc"
+    formats = ("mp3",)
+
+    def __init__(self, bitrates=None):
+        self.bitrates = dict(DEFAULT_BITRATES, **(bitrates or {}))
+
+    def available(self):
+        try:
+            import lameenc  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def encode(self, chunks, format):
+        import lameenc
+
+        sample_rate, channels, bits_per_sample, pcm = _iter_wav_pcm(chunks)
+        if bits_per_sample != 16:
+            raise TranscodeError(f"lameenc only supports 16-bit PCM, got {bits_per_sample}-bit")
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(self.bitrates["mp3"])
+        encoder.set_in_sample_rate(sample_rate)
+        encoder.set_channels(channels)
+        encoder.set_quality(5)
+        carry = b""
+        for chunk in pcm:
+            # 按完整的采样帧送入编码器
+            data = carry + bytes(chunk) if carry else chunk
+            usable = len(data) - len(data) % (2 * channels)
+            carry = bytes(data[usable:])
+            if usable:
+                encoded = encoder.encode(data[:usable])
+                if encoded:
+                    yield bytes(encoded)
+        yield bytes(encoder.flush())
+
+
+_DONE = object()
+
+
+class _Input:
+    """编码器读取的源音频分块；close 可在任意线程调用，正在读取时等本次读取返回后再关闭"""
+
+    def __init__(self, transcoder, chunks, close):
+        self.transcoder = transcoder
+        self.chunks = chunks
+        self.iterator = None
+        self.on_close = close or getattr(chunks, "close", None)
+        self.lock = threading.Lock()
+        self.reading = False
+        self.closing = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if self.closing:
+                raise StopIteration
+            self.reading = True
+        try:
+            if self.iterator is None:
+                self.iterator = iter(self.chunks)
+            chunk = next(self.iterator)
+        finally:
+            with self.lock:
+                self.reading = False
+                closing = self.closing
+            if closing:
+                self._close()
+        if closing:
+            raise StopIteration
+        self.transcoder._count("input_bytes", len(chunk))
+        return chunk
+
+    def close(self):
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+            if self.reading:
+                return
+        self._close()
+
+    def _close(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+
+class _Output:
+    """编码结果的分块迭代器；被关闭时（包括尚未开始读取时）取消转码"""
+
+    def __init__(self, transcoder, first, output, cancelled):
+        self.transcoder = transcoder
+        self.item = first
+        self.output = output
+        self.cancelled = cancelled
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item, self.item = self.item, None
+        if item is None:
+            try:
+                item = self.transcoder._get(self.output, self.cancelled)
+            except TranscodeError:
+                self.finished = True
+                raise
+        if item is _DONE:
+            self.finished = True
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.finished = True
+            self.transcoder._count("failures")
+            raise item
+        self.transcoder._count("output_bytes", len(item))
+        return item
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.cancelled.set()
+            self.transcoder._count("cancelled")
+
+
+class Transcoder:
+    """按目标格式选择可用的编码后端；同时进行的转码数由线程池大小限制
+
+    max_pending 为进行中和排队的转码总数上限（0 表示不限制），timeout 为等待下一段编码结果的最长秒数。
+    """
+
+    def __init__(self, encoders, max_workers=2, queue_size=16, max_pending=8, timeout=30.0):
+        self.encoders = list(encoders)
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-transcode")
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        self._lock = threading.Lock()
+        self._available = None
+        self._pending = 0
+        self._stats = {
+            "transcodes": 0, "failures": 0, "cancelled": 0, "rejected": 0, "timeouts": 0,
+            "input_bytes": 0, "output_bytes": 0,
+        }
+
+    def _encoders(self):
+        # 检测一次可用的后端（ffmpeg 是否在 PATH 中、编码库是否已安装）
+        if self._available is None:
+            self._available = [encoder for encoder in self.encoders if encoder.available()]
+        return self._available
+
+    def encoder_for(self, format):
+        for encoder in self._encoders():
+            if format in encoder.formats:
+                return encoder
+        return None
+
+    def formats(self):
+        return sorted({format for encoder in self._encoders() for format in encoder.formats})
+
+    def supports(self, format):
+        return self.encoder_for(format) is not None
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _work(self, encoder, source, format, output, cancelled):
+        def put(item):
+            # 客户端断开或等待超时后不再等待队列空位
+            while not cancelled.is_set():
+                try:
+                    output.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            encoded = encoder.encode(source, format)
+            try:
+                for data in encoded:
+                    if not put(data):
+                        return
+                put(_DONE)
+            except Exception as e:
+                put(e)
+            finally:
+                encoded.close()
+        finally:
+            source.close()
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def _get(self, output, cancelled):
+        try:
+            return output.get(timeout=self.timeout or None)
+        except queue.Empty:
+            cancelled.set()
+            self._count("timeouts")
+            raise TranscodeError(f"Transcode produced no output for {self.timeout}s")
+
+    def transcode(self, chunks, format, close=None):
+        """把 WAV 分块流转码为 format，返回编码结果的分块迭代器
+
+        等到第一段编码结果后才返回，编码器启动失败等错误在响应开始前抛出。close 为源音频用完后的
+        清理函数（默认关闭 chunks），转码完成、失败、被拒绝或被取消时都会调用一次。
+        """
+        source = _Input(self, chunks, close)
+        encoder = self.encoder_for(format)
+        if encoder is None:
+            source.close()
+            raise TranscodeError(f"No encoder available for '{format}'")
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            source.close()
+            self._count("rejected")
+            raise admission.Overloaded("transcode", "local", "queue_full", 1)
+        with self._lock:
+            self._pending += 1
+            self._stats["transcodes"] += 1
+        output = queue.Queue(maxsize=self.queue_size)
+        cancelled = threading.Event()
+        try:
+            self._executor.submit(self._work, encoder, source, format, output, cancelled)
+        except Exception:
+            source.close()
+            self._release()
+            raise
+        first = self._get(output, cancelled)
+        if isinstance(first, Exception):
+            self._count("failures")
+            raise first
+        return _Output(self, first, output, cancelled)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["encoders"] = [encoder.name for encoder in self._encoders()]
+        stats["formats"] = self.formats()
+        stats["max_workers"] = self.max_workers
+        stats["max_pending"] = self.max_pending
+        stats["timeout"] = self.timeout
+        stats["queued"] = self._executor._work_queue.qsize()
+        with self._lock:
+            stats["pending"] = self._pending
+        return stats
+
+
+def create_transcoder_from_env():
+    """根据环境变量创建转码器；TTS_TRANSCODER 为 auto 时按 ffmpeg、lameenc 的顺序使用可用的后端"""
+    bitrates = {
+        format: int(os.environ[f"TTS_TRANSCODE_{format.upper()}_KBPS"])
+        for format in DEFAULT_BITRATES if os.environ.get(f"TTS_TRANSCODE_{format.upper()}_KBPS")
+    }
+    names = os.environ.get("TTS_TRANSCODER", "auto").lower()
+    if names == "auto":
+        names = "ffmpeg,lameenc"
+    encoders = []
+    for name in (n.strip() for n in names.split(",")):
+        if name == "ffmpeg":
+            encoders.append(FFmpegEncoder(os.environ.get("TTS_FFMPEG_PATH", "ffmpeg"), bitrates))
+        elif name == "lameenc":
+            encoders.append(LameEncoder(bitrates))
+    max_workers = int(os.environ.get("TTS_TRANSCODE_WORKERS", 2))
+    return Transcoder(
+        encoders,
+        max_workers=max_workers,
+        max_pending=int(os.environ.get("TTS_TRANSCODE_MAX_PENDING", max_workers * 4)),
+        timeout=float(os.environ.get("TTS_TRANSCODE_TIMEOUT", 30)),
+    )
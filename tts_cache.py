@@ -0,0 +1,318 @@
+"""TTS 合成结果缓存：内存 LRU + 磁盘内容寻址存储。"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """规范化文本：Unicode NFC 并折叠多余空白，避免等价文本产生不同的缓存键"""
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.split())
+
+
+def make_cache_key(provider, model, voice, format, speed, text, endpoint, credential):
+    """根据合成参数计算内容寻址的缓存键（SHA-256）
+
+    endpoint 和 credential（上游 API 密钥）区分不同的上游和账号：同样的参数发往不同的代理或
+    账号可能得到不同的音频，也不应共享彼此的结果。密钥只以摘要形式参与计算。
+    """
+    try:
+        speed = float(speed if speed is not None else 1.0)
+    except (TypeError, ValueError):
+        speed = 1.0
+    material = json.dumps(
+        [
+            (provider or "").lower(),
+            model or "",
+            voice or "",
+            (format or "").lower(),
+            round(speed, 3),
+            normalize_text(text),
+            (endpoint or "").strip().rstrip("/"),
+            hashlib.sha256((credential or "").encode("utf-8")).hexdigest(),
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    """缓存条目，音频以分块形式保存以避免拼接大缓冲区"""
+
+    __slots__ = ("key", "chunks", "mimetype", "size", "created_at")
+
+    def __init__(self, key, chunks, mimetype, created_at=None):
+        self.key = key
+        self.chunks = tuple(chunks)
+        self.mimetype = mimetype
+        self.size = sum(len(c) for c in self.chunks)
+        self.created_at = created_at or time.time()
+
+
+class SynthesisCache:
+    """两级合成缓存：有界内存 LRU 在前，磁盘内容寻址存储在后"""
+
+    def __init__(self, cache_dir=None, memory_items=256, memory_bytes=64 * 1024 * 1024,
+                 disk_bytes=1024 * 1024 * 1024, max_age=7 * 24 * 3600, enabled=True):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_age = max_age
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None  # 首次使用时扫描目录得到
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "expired": 0,
+            "errors": 0,
+        }
+
+    # --- 磁盘路径 ---
+    def _paths(self, key):
+        subdir = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(subdir, key), os.path.join(subdir, key + ".meta")
+
+    def _incr(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    # --- 内存层 ---
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if self.max_age and time.time() - entry.created_at > self.max_age:
+                self._memory.pop(key)
+                self._memory_size -= entry.size
+                self._stats["expired"] += 1
+                return None
+            self._memory.move_to_end(key)
+            return entry
+
+    def _memory_put(self, entry):
+        # 超过内存总容量一半的单个条目只落盘，避免冲掉整个内存层
+        if entry.size > self.memory_bytes // 2 or self.memory_items <= 0:
+            return
+        with self._lock:
+            old = self._memory.pop(entry.key, None)
+            if old is not None:
+                self._memory_size -= old.size
+            self._memory[entry.key] = entry
+            self._memory_size += entry.size
+            while self._memory and (
+                len(self._memory) > self.memory_items or self._memory_size > self.memory_bytes
+            ):
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= evicted.size
+                self._stats["memory_evictions"] += 1
+
+    # --- 磁盘层 ---
+    def _disk_get(self, key):
+        if not self.cache_dir:
+            return None
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            created_at = meta.get("created_at", 0)
+            if self.max_age and time.time() - created_at > self.max_age:
+                self._disk_remove(key)
+                self._incr("expired")
+                return None
+            with open(data_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self._incr("errors")
+            return None
+        # 只更新访问时间（atime），mtime 保留为写入时间用于按年龄淘汰
+        try:
+            os.utime(data_path, (time.time(), os.stat(data_path).st_mtime))
+        except OSError:
+            pass
+        return CacheEntry(key, [data], meta.get("mimetype", "application/octet-stream"), created_at)
+
+    def _disk_put(self, entry):
+        if not self.cache_dir or entry.size > self.disk_bytes:
+            return
+        data_path, meta_path = self._paths(entry.key)
+        subdir = os.path.dirname(data_path)
+        try:
+            os.makedirs(subdir, exist_ok=True)
+            # 先写临时文件再原子替换，多个进程并发写同一键也不会读到半个文件
+            fd, tmp_path = tempfile.mkstemp(dir=subdir, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                for chunk in entry.chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, data_path)
+            fd, tmp_meta = tempfile.mkstemp(dir=subdir, prefix=".tmp-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"mimetype": entry.mimetype, "size": entry.size,
+                           "created_at": entry.created_at}, f)
+            os.replace(tmp_meta, meta_path)
+        except OSError:
+            self._incr("errors")
+            return
+
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += entry.size
+            needs_sweep = self._disk_size is None or self._disk_size > self.disk_bytes
+        if needs_sweep:
+            self.sweep()
+
+    def _disk_remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def sweep(self):
+        """扫描磁盘层，按写入时间删除过期条目，并按最近访问时间淘汰至容量上限以内"""
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return
+        now = time.time()
+        files = []
+        expired = 0
+        for subdir in os.listdir(self.cache_dir):
+            subpath = os.path.join(self.cache_dir, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                if name.startswith(".tmp-") or name.endswith(".meta"):
+                    continue
+                path = os.path.join(subpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if self.max_age and now - st.st_mtime > self.max_age:
+                    self._disk_remove(name)
+                    expired += 1
+                    continue
+                files.append((st.st_atime, st.st_size, name))
+
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        if total > self.disk_bytes:
+            files.sort()
+            # 淘汰到上限的 90%，避免每次写入都触发全量扫描
+            target = int(self.disk_bytes * 0.9)
+            for _, size, name in files:
+                if total <= target:
+                    break
+                self._disk_remove(name)
+                total -= size
+                evicted += 1
+
+        with self._lock:
+            self._disk_size = total
+            self._stats["disk_evictions"] += evicted
+            self._stats["expired"] += expired
+
+    # --- 公共接口 ---
+    def get(self, key):
+        """查询缓存，命中时返回 CacheEntry，否则返回 None"""
+        if not self.enabled:
+            return None
+        entry = self._memory_get(key)
+        if entry is not None:
+            self._incr("memory_hits")
+            return entry
+        entry = self._disk_get(key)
+        if entry is not None:
+            self._incr("disk_hits")
+            self._memory_put(entry)
+            return entry
+        self._incr("misses")
+        return None
+
+    def put(self, key, chunks, mimetype):
+        """写入缓存（内存层和磁盘层）"""
+        if not self.enabled:
+            return None
+        entry = CacheEntry(key, chunks, mimetype)
+        if entry.size == 0:
+            return None
+        self._memory_put(entry)
+        self._disk_put(entry)
+        self._incr("stores")
+        return entry
+
+    def storable(self, size=None):
+        """大小为 size 的音频（未知时为 None）写入后能否再读到：缓存关闭或超出两层容量时为 False"""
+        if not self.enabled:
+            return False
+        in_memory = self.memory_items > 0 and (size is None or size <= self.memory_bytes // 2)
+        on_disk = bool(self.cache_dir) and (size is None or size <= self.disk_bytes)
+        return in_memory or on_disk
+
+    def tee(self, key, iterable, mimetype):
+        """包装音频分块迭代器：边向客户端输出边收集，完整输出后写入缓存
+
+        客户端中途断开时关闭被包装的迭代器（结束上游读取、归还占用的名额）。
+        """
+        chunks = []
+        try:
+            for chunk in iterable:
+                if chunk:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        self.put(key, chunks, mimetype)
+
+    def clear(self):
+        """清空内存层（磁盘层保留，由 sweep 负责淘汰）"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+
+    def stats(self):
+        """返回命中/未命中/淘汰计数及当前容量，用于调优缓存大小"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "enabled": self.enabled,
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "memory_items_limit": self.memory_items,
+                "memory_bytes_limit": self.memory_bytes,
+                "disk_bytes": self._disk_size,
+                "disk_bytes_limit": self.disk_bytes,
+                "max_age": self.max_age,
+            })
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def create_cache_from_env(default_dir):
+    """根据环境变量创建缓存实例"""
+    return SynthesisCache(
+        cache_dir=os.environ.get("TTS_CACHE_DIR", default_dir) or None,
+        memory_items=int(os.environ.get("TTS_CACHE_MEMORY_ITEMS", 256)),
+        memory_bytes=int(os.environ.get("TTS_CACHE_MEMORY_MB", 64)) * 1024 * 1024,
+        disk_bytes=int(os.environ.get("TTS_CACHE_DISK_MB", 1024)) * 1024 * 1024,
+        max_age=int(os.environ.get("TTS_CACHE_MAX_AGE", 7 * 24 * 3600)),
+        enabled=os.environ.get("TTS_CACHE_ENABLED", "1").lower() not in ("0", "false", "no"),
+    )
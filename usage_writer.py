@@ -0,0 +1,256 @@
+"""API 使用记录的后台批量写入。"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+INSERT_SQL = """
+    INSERT INTO api_usage (api_key_id, provider, model, voice, text_length, audio_duration, success, error_message, cached, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def utc_timestamp():
+    """与 CURRENT_TIMESTAMP 相同格式的 UTC 时间，入队时即确定记录时间"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class UsageWriter:
+    """有界内存队列 + 后台线程，每 flush_interval 秒或每 batch_size 条在一个事务中写入
+
+    后台线程复用一个长连接，写入出错后重新连接。一批记录重试 3 次仍失败时丢弃，
+    计入 failed/dropped 并记录错误日志。
+
+    队列满时的处理策略（overflow）：
+    - "sync"：在请求线程中同步写入，不丢记录（默认）
+    - "drop"：丢弃该条记录并计数
+
+    传入 metrics_registry 时导出队列深度、每批写入耗时和丢弃记录数（tts_usage_writer_*）。
+    """
+
+    def __init__(self, connect, max_queue=10000, batch_size=200, flush_interval=0.05,
+                 overflow="sync", enabled=True, metrics_registry=None):
+        self.connect = connect
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.enabled = enabled
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._cond = threading.Condition()
+        self._pending = 0  # 已入队但尚未提交（或丢弃）的记录数
+        self._thread = None
+        self._db = None  # 后台线程的长连接
+        self._pid = None
+        self._stopping = False
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "dropped": 0,
+            "failed": 0,  # 重试后仍写入失败而丢弃的记录数（dropped 的一部分）
+            "sync_writes": 0,
+            "batches": 0,
+            "errors": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+            "max_queue_wait_ms": 0.0,
+        }
+        self._metrics = None
+        if metrics_registry is not None:
+            self._metrics = {
+                "queue": metrics_registry.gauge(
+                    "tts_usage_writer_queue_depth", "Usage records waiting for the background writer"
+                ),
+                "flush": metrics_registry.histogram(
+                    "tts_usage_writer_flush_seconds", "Time to write one batch of usage records",
+                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+                ),
+                "dropped": metrics_registry.counter(
+                    "tts_usage_writer_dropped_total", "Usage records dropped without being written", ("reason",)
+                ),
+            }
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._cond:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            # fork 出的 worker 中重建队列，父进程队列里的记录由父进程负责写入
+            if self._pid is not None and self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._pending = 0
+                self._db = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+            self._thread.start()
+
+    def _write(self, rows):
+        """在请求线程中用临时连接写入（队列满或未启用后台写入时）"""
+        db = self.connect()
+        try:
+            db.executemany(INSERT_SQL, rows)
+            db.commit()
+        finally:
+            db.close()
+
+    def _write_batch(self, rows):
+        """在后台线程中用长连接写入；出错时关闭连接，下次重新连接"""
+        if self._db is None:
+            self._db = self.connect()
+        try:
+            self._db.executemany(INSERT_SQL, rows)
+            self._db.commit()
+        except Exception:
+            db, self._db = self._db, None
+            try:
+                db.close()
+            except Exception:
+                pass
+            raise
+
+    def _write_sync(self, row):
+        try:
+            self._write([row])
+        except Exception:
+            with self._cond:
+                self._stats["errors"] += 1
+            raise
+        with self._cond:
+            self._stats["sync_writes"] += 1
+            self._stats["written"] += 1
+
+    def submit(self, row):
+        """提交一条使用记录（不含 created_at 的 9 个字段）"""
+        row = tuple(row) + (utc_timestamp(),)
+        if not self.enabled:
+            self._write_sync(row)
+            return
+        self._ensure_thread()
+        with self._cond:
+            self._stats["submitted"] += 1
+            self._pending += 1
+        try:
+            self._queue.put_nowait((time.monotonic(), row))
+        except queue.Full:
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+            if self.overflow == "drop":
+                with self._cond:
+                    self._stats["dropped"] += 1
+                self._dropped(1, "overflow")
+                return
+            self._write_sync(row)
+            return
+        self._queue_changed()
+
+    # --- 指标 ---
+    def _queue_changed(self):
+        if self._metrics is not None:
+            self._metrics["queue"].set(self._queue.qsize())
+
+    def _dropped(self, rows, reason):
+        if self._metrics is not None:
+            self._metrics["dropped"].inc(rows, reason=reason)
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._stopping:
+                    if self._db is not None:
+                        self._db.close()
+                        self._db = None
+                    return
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush_batch(batch)
+
+    def _flush_batch(self, batch):
+        rows = [row for _, row in batch]
+        started = time.monotonic()
+        written = False
+        error = None
+        for attempt in range(3):
+            try:
+                self._write_batch(rows)
+                written = True
+                break
+            except Exception as e:
+                error = e
+                with self._cond:
+                    self._stats["errors"] += 1
+                time.sleep(0.1 * (attempt + 1))
+        if not written:
+            logger.error("Usage batch dropped after retries", extra={"rows": len(rows), "error": str(error)})
+        finished = time.monotonic()
+        # 先更新指标再减少 pending，flush() 返回后指标已包含本批
+        if self._metrics is not None:
+            self._metrics["flush"].observe(finished - started)
+            self._queue_changed()
+            if not written:
+                self._dropped(len(rows), "failed")
+        flush_ms = (finished - started) * 1000
+        wait_ms = (finished - min(ts for ts, _ in batch)) * 1000
+        with self._cond:
+            if written:
+                self._stats["written"] += len(rows)
+                self._stats["batches"] += 1
+            else:
+                self._stats["dropped"] += len(rows)
+                self._stats["failed"] += len(rows)
+            self._stats["last_flush_ms"] = round(flush_ms, 3)
+            self._stats["max_flush_ms"] = round(max(self._stats["max_flush_ms"], flush_ms), 3)
+            self._stats["total_flush_ms"] += flush_ms
+            self._stats["max_queue_wait_ms"] = round(max(self._stats["max_queue_wait_ms"], wait_ms), 3)
+            self._pending -= len(rows)
+            self._cond.notify_all()
+
+    def flush(self, timeout=5.0):
+        """等待已入队的记录全部写入，返回是否在超时前完成"""
+        if not self.enabled or self._pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=10.0):
+        """关闭前尽量写完队列中的记录"""
+        self.flush(timeout)
+        self._stopping = True
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._queue.qsize()
+            stats["pending"] = self._pending
+        stats["max_queue"] = self.max_queue
+        stats["overflow"] = self.overflow
+        total_flush_ms = stats.pop("total_flush_ms")
+        stats["avg_flush_ms"] = round(total_flush_ms / stats["batches"], 3) if stats["batches"] else 0.0
+        stats["avg_batch_size"] = round((stats["written"] - stats["sync_writes"]) / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats